@@ -0,0 +1,101 @@
+from contextlib import ExitStack, contextmanager
+from pathlib import PurePosixPath
+from zipfile import ZipFile
+import os
+
+# Function to pick the data directory for an archive based on the filename prefix
+# Files that start with JC contain Jersey City data, otherwise it contains NYC data
+def city_directory_for(filename: str) -> str:
+    return "jersey_city_data" if filename.startswith("JC") else "nyc_data"
+
+# Function to work out the name a CSV gets once the old/new data format is marked
+# Citibike changed their data format in Feb 2021, so older files get an '_old' suffix
+# Files that already have it keep their name, so renaming what an earlier (or crashed) run left in the data
+# directories doesn't turn them into '_old_old' files, which would then be deleted as duplicates
+def renamed_csv_name(filename: str, base_directory: str) -> str:
+    stem, extension = os.path.splitext(filename)
+    if stem.endswith('_old'):
+        return filename
+
+    # Rename old NYC data files to include '_old' suffix for easy identification
+    if base_directory.endswith("nyc_data"):
+        try:
+            file_date = int(stem[:6])
+        except ValueError:
+            return filename
+
+    # Similar renaming logic for Jersey City data
+    elif base_directory.endswith("jersey_city_data"):
+        try:
+            start_index = stem.find('JC-') + 3
+            file_date = int(stem[start_index:start_index+6])
+        except ValueError:
+            try:
+                file_date = int(stem.split("-")[1])
+            except (ValueError, IndexError):
+                file_date = None
+    else:
+        return filename
+
+    if file_date and file_date < 202102:
+        return f"{stem}_old{extension}"
+    return filename
+
+# Function to check whether a (renamed) CSV only holds data that is also in another file
+# For 2013 and 2018, files ending in '1_old', '2_old' or '3_old' overlap with the main '_old' file,
+# and any '_old_old' file is a duplicate
+def is_redundant_csv(filename: str) -> bool:
+    stem = os.path.splitext(filename)[0]
+    if stem[:4] in ['2013', '2018'] and any(stem.endswith(f"{i}_old") for i in range(1, 4)):
+        return True
+    return '_old_old' in stem
+
+# Function to check whether an archive member is macOS metadata rather than data
+def is_macos_metadata(member_name: str) -> bool:
+    path = PurePosixPath(member_name)
+    return '__MACOSX' in path.parts or path.name.startswith('._')
+
+# Function to list the CSV members of an open archive, descending into nested zips
+# Yields (member_chain, size) where member_chain is the list of member names to follow from the outer archive
+def iter_csv_members(archive: ZipFile, chain: tuple = ()):
+    for info in archive.infolist():
+        if info.is_dir() or is_macos_metadata(info.filename):
+            continue
+        if info.filename.lower().endswith('.zip'):
+            with archive.open(info) as nested_file, ZipFile(nested_file) as nested:
+                yield from iter_csv_members(nested, chain + (info.filename,))
+        elif info.filename.endswith('.csv'):
+            yield list(chain + (info.filename,)), info.file_size
+
+# Function to list the CSVs held in downloaded archives without extracting them
+# Applies the same rules as the extract path in memory: __MACOSX filtering, first-seen wins for duplicate
+# file names, '_old' renaming and the 2013/2018 clean-up. Returns (zip_path, member_chain, base_directory,
+# csv_name, size) tuples
+def list_archive_csvs(zip_paths: list) -> list:
+    seen_files = {}
+    csv_members = []
+    for zip_path in sorted(zip_paths):
+        base_directory = city_directory_for(os.path.basename(zip_path))
+        with ZipFile(zip_path) as archive:
+            for member_chain, size in iter_csv_members(archive):
+                filename = PurePosixPath(member_chain[-1]).name
+                if filename in seen_files.setdefault(base_directory, set()):
+                    continue
+                seen_files[base_directory].add(filename)
+
+                csv_name = renamed_csv_name(filename, base_directory)
+                if is_redundant_csv(csv_name):
+                    print(f"Skipping {csv_name} in {os.path.basename(zip_path)}, its data is in another file.")
+                    continue
+                csv_members.append((zip_path, member_chain, base_directory, csv_name, size))
+    return csv_members
+
+# Function to open a CSV inside an archive (following nested zips) as a binary file object
+# Nested archives are read straight from the outer archive's stream, so nothing is written to disk
+@contextmanager
+def open_archive_member(zip_path: str, member_chain: list):
+    with ExitStack() as stack:
+        archive = stack.enter_context(ZipFile(zip_path))
+        for member_name in member_chain[:-1]:
+            archive = stack.enter_context(ZipFile(stack.enter_context(archive.open(member_name))))
+        yield stack.enter_context(archive.open(member_chain[-1]))
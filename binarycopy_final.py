@@ -0,0 +1,165 @@
+import math
+import struct
+from decimal import Decimal, ROUND_HALF_UP
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from metrics_final import substage
+
+# Rows encoded at a time; every field of a batch is held as its own bytes object until the batch is joined
+BINARY_BATCH_ROWS = 50_000
+
+# Start of a binary COPY stream: the signature, then the flags and header extension length (both 0)
+binary_copy_header = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+# End of a binary COPY stream: a field count of -1
+binary_copy_trailer = struct.pack('>h', -1)
+# A NULL field is a length of -1 with no data after it
+null_field = struct.pack('>i', -1)
+
+# Postgres types of the preprocessed ride columns, as declared for the load tables in loading_final.py
+rides_binary_types = {
+    'ride_id': 'text', 'rideable_type': 'text', 'started_at': 'timestamp', 'ended_at': 'timestamp',
+    'start_station_name': 'text', 'start_station_id': 'text', 'end_station_name': 'text', 'end_station_id': 'text',
+    'start_lat': 'numeric', 'start_lng': 'numeric', 'end_lat': 'numeric', 'end_lng': 'numeric',
+    'member_casual': 'text', 'trip_duration_seconds': 'int4', 'trip_distance_meters': 'int4', 'bike_id': 'text',
+    'gender': 'int4', 'birth_year': 'int4', 'data_source_city': 'text',
+}
+
+# Postgres timestamps count microseconds from 2000-01-01, 946,684,800 seconds after the Unix epoch
+postgres_epoch_microseconds = 946_684_800 * 10 ** 6
+
+# Decimal places of the DECIMAL(9, 6) coordinate columns
+numeric_scale = 6
+numeric_quantum = Decimal(1).scaleb(-numeric_scale)
+
+# Function to prefix a field's data with its length
+def length_prefixed(data):
+    return struct.pack('>i', len(data)) + data
+
+# Function to encode a text column, one field per row
+# Matches what the CSV path stores: to_csv writes each value with str() and missing values as 'NULL',
+# and COPY ... NULL 'NULL' reads both a missing value and the text 'NULL' as NULL
+def text_fields(series):
+    codes, uniques = pd.factorize(series)
+    texts = [str(value) for value in uniques]
+    fields = [null_field if text == 'NULL' else length_prefixed(text.encode('utf-8')) for text in texts]
+    fields = np.array(fields + [null_field], dtype=object)
+    return fields[np.where(codes < 0, len(uniques), codes)]
+
+# Function to encode fixed-width values, one field per row, with NULL for the missing ones
+def fixed_width_fields(values, missing, dtype):
+    fields = np.full(len(values), null_field, dtype=object)
+    if missing.all():
+        return fields
+    records = np.empty(len(values), dtype=[('length', '>i4'), ('value', dtype)])
+    records['length'] = np.dtype(dtype).itemsize
+    records['value'] = values
+    data = records.tobytes()
+    width = records.itemsize
+    present = np.flatnonzero(~missing)
+    fields[present] = [data[i * width:(i + 1) * width] for i in present.tolist()]
+    return fields
+
+# Function to encode a timestamp column as microseconds since 2000-01-01
+# The CSV path writes the fraction of a second as text, which Postgres reads as a double and rounds to
+# microseconds with rint(); the same arithmetic here gives the same microsecond for nanosecond values
+def timestamp_fields(series):
+    values = series.values.astype('datetime64[ns]')
+    missing = np.isnat(values)
+    seconds, nanoseconds = np.divmod(values.view('int64'), 10 ** 9)
+    microseconds = np.rint(nanoseconds / 1e9 * 1e6).astype('int64')
+    return fixed_width_fields(seconds * 10 ** 6 + microseconds - postgres_epoch_microseconds, missing, '>i8')
+
+# Function to encode an INT column
+# The CSV path can't load floats into INT (to_csv writes 1 as '1.0'), so they are refused here as well
+def int4_fields(series, column):
+    missing = series.isna().to_numpy()
+    if missing.all():
+        values = np.zeros(len(series), dtype='int64')
+    elif pd.api.types.is_integer_dtype(series.dtype):
+        values = series.to_numpy(dtype='int64', na_value=0)
+    elif series.dtype == object:
+        values = series.astype('Int64').to_numpy(dtype='int64', na_value=0)
+    else:
+        raise ValueError(f"{column} holds {series.dtype} values, which can't be loaded into an INT column")
+    if (((values < -2 ** 31) | (values >= 2 ** 31)) & ~missing).any():
+        raise ValueError(f"{column} holds values out of range for an INT column")
+    return fixed_width_fields(values, missing, '>i4')
+
+# Function to encode one DECIMAL(9, 6) value in Postgres' binary numeric format
+# The value is rounded to 6 places half away from zero from the text to_csv writes for it (its repr),
+# which is how Postgres rounds that text on the CSV path. Coordinates repeat a lot, so encodings are cached
+@lru_cache(maxsize=2 ** 16)
+def numeric_field(value):
+    if not math.isfinite(value):
+        raise ValueError(f"{value} can't be loaded into a DECIMAL(9, 6) column")
+    scaled = int(Decimal(repr(value)).quantize(numeric_quantum, rounding=ROUND_HALF_UP).scaleb(numeric_scale))
+    negative = scaled < 0
+    integer, fraction = divmod(abs(scaled), 10 ** numeric_scale)
+
+    # Digits are base 10000, most significant first; weight is the power of 10000 of the first one
+    digits = []
+    while integer:
+        integer, digit = divmod(integer, 10000)
+        digits.insert(0, digit)
+    weight = len(digits) - 1
+    digits += [fraction // 100, fraction % 100 * 100]
+    while digits and digits[0] == 0:
+        digits.pop(0)
+        weight -= 1
+    while digits and digits[-1] == 0:
+        digits.pop()
+    if not digits:
+        weight, negative = 0, False
+
+    return struct.pack(f'>ihhhh{len(digits)}h', 8 + 2 * len(digits), len(digits), weight,
+                       0x4000 if negative else 0, numeric_scale, *digits)
+
+# Function to encode a DECIMAL(9, 6) column, one field per row
+def numeric_fields(series):
+    values = series if pd.api.types.is_float_dtype(series.dtype) else pd.to_numeric(series)
+    codes, uniques = pd.factorize(values.to_numpy(dtype='float64', na_value=np.nan))
+    fields = np.array([numeric_field(value) for value in uniques.tolist()] + [null_field], dtype=object)
+    return fields[np.where(codes < 0, len(uniques), codes)]
+
+# Function to encode one column of transformed rides according to its Postgres type
+def column_fields(series, column):
+    column_type = rides_binary_types[column]
+    if column_type == 'timestamp':
+        return timestamp_fields(series)
+    if column_type == 'numeric':
+        return numeric_fields(series)
+    if column_type == 'int4':
+        return int4_fields(series, column)
+    return text_fields(series)
+
+# Function to encode a batch of transformed rides as a table of fields, a row's field count first
+def row_fields(batch):
+    rows = np.empty((len(batch), len(batch.columns) + 1), dtype=object)
+    rows[:, 0] = struct.pack('>h', len(batch.columns))
+    for i, column in enumerate(batch.columns):
+        rows[:, i + 1] = column_fields(batch[column], column)
+    return rows
+
+# Function to encode transformed rides (from transform_rides) as the rows of a binary COPY stream
+# Yields one bytes object per batch of rows; the COPY column list must follow the DataFrame's columns
+def binary_copy_rows(df, batch_rows=BINARY_BATCH_ROWS):
+    for start in range(0, len(df), batch_rows):
+        with substage('to_binary'):
+            data = b''.join(row_fields(df.iloc[start:start + batch_rows]).ravel().tolist())
+        yield data
+
+# Function to encode transformed rides as binary COPY rows, one bytes object per row, so they can be sent in any split
+def binary_copy_row_list(df, batch_rows=BINARY_BATCH_ROWS):
+    encoded = []
+    for start in range(0, len(df), batch_rows):
+        with substage('to_binary'):
+            encoded.extend(b''.join(row) for row in row_fields(df.iloc[start:start + batch_rows]).tolist())
+    return encoded
+
+# Function to turn DataFrames of transformed rides into the chunks of one binary COPY stream
+def binary_copy_chunks(frames):
+    yield binary_copy_header
+    for df in frames:
+        yield from binary_copy_rows(df)
+    yield binary_copy_trailer
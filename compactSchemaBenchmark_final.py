@@ -0,0 +1,124 @@
+import os
+import time
+import psycopg2
+from createTables_final import (create_stations_table_sql, rides_columns_sql, create_enum_types_sql,
+                                create_compact_stations_table_sql, compact_rides_columns_sql, rides_table_sql)
+from createIndexes_final import index_sql, indexed_columns
+from loading_final import load_rides, finish_loading
+from rollups_final import create_rollup_tables_sql
+
+# Database connection setup
+DATABASE_URI = 'YOUR_DATABASE_URI'
+
+base_dir = 'YOUR_BASE_DIR'
+preprocessed_csv_dir = os.path.join(base_dir, 'preprocessed_for_copy')
+
+# Benchmark setup: preprocessed files loaded into each schema (None loads them all) and runs per query
+BENCHMARK_FILES = 3
+QUERY_RUNS = 5
+
+# Each layout is loaded into its own Postgres schema, so the benchmark leaves the real tables alone
+layouts = {
+    'wide': ('benchmark_wide', False),
+    'compact': ('benchmark_compact', True),
+}
+
+# Common queries, written for the wide and the compact schema
+benchmark_queries = {
+    'rides per month': (
+        "SELECT date_trunc('month', started_at), count(*) FROM rides GROUP BY 1 ORDER BY 1;",
+        "SELECT date_trunc('month', started_at), count(*) FROM rides GROUP BY 1 ORDER BY 1;",
+    ),
+    'members vs casual riders': (
+        "SELECT member_casual, count(*), avg(ended_at - started_at) FROM rides GROUP BY 1;",
+        "SELECT member_casual, count(*), avg(ended_at - started_at) FROM rides GROUP BY 1;",
+    ),
+    'busiest start stations': (
+        "SELECT start_station_name, count(*) FROM rides GROUP BY 1 ORDER BY 2 DESC LIMIT 10;",
+        """SELECT s.station_name, count(*) FROM rides r JOIN stations s ON s.station_key = r.start_station_key
+           GROUP BY 1 ORDER BY 2 DESC LIMIT 10;""",
+    ),
+    'rides from one station': (
+        """SELECT count(*), avg(ended_at - started_at) FROM rides
+           WHERE start_station_id = (SELECT station_id FROM stations ORDER BY station_id LIMIT 1);""",
+        """SELECT count(*), avg(ended_at - started_at) FROM rides
+           WHERE start_station_key = (SELECT station_key FROM stations ORDER BY station_id LIMIT 1);""",
+    ),
+}
+
+# Function to create, load and index the tables of one layout in its own schema
+# Returns the load time in seconds
+def build_layout(schema, compact, filepaths):
+    conn = psycopg2.connect(DATABASE_URI, options=f"-c search_path={schema}")
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema};")
+            if compact:
+                cursor.execute(create_enum_types_sql)
+                cursor.execute(create_compact_stations_table_sql)
+                cursor.execute(rides_table_sql(compact_rides_columns_sql, partitioned=False))
+            else:
+                cursor.execute(create_stations_table_sql)
+                cursor.execute(rides_table_sql(rides_columns_sql, partitioned=False))
+            cursor.execute(create_rollup_tables_sql)
+        conn.commit()
+
+        start = time.perf_counter()
+        for filepath in filepaths:
+            load_rides(conn, filepath)
+        finish_loading(conn)
+        with conn.cursor() as cursor:
+            for column in indexed_columns(compact):
+                cursor.execute(index_sql(column))
+        conn.commit()
+        load_seconds = time.perf_counter() - start
+
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute("VACUUM ANALYZE rides;")
+            cursor.execute("VACUUM ANALYZE stations;")
+        return load_seconds
+    finally:
+        conn.close()
+
+# Function to measure the size of one layout and time the common queries against it
+def measure_layout(schema, compact):
+    conn = psycopg2.connect(DATABASE_URI, options=f"-c search_path={schema}")
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT pg_relation_size('rides'), pg_indexes_size('rides'), pg_total_relation_size('stations'),
+                       (SELECT avg(pg_column_size(r.*)) FROM rides r);
+            """)
+            table_bytes, index_bytes, stations_bytes, row_bytes = cursor.fetchone()
+            metrics = {'rides table MB': table_bytes / 1024 ** 2, 'rides indexes MB': index_bytes / 1024 ** 2,
+                       'stations MB': stations_bytes / 1024 ** 2, 'average row bytes': float(row_bytes or 0)}
+
+            for name, queries in benchmark_queries.items():
+                timings = []
+                for _ in range(QUERY_RUNS):
+                    start = time.perf_counter()
+                    cursor.execute(queries[compact])
+                    cursor.fetchall()
+                    timings.append(time.perf_counter() - start)
+                metrics[f"{name} ms"] = min(timings) * 1000
+        return metrics
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    filepaths = sorted(os.path.join(preprocessed_csv_dir, filename)
+                       for filename in os.listdir(preprocessed_csv_dir) if filename.endswith('.csv'))
+    filepaths = filepaths[:BENCHMARK_FILES] if BENCHMARK_FILES else filepaths
+    print(f"Loading {len(filepaths)} files into each layout...")
+
+    results = {}
+    for layout, (schema, compact) in layouts.items():
+        load_seconds = build_layout(schema, compact, filepaths)
+        results[layout] = {'load seconds': load_seconds, **measure_layout(schema, compact)}
+
+    print(f"{'metric':<32} {'wide':>12} {'compact':>12} {'compact/wide':>13}")
+    for metric, wide_value in results['wide'].items():
+        compact_value = results['compact'][metric]
+        ratio = compact_value / wide_value if wide_value else float('nan')
+        print(f"{metric:<32} {wide_value:>12,.1f} {compact_value:>12,.1f} {ratio:>13.2f}")
@@ -0,0 +1,110 @@
+import os
+import sys
+import time
+import psycopg2
+import syntheticData_final
+from preprocessing_final import final_columns, list_archive_jobs, iter_transformed_rides, rides_csv_text, source_name
+from loading_final import COPY_BUFFER_SIZE, CopyChunkStream, rides_csv_columns_sql, copy_sql, copy_rides_into
+from binarycopy_final import binary_copy_chunks
+
+# Database connection setup (a local Postgres; the benchmark only touches its own schema)
+DATABASE_URI = 'YOUR_DATABASE_URI'
+BENCHMARK_SCHEMA = 'benchmark_copy_format'
+
+# Benchmark setup: synthetic archives generated into archive_dir, and timed runs per format
+archive_dir = os.path.join('copy_format_benchmark', 'archives')
+ROWS_PER_FILE = 100_000
+BENCHMARK_RUNS = 3
+
+# Formats compared, each COPYed into its own table with the columns of the load tables in loading_final.py
+copy_formats = ['csv', 'binary']
+
+# Function to transform every raw CSV of the synthetic archives once, keeping the DataFrames in memory
+# so the runs only time encoding and COPY
+def transform_archives():
+    if not os.path.isdir(archive_dir):
+        syntheticData_final.generate_dataset(archive_dir, rows_per_file=ROWS_PER_FILE)
+    frames = []
+    for source, _, city_name, is_old_format in list_archive_jobs(archive_dir):
+        print(f"Transforming {source_name(source)}...")
+        frames.extend(df for df, _ in iter_transformed_rides(source, city_name, is_old_format))
+    return frames
+
+# Function to encode the transformed rides for COPY in one format, chunk by chunk
+def iter_encoded_chunks(frames, copy_format):
+    if copy_format == 'binary':
+        yield from binary_copy_chunks(frames)
+        return
+    yield ','.join(final_columns) + '\n'
+    for df in frames:
+        yield rides_csv_text(df)
+
+# Function to time one run of a format: encoding alone, COPY of the already encoded chunks (the server's share),
+# and encoding streamed into COPY as the pipeline does it
+def time_format(conn, frames, copy_format):
+    table = f"rides_{copy_format}"
+    with conn.cursor() as cursor:
+        start = time.perf_counter()
+        chunks = list(iter_encoded_chunks(frames, copy_format))
+        encode_seconds = time.perf_counter() - start
+
+        cursor.execute(f"TRUNCATE {table};")
+        conn.commit()
+        start = time.perf_counter()
+        cursor.copy_expert(sql=copy_sql(table, copy_format), file=CopyChunkStream(chunks), size=COPY_BUFFER_SIZE)
+        conn.commit()
+        copy_seconds = time.perf_counter() - start
+
+        cursor.execute(f"TRUNCATE {table};")
+        conn.commit()
+        start = time.perf_counter()
+        # The binary mode of copy_rides_into takes the DataFrames and encodes them itself
+        source = frames if copy_format == 'binary' else iter_encoded_chunks(frames, copy_format)
+        rows = copy_rides_into(cursor, table, source, copy_format)
+        conn.commit()
+        stream_seconds = time.perf_counter() - start
+    return {'encode seconds': encode_seconds, 'copy seconds': copy_seconds, 'streamed seconds': stream_seconds,
+            'rows': rows, 'MB sent': sum(len(chunk) for chunk in chunks) / 1024 ** 2}
+
+# Function to check that both formats stored exactly the same rows
+# Returns the number of rows found in one table but not the other
+def count_mismatched_rows(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT (SELECT count(*) FROM (SELECT * FROM rides_csv EXCEPT ALL SELECT * FROM rides_binary) AS a)
+                 + (SELECT count(*) FROM (SELECT * FROM rides_binary EXCEPT ALL SELECT * FROM rides_csv) AS b);
+        """)
+        return cursor.fetchone()[0]
+
+if __name__ == '__main__':
+    frames = transform_archives()
+    print(f"Benchmarking {sum(len(df) for df in frames):,} rides...")
+
+    conn = psycopg2.connect(DATABASE_URI, options=f"-c search_path={BENCHMARK_SCHEMA}")
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {BENCHMARK_SCHEMA} CASCADE; CREATE SCHEMA {BENCHMARK_SCHEMA};")
+        for copy_format in copy_formats:
+            cursor.execute(f"CREATE UNLOGGED TABLE rides_{copy_format} ({rides_csv_columns_sql});")
+    conn.commit()
+
+    # Each metric is the best of the runs
+    results = {copy_format: {} for copy_format in copy_formats}
+    for run in range(BENCHMARK_RUNS):
+        for copy_format in copy_formats:
+            for metric, value in time_format(conn, frames, copy_format).items():
+                best = results[copy_format].get(metric)
+                results[copy_format][metric] = value if best is None or 'seconds' not in metric else min(best, value)
+    for metrics in results.values():
+        metrics['rows/s streamed'] = metrics['rows'] / metrics['streamed seconds']
+
+    print(f"{'metric':<20} {'csv':>12} {'binary':>12} {'binary/csv':>11}")
+    for metric, csv_value in results['csv'].items():
+        binary_value = results['binary'][metric]
+        print(f"{metric:<20} {csv_value:>12,.2f} {binary_value:>12,.2f} {binary_value / csv_value:>11.2f}")
+
+    mismatched = count_mismatched_rows(conn)
+    conn.close()
+    if mismatched:
+        print(f"The formats stored different rows ({mismatched:,} rows differ).")
+        sys.exit(1)
+    print("Both formats stored the same rows.")
@@ -1,35 +1,126 @@
+import time
 import psycopg2
+from concurrent.futures import ThreadPoolExecutor
+from metrics_final import MetricsConnection, stage
 
 # Database connection setup
 DATABASE_URI = 'YOUR_DATABASE_URI'
 
+# Connections building indexes at the same time (each index is built on its own connection)
+INDEX_WORKERS = 5
+
+# Build with CREATE INDEX CONCURRENTLY so rides stays writable during the build
+# Postgres allows one concurrent build per table at a time, so these builds run one after another
+CREATE_CONCURRENTLY = False
+
+# Index method for started_at/ended_at: 'BRIN' is tiny and quick to build because rides are loaded in time order
+TIME_INDEX_METHOD = 'BTREE'
+
+# maintenance_work_mem for each building connection (e.g. '1GB'), None keeps the server default
+MAINTENANCE_WORK_MEM = None
+
+# Columns of the rides table that get an index (the compact schema refers to stations by station_key)
+time_columns = ['started_at', 'ended_at']
+
+def indexed_columns(compact=False):
+    station_column = 'station_key' if compact else 'station_id'
+    return time_columns + [f'start_{station_column}', f'end_{station_column}', 'member_casual']
+
+rides_indexed_columns = indexed_columns()
+
+# Function to pick the index name and method for a column
+def index_name_and_method(column, time_index_method=TIME_INDEX_METHOD):
+    method = time_index_method if column in time_columns else 'BTREE'
+    name = f"idx_rides_{column}" if method == 'BTREE' else f"idx_rides_{column}_{method.lower()}"
+    return name, method
+
+# Function to build the CREATE INDEX statement for a column
+def index_sql(column, time_index_method=TIME_INDEX_METHOD, concurrently=False):
+    name, method = index_name_and_method(column, time_index_method)
+    concurrently = "CONCURRENTLY " if concurrently else ""
+    return f"CREATE INDEX {concurrently}IF NOT EXISTS {name} ON rides USING {method} ({column});"
+
 # SQL statements to create indexes
-index_creation_commands = [
-    "CREATE INDEX IF NOT EXISTS idx_rides_started_at ON rides USING BTREE (started_at);",
-    "CREATE INDEX IF NOT EXISTS idx_rides_ended_at ON rides USING BTREE (ended_at);",
-    "CREATE INDEX IF NOT EXISTS idx_rides_start_station_id ON rides USING BTREE (start_station_id);",
-    "CREATE INDEX IF NOT EXISTS idx_rides_end_station_id ON rides USING BTREE (end_station_id);",
-    "CREATE INDEX IF NOT EXISTS idx_rides_member_casual ON rides USING BTREE (member_casual);",
-]
-
-def create_indexes():
+index_creation_commands = [index_sql(column) for column in rides_indexed_columns]
+
+# Function to build one index on its own connection and measure it
+# Returns the index name, method, build time and on-disk size (summed over partitions for a partitioned table)
+def build_index(column, time_index_method, concurrently):
+    name, method = index_name_and_method(column, time_index_method)
+    result = {'index': name, 'method': method, 'seconds': 0.0, 'bytes': 0, 'error': None}
+    conn = None
     try:
-        # Connect to the database
-        conn = psycopg2.connect(DATABASE_URI)
-        cursor = conn.cursor()
-        
-        for command in index_creation_commands:
-            cursor.execute(command)
-
-        # Commit the changes
-        conn.commit()
-        print("Indexes created successfully.")
-        
+        # A failed connection fails this index only, not the rest of the build
+        conn = psycopg2.connect(DATABASE_URI, connection_factory=MetricsConnection)
+        # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+        conn.autocommit = True
+        with stage('index_build', index=name, method=method) as record, conn.cursor() as cursor:
+            if MAINTENANCE_WORK_MEM:
+                cursor.execute("SET maintenance_work_mem = %s;", (MAINTENANCE_WORK_MEM,))
+            print(f"Building {name}...")
+            start = time.perf_counter()
+            cursor.execute(index_sql(column, time_index_method, concurrently))
+            result['seconds'] = time.perf_counter() - start
+            cursor.execute("""
+                SELECT coalesce((SELECT sum(pg_relation_size(relid)) FROM pg_partition_tree(%(name)s::regclass)),
+                                pg_relation_size(%(name)s::regclass));
+            """, {'name': name})
+            result['bytes'] = record['bytes'] = int(cursor.fetchone()[0])
     except Exception as e:
-        print(f"An error occurred: {e}")
+        # A failed concurrent build leaves an INVALID index behind, which has to be dropped before retrying
+        result['error'] = repr(e)
+        print(f"An error occurred while building {name}: {e}")
+    finally:
+        if conn is not None:
+            conn.close()
+    return result
+
+# Function to check whether rides is partitioned (CONCURRENTLY isn't supported on partitioned tables)
+# and whether it uses the compact schema
+def describe_rides():
+    conn = psycopg2.connect(DATABASE_URI)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT relkind = 'p', EXISTS (
+                    SELECT 1 FROM pg_attribute WHERE attrelid = pg_class.oid AND attname = 'start_station_key'
+                )
+                FROM pg_class WHERE oid = 'rides'::regclass;
+            """)
+            return cursor.fetchone()
     finally:
-        # Close the cursor and connection to clean up
-        cursor.close()
         conn.close()
 
-create_indexes()
+def create_indexes(workers=INDEX_WORKERS, concurrently=CREATE_CONCURRENTLY, time_index_method=TIME_INDEX_METHOD):
+    partitioned, compact = describe_rides()
+    if concurrently and partitioned:
+        print("rides is partitioned, which doesn't support CREATE INDEX CONCURRENTLY; building normally.")
+        concurrently = False
+    # Plain builds only take a SHARE lock, so several of them can run on rides at once
+    workers = 1 if concurrently else workers
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda column: build_index(column, time_index_method, concurrently),
+                                    indexed_columns(compact)))
+    total_seconds = time.perf_counter() - start
+
+    print_index_report(results, total_seconds)
+    if not any(result['error'] for result in results):
+        print("Indexes created successfully.")
+    return results
+
+# Function to print the build time and size of each index
+def print_index_report(results, total_seconds):
+    print(f"{'index':<32} {'method':>7} {'seconds':>9} {'MB':>9}")
+    for result in results:
+        if result['error']:
+            print(f"{result['index']:<32} FAILED: {result['error']}")
+        else:
+            print(f"{result['index']:<32} {result['method']:>7} {result['seconds']:>9.1f} "
+                  f"{result['bytes'] / 1024 ** 2:>9.1f}")
+    print(f"{'total (wall clock)':<32} {'':>7} {total_seconds:>9.1f} "
+          f"{sum(result['bytes'] for result in results) / 1024 ** 2:>9.1f}")
+
+if __name__ == '__main__':
+    create_indexes()
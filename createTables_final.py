@@ -1,4 +1,6 @@
 import psycopg2
+from rollups_final import create_rollup_tables_sql
+from quarantine_final import create_quarantine_table_sql
 
 # Database connection setup
 DATABASE_URI = 'YOUR_DATABASE_URI'
@@ -13,10 +15,15 @@ CREATE TABLE IF NOT EXISTS stations (
 );
 """
 
-# SQL statement to create the rides table with foreign keys for stations
-create_rides_table_sql = """
-CREATE TABLE IF NOT EXISTS rides (
-    id SERIAL PRIMARY KEY,
+# Create rides partitioned by started_at month (and by city within each month) instead of as one table
+PARTITION_RIDES = False
+
+# Use the compact schema: rides refer to stations by an integer key, low-cardinality text columns are enums,
+# and coordinates are floats; station names are only kept in 'stations'
+COMPACT_SCHEMA = False
+
+# Column definitions of the rides table
+rides_columns_sql = """
     ride_id VARCHAR(255) NOT NULL,
     rideable_type VARCHAR(255) NULL,
     started_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
@@ -31,13 +38,101 @@ CREATE TABLE IF NOT EXISTS rides (
     end_lng DECIMAL(9, 6) NULL,
     member_casual VARCHAR(50) NULL,
     trip_duration_seconds INT NULL,
+    trip_distance_meters INT NULL,  -- Straight-line distance from the start to the end point
     bike_id VARCHAR(255) NULL,
     gender INT NULL,
     birth_year INT NULL,
-    data_source_city VARCHAR(255) NOT NULL
+    data_source_city VARCHAR(255) NOT NULL"""
+
+# SQL statement to create the enum types used by the compact schema
+# Citibike adding a new rideable type needs an ALTER TYPE rideable_type_enum ADD VALUE before it can be loaded
+create_enum_types_sql = """
+DO $$ BEGIN
+    CREATE TYPE rideable_type_enum AS ENUM ('classic_bike', 'electric_bike', 'docked_bike');
+EXCEPTION WHEN duplicate_object THEN NULL; END $$;
+DO $$ BEGIN
+    CREATE TYPE member_casual_enum AS ENUM ('member', 'casual');
+EXCEPTION WHEN duplicate_object THEN NULL; END $$;
+DO $$ BEGIN
+    CREATE TYPE data_source_city_enum AS ENUM ('NYC', 'Jersey City');
+EXCEPTION WHEN duplicate_object THEN NULL; END $$;
+"""
+
+# SQL statement to create the stations table of the compact schema
+# station_key is the integer rides refer to; the table is filled as rides are loaded
+create_compact_stations_table_sql = """
+CREATE TABLE IF NOT EXISTS stations (
+    station_key INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    station_id VARCHAR(255) NOT NULL UNIQUE,
+    station_name VARCHAR(255) NULL,
+    latitude DOUBLE PRECISION,  -- Latitude of the station
+    longitude DOUBLE PRECISION  -- Longitude of the station
 );
 """
 
+# Column definitions of the compact rides table
+# Fixed-width columns come first, widest first, so rows carry no alignment padding
+# REAL coordinates are accurate to about a metre, which is plenty for a ride's start and end point
+compact_rides_columns_sql = """
+    started_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    ended_at TIMESTAMP WITHOUT TIME ZONE NULL,
+    start_lat REAL NULL,
+    start_lng REAL NULL,
+    end_lat REAL NULL,
+    end_lng REAL NULL,
+    start_station_key INT NULL,
+    end_station_key INT NULL,
+    trip_duration_seconds INT NULL,
+    trip_distance_meters INT NULL,
+    rideable_type rideable_type_enum NULL,
+    member_casual member_casual_enum NULL,
+    data_source_city data_source_city_enum NOT NULL,
+    gender SMALLINT NULL,
+    birth_year SMALLINT NULL,
+    ride_id VARCHAR(255) NOT NULL,
+    bike_id VARCHAR(255) NULL"""
+
+# Function to build the statement that creates the rides table from its column definitions
+# The monthly partitions (each split by data_source_city) are created by loading_final.py as data arrives.
+# A primary key on a partitioned table has to contain the partition keys, so it is (ride_id, started_at,
+# data_source_city); one row per ride_id is kept by the loads instead, with the help of ride_sources (below)
+def rides_table_sql(columns_sql, partitioned):
+    if partitioned:
+        return f"""
+        CREATE TABLE IF NOT EXISTS rides ({columns_sql},
+            PRIMARY KEY (ride_id, started_at, data_source_city)
+        ) PARTITION BY RANGE (started_at);
+        """
+    return f"""
+    CREATE TABLE IF NOT EXISTS rides ({columns_sql},
+        PRIMARY KEY (ride_id)
+    );
+    """
+
+# SQL statement that adds the columns introduced since an existing rides table was created
+# (rides loaded before then have no trip distance until their month is loaded again)
+add_new_rides_columns_sql = """
+ALTER TABLE rides ADD COLUMN IF NOT EXISTS trip_distance_meters INT NULL;
+"""
+
+# SQL statement to create ride_sources, which a partitioned rides needs alongside it: one row per ride, keyed by
+# ride_id (which the partitioned table can't be), with the month of the file it was loaded from (NULL for files
+# without a month in their name) and its city. Re-ingesting a month uses it to tell the rides of its own files
+# from those other files put in its partitions
+create_ride_sources_table_sql = """
+CREATE TABLE IF NOT EXISTS ride_sources (
+    ride_id VARCHAR(255) PRIMARY KEY,
+    started_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    data_source_city VARCHAR(255) NOT NULL,
+    source_month DATE NULL
+);
+CREATE INDEX IF NOT EXISTS ride_sources_source_month_idx ON ride_sources (source_month, data_source_city);
+"""
+
+# SQL statements to create the rides table with foreign keys for stations, plain or partitioned by month
+create_rides_table_sql = rides_table_sql(rides_columns_sql, partitioned=False)
+create_partitioned_rides_table_sql = rides_table_sql(rides_columns_sql, partitioned=True)
+
 def create_tables():
     try:
         # Connect to the database
@@ -45,8 +140,18 @@ def create_tables():
         cursor = conn.cursor()
         
         # Execute the create table SQL statements
-        cursor.execute(create_stations_table_sql)
-        cursor.execute(create_rides_table_sql)
+        if COMPACT_SCHEMA:
+            cursor.execute(create_enum_types_sql)
+            cursor.execute(create_compact_stations_table_sql)
+            cursor.execute(rides_table_sql(compact_rides_columns_sql, PARTITION_RIDES))
+        else:
+            cursor.execute(create_stations_table_sql)
+            cursor.execute(rides_table_sql(rides_columns_sql, PARTITION_RIDES))
+        cursor.execute(add_new_rides_columns_sql)
+        if PARTITION_RIDES:
+            cursor.execute(create_ride_sources_table_sql)
+        cursor.execute(create_rollup_tables_sql)
+        cursor.execute(create_quarantine_table_sql)
         
         # Commit the changes
         conn.commit()
@@ -59,4 +164,5 @@ def create_tables():
         cursor.close()
         conn.close()
 
-create_tables()
+if __name__ == '__main__':
+    create_tables()
@@ -1,4 +1,5 @@
 import psycopg2
+from rollups_final import drop_rollup_tables_sql
 
 # Database connection setup
 DATABASE_URI = 'YOUR_DATABASE_URI'
@@ -13,6 +14,26 @@ drop_rides_table_sql = """
 DROP TABLE IF EXISTS stations;
 """
 
+# SQL statement to drop the unlogged staging table used by parallel loads
+drop_staging_table_sql = """
+DROP TABLE IF EXISTS rides_staging;
+"""
+
+# SQL statement to drop the table a partitioned rides keeps its ride_ids and their sources in
+drop_ride_sources_table_sql = """
+DROP TABLE IF EXISTS ride_sources;
+"""
+
+# SQL statement to drop the table rows rejected by resilient loads are kept in
+drop_quarantine_table_sql = """
+DROP TABLE IF EXISTS rides_quarantine;
+"""
+
+# SQL statement to drop the enum types of the compact schema
+drop_enum_types_sql = """
+DROP TYPE IF EXISTS rideable_type_enum, member_casual_enum, data_source_city_enum;
+"""
+
 def drop_tables():
     try:
         # Connect to the database
@@ -22,6 +43,11 @@ def drop_tables():
         # Execute the drop table SQL statements
         cursor.execute(drop_stations_table_sql)
         cursor.execute(drop_rides_table_sql)
+        cursor.execute(drop_staging_table_sql)
+        cursor.execute(drop_ride_sources_table_sql)
+        cursor.execute(drop_quarantine_table_sql)
+        cursor.execute(drop_enum_types_sql)
+        cursor.execute(drop_rollup_tables_sql)
         
         # Commit the changes
         conn.commit()
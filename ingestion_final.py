@@ -1,7 +1,7 @@
 from os import makedirs, remove, rmdir
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse, unquote
-from re import findall
+from re import findall, fullmatch
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
@@ -9,34 +9,222 @@ from selenium.webdriver.support import expected_conditions as EC
 from bs4 import BeautifulSoup as bs
 from zipfile import ZipFile
 from pathlib import Path
+from requests.adapters import HTTPAdapter
+from archives_final import city_directory_for, renamed_csv_name, is_redundant_csv
+from manifest_final import (MANIFEST_PATH, DOWNLOADING, DOWNLOADED, EXTRACTED, PREPROCESSED, load_manifest,
+                            update_entry, remote_fingerprint, is_unchanged, file_sha256)
+from metrics_final import stage
 import requests
 import shutil
+import time
 import os
 
+# Download settings
+DOWNLOAD_WORKERS = 5                    # concurrent transfers, and connections kept in the session pool
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024       # bytes read from the socket and written per iteration
+DOWNLOAD_RETRIES = 5                    # retries per file after a dropped connection or server error
+DOWNLOAD_BACKOFF_SECONDS = 2            # first retry delay, doubled on each further retry
+DOWNLOAD_TIMEOUT_SECONDS = 60           # connect/read timeout
+
+# Index page listing every Citibike archive
+TRIPDATA_INDEX_URL = "https://s3.amazonaws.com/tripdata/index.html"
+
+# Extract archives into nyc_data/jersey_city_data; turn off to keep the zips for preprocessing to stream from
+EXTRACT_ZIPS = True
+
 # Function to extract ZIP files into a designated directory based on the filename prefix
 def extract_zip(filename: str, zip_path: str) -> None:
     # Assign directory based on whether the filename indicates Jersey City or NYC data
-    # Files that start with JC contain Jersey City data, otherwise it contains NYC data
-    if filename.startswith("JC"):
-        extract_dir = "./jersey_city_data"
-    else:
-        extract_dir = "./nyc_data"
+    extract_dir = f"./{city_directory_for(filename)}"
 
     # Extract the ZIP file and then delete it to save space
-    with ZipFile(zip_path, 'r') as zf:
+    with stage('extract', file=zip_path) as record, ZipFile(zip_path, 'r') as zf:
+        record['bytes'] = os.path.getsize(zip_path)
         zf.extractall(extract_dir)
     remove(zip_path)
 
+# Function to create a pooled HTTP session shared by all download threads
+def make_session(pool_size: int = DOWNLOAD_WORKERS) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# Function to read the full size of a file from a Content-Range header ('bytes */1234' or 'bytes 0-99/1234')
+def content_range_size(header: str) -> int:
+    match = fullmatch(r'bytes (?:\*|\d+-\d+)/(\d+)', header.strip()) if header else None
+    return int(match.group(1)) if match else None
+
+# Function to download a file, resuming a partial download with an HTTP Range request after a failure
+# Data goes to '<path>.part' and is renamed once complete; returns the transfer metrics for the file
+# With the archive's fingerprint from the manifest, a resumed request carries If-Range, so if the archive has
+# changed since the partial file was started the server sends all of it again instead of the rest of a new version
+def download_file(session: requests.Session, href: str, path: str, chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+                  retries: int = DOWNLOAD_RETRIES, fingerprint: dict = None) -> dict:
+    part_path = f"{path}.part"
+    fingerprint = fingerprint or {}
+    # If-Range only accepts a strong ETag, so a weak one falls back to the Last-Modified date
+    etag = fingerprint.get('etag')
+    validator = etag if etag and not etag.startswith('W/') else fingerprint.get('last_modified')
+    metrics = {'url': href, 'file': path, 'bytes': 0, 'resumed_from': 0, 'attempts': 0,
+               'seconds': 0.0, 'mb_per_second': 0.0, 'error': None}
+    with stage('download', file=path) as record:
+        start = time.perf_counter()
+
+        while True:
+            metrics['attempts'] += 1
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {'Range': f"bytes={offset}-"} if offset else {}
+            if offset and validator:
+                headers['If-Range'] = validator
+            try:
+                with session.get(href, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT_SECONDS) as response:
+                    # Nothing is left to send from the offset; the partial file is only complete if it is exactly
+                    # as long as the archive, otherwise it is discarded and the download starts again
+                    if offset and response.status_code == 416:
+                        size = content_range_size(response.headers.get('Content-Range')) or fingerprint.get('size')
+                        if offset == size:
+                            break
+                        print(f"Discarding {part_path}: it holds {offset:,} bytes, and the archive is "
+                              f"{'of unknown size' if size is None else f'{size:,} bytes'}.")
+                        remove(part_path)
+                        continue
+                    response.raise_for_status()
+
+                    # Servers that ignore the Range header send the whole file again, as do ones whose copy
+                    # no longer matches If-Range
+                    if offset and response.status_code != 206:
+                        offset = 0
+                    if offset:
+                        metrics['resumed_from'] = offset
+                    with open(part_path, "ab" if offset else "wb") as fd:
+                        for chunk in response.iter_content(chunk_size=chunk_size):
+                            fd.write(chunk)
+                            metrics['bytes'] += len(chunk)
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                    requests.HTTPError) as e:
+                retryable = not isinstance(e, requests.HTTPError) or e.response.status_code >= 500
+                if not retryable or metrics['attempts'] > retries:
+                    metrics['error'] = repr(e)
+                    metrics['seconds'] = time.perf_counter() - start
+                    raise
+                print(f"Retrying {href} after error: {e}")
+                time.sleep(DOWNLOAD_BACKOFF_SECONDS * 2 ** (metrics['attempts'] - 1))
+
+        os.replace(part_path, path)
+        metrics['seconds'] = time.perf_counter() - start
+        metrics['mb_per_second'] = metrics['bytes'] / 1024 ** 2 / metrics['seconds'] if metrics['seconds'] else 0.0
+        record.update(bytes=metrics['bytes'], attempts=metrics['attempts'], resumed_from=metrics['resumed_from'])
+    return metrics
+
 # Function to download ZIP files from a given URL and then call extract_zip
-def download_and_extract(href: str, fname: str) -> None:
-    response = requests.get(href, stream=True)
+# With EXTRACT_ZIPS off the archive is kept as downloaded, for preprocessing to read directly
+def download_and_extract(href: str, fname: str, session: requests.Session = None) -> dict:
     zip_path = f"./zips/{fname}.zip"
-    
+
     # Save the ZIP file and then extract its contents
-    with open(zip_path, "wb") as fd:
-        for chunk in response.iter_content(chunk_size=128):
-            fd.write(chunk)
-    extract_zip(fname, zip_path)
+    metrics = download_file(session or make_session(1), href, zip_path)
+    if EXTRACT_ZIPS:
+        extract_zip(fname, zip_path)
+    return metrics
+
+# Function to bring one archive up to date against the manifest
+# New or changed archives are downloaded (and extracted); unchanged ones are skipped, and a run that
+# crashed part way picks up where it stopped. Returns the download metrics, or None if nothing was fetched
+def sync_archive(href: str, fname: str, session: requests.Session, manifest: dict) -> dict:
+    zip_path = f"./zips/{fname}.zip"
+    fingerprint = remote_fingerprint(session, href)
+    entry = manifest.get(href)
+
+    if is_unchanged(entry, fingerprint):
+        state = entry.get('state')
+        if state in (EXTRACTED, PREPROCESSED):
+            return None
+        # Downloaded before a crash: keep the zip if it is intact
+        if state == DOWNLOADED and os.path.exists(zip_path) and file_sha256(zip_path) == entry.get('sha256'):
+            if EXTRACT_ZIPS:
+                extract_zip(fname, zip_path)
+                update_entry(manifest, href, MANIFEST_PATH, state=EXTRACTED)
+            return None
+    elif os.path.exists(f"{zip_path}.part"):
+        # A partial download of an older version can't be resumed
+        remove(f"{zip_path}.part")
+
+    update_entry(manifest, href, MANIFEST_PATH, fname=fname, state=DOWNLOADING, **fingerprint)
+    metrics = download_file(session, href, zip_path, fingerprint=fingerprint)
+    update_entry(manifest, href, MANIFEST_PATH, state=DOWNLOADED, sha256=file_sha256(zip_path))
+    if EXTRACT_ZIPS:
+        extract_zip(fname, zip_path)
+        update_entry(manifest, href, MANIFEST_PATH, state=EXTRACTED)
+    return metrics
+
+# Function to download and extract a list of (fname, href) pairs over a shared session
+# At most `workers` transfers run at once; with a manifest, only new or changed archives are fetched
+# Returns the metrics of every file fetched, failed ones included
+def download_all(filenames: list, workers: int = DOWNLOAD_WORKERS, manifest: dict = None) -> list:
+    session = make_session(workers)
+    results = []
+    up_to_date = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if manifest is None:
+            futures = {executor.submit(download_and_extract, href, fname, session): (fname, href)
+                       for fname, href in filenames}
+        else:
+            futures = {executor.submit(sync_archive, href, fname, session, manifest): (fname, href)
+                       for fname, href in filenames}
+        for future in as_completed(futures):
+            fname, href = futures[future]
+            try:
+                metrics = future.result()
+                if metrics is None:
+                    up_to_date += 1
+                else:
+                    results.append(metrics)
+            except Exception as e:
+                results.append({'url': href, 'file': f"./zips/{fname}.zip", 'error': repr(e)})
+                print(f"Failed to download {fname}: {e}")
+    session.close()
+    failed = sum(1 for metrics in results if metrics['error'])
+    print(f"{len(results) - failed} archives fetched, {failed} failed, {up_to_date} already up to date.")
+    return results
+
+# Function to print per-file throughput and retry metrics of a download run
+def print_download_summary(results: list) -> None:
+    print(f"{'file':<45} {'MB':>9} {'seconds':>9} {'MB/s':>8} {'attempts':>9} {'resumed at':>12}")
+    for metrics in sorted(results, key=lambda metrics: metrics['file']):
+        name = Path(metrics['file']).name
+        if metrics['error']:
+            print(f"{name:<45} FAILED: {metrics['error']}")
+        else:
+            print(f"{name:<45} {metrics['bytes'] / 1024 ** 2:>9.1f} {metrics['seconds']:>9.1f} "
+                  f"{metrics['mb_per_second']:>8.1f} {metrics['attempts']:>9} {metrics['resumed_from']:>12,}")
+
+# Function to list the ZIP files on the Citibike index page as (fname, href) pairs
+# The page builds its links with JavaScript, so it is rendered in a headless browser
+def list_remote_archives(url: str = TRIPDATA_INDEX_URL) -> list:
+    # Web scraping setup to download Citibike data ZIP files
+    options = webdriver.ChromeOptions()
+    options.add_argument("--headless")
+    options.add_argument("--disable-gpu")
+
+    driver = webdriver.Chrome(options=options)
+    try:
+        driver.get(url)
+        WebDriverWait(driver, 10).until(EC.presence_of_all_elements_located((By.TAG_NAME, 'a')))
+
+        filenames = []
+        for anchor in bs(driver.page_source, "lxml").find_all("a", href=True):
+            href: str = anchor['href']
+            if href.endswith(".zip"):
+                path = urlparse(href).path
+                fname = unquote(path.split('/')[-1])
+                fname = fname[:-4]
+                filenames.append((fname, href))
+    finally:
+        driver.quit()
+    return filenames
 
 # Function to remove duplicates and move files from nested directories to a base directory
 def remove_duplicates_and_move(base_directory: str):
@@ -70,61 +258,18 @@ def remove_duplicates_and_move(base_directory: str):
 def rename_files(base_directory: str):
     base_path = Path(base_directory)
     for file_path in base_path.glob('*.csv'):
-        filename = file_path.stem
-        extension = file_path.suffix
-
-        # Rename old NYC data files to include '_old' suffix for easy identification
-        if base_directory.endswith("nyc_data"):
-            try:
-                file_date = int(filename[:6])
-                if file_date < 202102:
-                    new_filename = f"{filename}_old{extension}"
-                    file_path.rename(base_path / new_filename)
-            except ValueError:
-                pass
-
-        # Similar renaming logic for Jersey City data
-        elif base_directory.endswith("jersey_city_data"):
-            try:
-                start_index = filename.find('JC-') + 3
-                file_date_str = filename[start_index:start_index+6]
-                file_date = int(file_date_str)
-                
-                date_valid = True
-            except ValueError:
-                date_valid = False
-            
-            if not date_valid:
-                try:
-                    parts = filename.split("-")
-                    file_date = int(parts[1])
-                except (ValueError, IndexError):
-                    file_date = None
-
-            if file_date and file_date < 202102:
-                new_filename = f"{filename}_old{extension}"
-                file_path.rename(base_path / new_filename)
+        new_filename = renamed_csv_name(file_path.name, base_directory)
+        if new_filename != file_path.name:
+            file_path.rename(base_path / new_filename)
 
 # Function to perform additional file clean-up based on naming conventions
 def clean_up_files(base_directory: str):
     base_path = Path(base_directory)
 
-    # Gather all csv files in the directory
-    csv_files = list(base_path.glob('*.csv'))
-
-    # Filter and delete specific files
-    for file_path in csv_files:
-        # Extract year and check if it's 2013 or 2018
-        year = file_path.stem[:4]
-        if year in ['2013', '2018']:
-            # If file ends with '1_old', '2_old', or '3_old', delete it
-            if any(file_path.stem.endswith(f"{i}_old") for i in range(1, 4)):
-                print(f"Deleting {file_path.name} based on year and suffix condition.")
-                file_path.unlink()
-
-        # Additionally, delete any file ending with '_old_old.csv'
-        if '_old_old' in file_path.stem:
-            print(f"Deleting {file_path.name} for ending with '_old_old'.")
+    # Gather all csv files in the directory and delete the ones whose data is captured in another file
+    for file_path in list(base_path.glob('*.csv')):
+        if is_redundant_csv(file_path.name):
+            print(f"Deleting {file_path.name}, its data is captured in another file.")
             file_path.unlink()
 
 if __name__ == '__main__':
@@ -136,48 +281,32 @@ if __name__ == '__main__':
     nyc_data_directory = 'nyc_data'
     jersey_city_directory = 'jersey_city_data'
 
-    # Web scraping setup to download Citibike data ZIP files
-    options = webdriver.ChromeOptions()
-    options.add_argument("--headless")
-    options.add_argument("--disable-gpu")
-    
-    driver = webdriver.Chrome(options=options)
-    driver.get("https://s3.amazonaws.com/tripdata/index.html")
-
     # Attempt to download and process all listed ZIP files
     try:
-        WebDriverWait(driver, 10).until(EC.presence_of_all_elements_located((By.TAG_NAME, 'a')))
-        
-        filenames = []
-        for anchor in bs(driver.page_source, "lxml").find_all("a", href=True):
-            href: str = anchor['href']
-            if href.endswith(".zip"):
-                path = urlparse(href).path
-                fname = unquote(path.split('/')[-1])
-                fname = fname[:-4] 
-                filenames.append((fname, href))
+        filenames = list_remote_archives()
 
         print("Files to be downloaded:")
         for fname, _ in filenames:
             print(fname)
         
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            for fname, href in filenames:
-                executor.submit(download_and_extract, href, fname)
+        results = download_all(filenames, manifest=load_manifest(MANIFEST_PATH))
+        print_download_summary(results)
 
     except Exception as e:
         print("Error occurred:", e)
     finally:
-        driver.quit()
         if not os.listdir("zips"):
             rmdir("zips")
 
     # Remove duplicates, rename files, and clean up as necessary
-    remove_duplicates_and_move(nyc_data_directory)
-    rename_files(nyc_data_directory)
+    # When the zips are kept, preprocessing applies the same rules while reading them
+    if EXTRACT_ZIPS:
+        with stage('clean_up'):
+            remove_duplicates_and_move(nyc_data_directory)
+            rename_files(nyc_data_directory)
 
-    remove_duplicates_and_move(jersey_city_directory)
-    rename_files(jersey_city_directory)
+            remove_duplicates_and_move(jersey_city_directory)
+            rename_files(jersey_city_directory)
 
-    clean_up_files(nyc_data_directory)
-    clean_up_files(jersey_city_directory)
\ No newline at end of file
+            clean_up_files(nyc_data_directory)
+            clean_up_files(jersey_city_directory)
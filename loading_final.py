@@ -1,136 +1,769 @@
+import io
 import os
+import csv
+import queue
+import re
+import time
+from datetime import date
 import psycopg2
+from concurrent.futures import ThreadPoolExecutor
+from rollups_final import record_pending_months_sql, refresh_rollups
+from binarycopy_final import binary_copy_chunks
+from spatial_final import load_station_index
+from quarantine_final import ResilientCopy, create_quarantine_table_sql
+from createTables_final import create_ride_sources_table_sql
+from metrics_final import MetricsConnection, stage
 
 # Database connection setup
 DATABASE_URI = "host='HOSTNAME' dbname='DATABASENAME' user='USERNAME' password='YOUR_PASSWORD'"
-conn = psycopg2.connect(DATABASE_URI)
-cursor = conn.cursor()
 
 base_dir = 'YOUR_BASE_DIR'
 preprocessed_csv_dir = os.path.join(base_dir, 'preprocessed_for_copy')
 
-# Function to insert unique station data into the 'stations' table.
-# It selects distinct station information from the 'rides' table to avoid duplicates.
-def deduplicate_and_load_stations():
-    print("Deduplicating and loading stations...")
-    # Extract unique station information from rides table and load into stations table
-    cursor.execute("""
+# Bytes handed to COPY per read
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Worker connections used to COPY files concurrently (1 loads files one after another into rides)
+LOAD_WORKERS = 1
+
+# Load rows one batch at a time in savepoints, so rows that fail validation or COPY are moved to rides_quarantine
+# (with the reason) instead of failing their whole file
+RESILIENT_LOAD = False
+
+# Rides with coordinates but no station id (dockless e-bike rides) are given the nearest station within this
+# many metres once the stations are loaded (None leaves them without a station)
+SNAP_RADIUS_METERS = 100
+
+# Columns of the preprocessed ride CSVs, in file order
+rides_columns = ['ride_id', 'rideable_type', 'started_at', 'ended_at', 'start_station_name', 'start_station_id',
+                 'end_station_name', 'end_station_id', 'start_lat', 'start_lng', 'end_lat', 'end_lng', 'member_casual',
+                 'trip_duration_seconds', 'trip_distance_meters', 'bike_id', 'gender', 'birth_year',
+                 'data_source_city']
+rides_copy_columns = ", ".join(rides_columns)
+
+# Column definitions matching the preprocessed ride CSVs, for the tables they are COPYed into
+rides_csv_columns_sql = """
+    ride_id VARCHAR(255) NOT NULL,
+    rideable_type VARCHAR(255),
+    started_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    ended_at TIMESTAMP WITHOUT TIME ZONE,
+    start_station_id VARCHAR(255),
+    end_station_id VARCHAR(255),
+    start_station_name VARCHAR(255),
+    end_station_name VARCHAR(255),
+    start_lat DECIMAL(9, 6),
+    start_lng DECIMAL(9, 6),
+    end_lat DECIMAL(9, 6),
+    end_lng DECIMAL(9, 6),
+    member_casual VARCHAR(50),
+    trip_duration_seconds INT,
+    trip_distance_meters INT,
+    bike_id VARCHAR(255),
+    gender INT,
+    birth_year INT,
+    data_source_city VARCHAR(255) NOT NULL"""
+
+# Per-session temporary table each file is COPYed into before being merged into 'rides'
+create_load_table_sql = f"""
+CREATE TEMP TABLE IF NOT EXISTS rides_load ({rides_csv_columns_sql}
+) ON COMMIT DELETE ROWS;
+"""
+
+# Unlogged staging table that parallel workers COPY into before rows are merged into 'rides'
+# It skips WAL writes, so it is cheap to fill but is emptied if the server crashes
+create_staging_table_sql = f"""
+CREATE UNLOGGED TABLE IF NOT EXISTS rides_staging ({rides_csv_columns_sql}
+);
+"""
+
+# Columns of 'rides' in the compact schema (see createTables_final.py), in table order
+compact_rides_columns = ['started_at', 'ended_at', 'start_lat', 'start_lng', 'end_lat', 'end_lng', 'start_station_key',
+                         'end_station_key', 'trip_duration_seconds', 'trip_distance_meters', 'rideable_type',
+                         'member_casual', 'data_source_city', 'gender', 'birth_year', 'ride_id', 'bike_id']
+
+# How the compact columns that differ from the CSV are computed from a loaded ride ('r'),
+# with its start and end stations joined as 's' and 'e'
+compact_column_expressions = {
+    'start_station_key': 's.station_key',
+    'end_station_key': 'e.station_key',
+    'rideable_type': 'r.rideable_type::rideable_type_enum',
+    'member_casual': 'r.member_casual::member_casual_enum',
+    'data_source_city': 'r.data_source_city::data_source_city_enum',
+}
+
+# Function to build the COPY statement for preprocessed ride CSVs (header row included)
+# copy_format 'binary' takes the rows in Postgres' binary COPY format instead (see binarycopy_final.py),
+# which spares the server from parsing every timestamp, number and integer from text
+def copy_sql(table, copy_format='csv'):
+    if copy_format == 'binary':
+        return f"""
+        COPY {table}({rides_copy_columns})
+        FROM STDIN WITH (FORMAT binary)
+        """
+    return f"""
+    COPY {table}({rides_copy_columns})
+    FROM STDIN WITH CSV HEADER NULL 'NULL'
+    """
+
+# Primary key of 'rides' when it is partitioned (see createTables_final.py)
+# It can't be ride_id alone, so load_month keeps one row per ride_id itself, through ride_sources
+partitioned_key_columns = 'ride_id, started_at, data_source_city'
+
+# Matches the year and month in a ride CSV's file name, e.g. '201307-citibike-tripdata.csv' or 'JC-202102-...'
+file_month_pattern = re.compile(r'(20\d{2})-?(0[1-9]|1[0-2])')
+
+# Function to build the query that turns the rows of a load table into rides, one per ride_id
+# (the earliest by started_at). Returns the columns of 'rides' it fills and the query
+def select_rides_sql(source_table, compact=False, where='TRUE'):
+    if not compact:
+        return rides_columns, f"""
+        SELECT DISTINCT ON (ride_id) {rides_copy_columns}
+        FROM {source_table}
+        WHERE {where}
+        ORDER BY ride_id, started_at"""
+
+    expressions = [compact_column_expressions.get(column, f"r.{column}") for column in compact_rides_columns]
+    return compact_rides_columns, f"""
+        SELECT DISTINCT ON (r.ride_id) {", ".join(expressions)}
+        FROM {source_table} r
+        LEFT JOIN stations s ON s.station_id = r.start_station_id
+        LEFT JOIN stations e ON e.station_id = r.end_station_id
+        WHERE {where}
+        ORDER BY r.ride_id, r.started_at"""
+
+# Function to build the statement that merges a loaded batch into 'rides' without duplicates
+# Only the earliest ride (by started_at) of each ride_id is kept, both within the batch and against
+# rides loaded earlier, so the primary key can exist from the first load
+# With the partitioned key, a conflict is the same ride at the same start time, which the new row replaces
+# (load_month has already dropped the rides that an earlier ride_id beats, on either side)
+def merge_rides_sql(source_table, key_columns='ride_id', compact=False):
+    columns, select_sql = select_rides_sql(source_table, compact)
+    update_columns = [column for column in columns if column not in key_columns.split(', ')]
+    earliest_wins = "WHERE EXCLUDED.started_at < rides.started_at" if key_columns == 'ride_id' else ""
+    return f"""
+    INSERT INTO rides({", ".join(columns)})
+    {select_sql}
+    ON CONFLICT ({key_columns}) DO UPDATE
+    SET ({", ".join(update_columns)}) = ({", ".join(f"EXCLUDED.{column}" for column in update_columns)})
+    {earliest_wins};
+    """
+
+# Function to build the statement that inserts the unique stations found in a table of rides
+def load_stations_sql(rides_table):
+    return f"""
         INSERT INTO stations (station_id, station_name, latitude, longitude)
-        SELECT DISTINCT start_station_id, start_station_name, start_lat, start_lng FROM rides
+        SELECT DISTINCT start_station_id, start_station_name, start_lat, start_lng FROM {rides_table}
         WHERE start_station_id IS NOT NULL AND start_station_name IS NOT NULL
         UNION
-        SELECT DISTINCT end_station_id, end_station_name, end_lat, end_lng FROM rides
+        SELECT DISTINCT end_station_id, end_station_name, end_lat, end_lng FROM {rides_table}
         WHERE end_station_id IS NOT NULL AND end_station_name IS NOT NULL
         ON CONFLICT (station_id) DO NOTHING;
-    """)
-    conn.commit()
+    """
 
-# Removes duplicate rides based on the 'ride_id' column.
-# Additionally, it sets 'ride_id' as the primary key and drops the old 'id' column.
-def remove_ride_duplicates_and_set_primary_key():
-    print("Removing duplicates based on ride_id...")
-    # Remove duplicate ride_ids while keeping the earliest ride based on started_at
-    cursor.execute("""
-    WITH ranked_rides AS (
-        SELECT
-            id,  -- Assuming 'id' is the unique identifier for each row in the 'rides' table
-            ROW_NUMBER() OVER (PARTITION BY ride_id ORDER BY started_at) AS rn
-        FROM
-            rides
-    )
-    DELETE FROM
-        rides
-    WHERE
-        id IN (SELECT id FROM ranked_rides WHERE rn > 1);
-    """)
-    conn.commit()
-    
-    print("Dropping existing primary key constraint, if any...")
-    cursor.execute("ALTER TABLE rides DROP CONSTRAINT IF EXISTS rides_pkey;")
-    conn.commit()
+# Function to build the statement that adds the stations of a load table that 'stations' doesn't have yet
+# Used by the compact schema, where each new station gets its integer station_key before rides refer to it
+def add_station_keys_sql(source_table):
+    return f"""
+        INSERT INTO stations (station_id, station_name, latitude, longitude)
+        SELECT DISTINCT ON (station_id) station_id, station_name, latitude, longitude
+        FROM (
+            SELECT start_station_id, start_station_name, start_lat, start_lng FROM {source_table}
+            UNION ALL
+            SELECT end_station_id, end_station_name, end_lat, end_lng FROM {source_table}
+        ) AS seen (station_id, station_name, latitude, longitude)
+        WHERE station_id IS NOT NULL AND station_id NOT IN ('nan', '')
+          AND NOT EXISTS (SELECT 1 FROM stations WHERE stations.station_id = seen.station_id)
+        ORDER BY station_id, station_name NULLS LAST
+        ON CONFLICT (station_id) DO NOTHING;
+    """
 
-    print("Setting ride_id as primary key...")
-    # Now that duplicates are removed and any existing primary key constraint is dropped, set ride_id as the new primary key
-    cursor.execute("""
-    ALTER TABLE rides
-    ADD CONSTRAINT rides_pkey PRIMARY KEY (ride_id);
-    """)
-    conn.commit()
+# Function to get a load table ready to be merged into 'rides', in the same transaction as the merge
+# The months it touches are marked for the next rollup refresh, and 'stations' gets the stations it refers to,
+# so the foreign keys left by an earlier finish_loading hold for the new rides: the compact schema gives new
+# stations their keys, and the plain one first sets 'nan' and blank station ids to NULL, as finish_loading does
+def prepare_load_table(cursor, source_table, compact=False):
+    cursor.execute(record_pending_months_sql(source_table))
+    if compact:
+        cursor.execute(add_station_keys_sql(source_table))
+        return
+    cursor.execute(f"UPDATE {source_table} SET start_station_id = NULL WHERE start_station_id IN ('nan', '');")
+    cursor.execute(f"UPDATE {source_table} SET end_station_id = NULL WHERE end_station_id IN ('nan', '');")
+    cursor.execute(load_stations_sql(source_table))
 
-    print("Dropping the id column...")
-    cursor.execute("ALTER TABLE rides DROP COLUMN id;")
-    conn.commit()
+# Function to build the statement that records the months of the rides a merge is about to replace
+# An earlier started_at for a ride_id moves the ride, possibly to another month, so the months it leaves
+# (started and ended in) need their rollups refreshed as well as the load table's own
+def record_replaced_months_sql(source_table):
+    return f"""
+        WITH replaced AS (
+            SELECT r.started_at, r.ended_at FROM rides r
+            JOIN {source_table} s ON s.ride_id = r.ride_id AND s.started_at < r.started_at
+        )
+        {record_pending_months_sql('replaced')}
+    """
 
-    print("Operation completed successfully.")
+# Merges a load table into 'rides', once it is prepared as above
+def merge_into_rides(cursor, source_table, key_columns='ride_id', compact=False):
+    prepare_load_table(cursor, source_table, compact)
+    if key_columns == 'ride_id':
+        cursor.execute(record_replaced_months_sql(source_table))
+    cursor.execute(merge_rides_sql(source_table, key_columns, compact))
+    return cursor.rowcount
 
-# Adding foreign key constraints to the 'rides' table
-def add_foreign_key_constraints():
+# Function to insert unique station data into the 'stations' table.
+# It selects distinct station information from the 'rides' table to avoid duplicates.
+def deduplicate_and_load_stations(conn):
+    cursor = conn.cursor()
+    print("Deduplicating and loading stations...")
+    with stage('station_load') as record:
+        # Extract unique station information from rides table and load into stations table
+        cursor.execute(load_stations_sql('rides'))
+        record['rows'] = cursor.rowcount
+        conn.commit()
+
+# Function to build the query for the rides of a month that have coordinates but no station at one end
+def unsnapped_rides_sql(end, compact):
+    if compact:
+        missing = f"{end}_station_key IS NULL"
+    else:
+        missing = f"({end}_station_id IS NULL OR {end}_station_id IN ('nan', ''))"
+    return f"""
+        SELECT ride_id, started_at, {end}_lat::float8, {end}_lng::float8 FROM rides
+        WHERE started_at >= %(start)s AND started_at < %(end)s AND {missing}
+          AND {end}_lat IS NOT NULL AND {end}_lng IS NOT NULL;
+    """
+
+# Gives rides that have coordinates but no station id the nearest station within max_meters
+# Only the months of this load (those waiting for a rollup refresh) are looked at, and the nearest stations are
+# found with the in-memory station index rather than by comparing every ride with every station in SQL.
+# The ride keeps its own coordinates and station name (blank for dockless rides), so snapped rides can still be
+# told apart; the station id is what the foreign keys and the rollups use
+def snap_rides_to_stations(conn, compact=False, max_meters=SNAP_RADIUS_METERS):
+    if max_meters is None:
+        return 0
+    with stage('station_snap') as record, conn.cursor() as cursor:
+        index = load_station_index(conn)
+        cursor.execute("SELECT month FROM rollup_pending_months ORDER BY month;")
+        months = [month for (month,) in cursor.fetchall()]
+        station_column = 'station_key' if compact else 'station_id'
+        snapped = 0
+        for month in months:
+            params = {'start': month, 'end': next_month(month)}
+            for end in ('start', 'end'):
+                cursor.execute(unsnapped_rides_sql(end, compact), params)
+                rides = cursor.fetchall()
+                if not rides:
+                    continue
+                nearest, _ = index.nearest([ride[2] for ride in rides], [ride[3] for ride in rides], max_meters)
+                stations = index.stations[station_column].to_numpy()
+
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                for ride, station in zip(rides, nearest.tolist()):
+                    if station >= 0:
+                        writer.writerow([ride[0], ride[1], stations[station]])
+                buffer.seek(0)
+                cursor.execute("""
+                    CREATE TEMP TABLE IF NOT EXISTS snapped_rides (ride_id VARCHAR(255), started_at TIMESTAMP,
+                                                                  station TEXT) ON COMMIT DELETE ROWS;
+                """)
+                cursor.copy_expert("COPY snapped_rides FROM STDIN WITH CSV", buffer)
+                cursor.execute(f"""
+                    UPDATE rides r SET {end}_{station_column} = s.station::{'int' if compact else 'varchar'}
+                    FROM snapped_rides s
+                    WHERE r.ride_id = s.ride_id AND r.started_at = s.started_at
+                      AND r.started_at >= %(start)s AND r.started_at < %(end)s;
+                """, params)
+                snapped += cursor.rowcount
+                print(f"Snapped {cursor.rowcount:,} of {len(rides):,} ride {end}s in {month:%Y-%m} without a station "
+                      f"to a station within {max_meters}m.")
+                conn.commit()
+        record['rows'] = snapped
+    return snapped
+
+# Setting 'nan' station IDs in the 'rides' table to NULL
+# Blank ids (new format rides that didn't start or end at a dock) are set to NULL the same way
+def null_nan_station_ids(conn):
+    cursor = conn.cursor()
     print("Setting 'nan' station IDs to NULL...")
     # Set 'nan' station IDs to NULL for start_station_id
     cursor.execute("""
         UPDATE rides
         SET start_station_id = NULL
-        WHERE start_station_id = 'nan';
+        WHERE start_station_id IN ('nan', '');
     """)
     
     # Set 'nan' station IDs to NULL for end_station_id
     cursor.execute("""
         UPDATE rides
         SET end_station_id = NULL
-        WHERE end_station_id = 'nan';
+        WHERE end_station_id IN ('nan', '');
     """)
     conn.commit()
     print("'nan' station IDs set to NULL successfully.")
 
-    print("Adding foreign key constraints...")
-    # Add foreign key constraint for start_station_id
+# Adding foreign key constraints to the 'rides' table
+def add_foreign_key_constraints(conn):
+    with stage('foreign_keys'):
+        cursor = conn.cursor()
+        # The compact schema refers to stations by key, and its loads already leave out 'nan' and blank ids
+        if rides_is_compact(conn):
+            key_column = 'station_key'
+        else:
+            key_column = 'station_id'
+            null_nan_station_ids(conn)
+
+        print("Adding foreign key constraints...")
+        # NOT VALID only checks new rows, so adding the constraints takes a brief lock; the loaded rows are then
+        # checked by VALIDATE CONSTRAINT, which lets reads and writes on rides carry on
+        # (Postgres doesn't accept NOT VALID foreign keys on a partitioned table, so those are checked straight away)
+        not_valid = "" if rides_is_partitioned(conn) else " NOT VALID"
+        # Constraints left by an earlier run (e.g. the orchestrator loading new months) are kept as they are
+        cursor.execute("SELECT conname FROM pg_constraint WHERE conrelid = 'rides'::regclass;")
+        existing = {name for (name,) in cursor.fetchall()}
+        constraints = [('fk_start_station', f'start_{key_column}'), ('fk_end_station', f'end_{key_column}')]
+        constraints = [(constraint, column) for constraint, column in constraints if constraint not in existing]
+        for constraint, column in constraints:
+            start = time.perf_counter()
+            cursor.execute(f"""
+                ALTER TABLE rides
+                ADD CONSTRAINT {constraint}
+                FOREIGN KEY ({column})
+                REFERENCES stations({key_column})
+                ON DELETE SET NULL{not_valid};
+            """)
+            conn.commit()
+            print(f"Added {constraint} in {time.perf_counter() - start:.1f}s.")
+
+        if not_valid:
+            for constraint, _ in constraints:
+                start = time.perf_counter()
+                cursor.execute(f"ALTER TABLE rides VALIDATE CONSTRAINT {constraint};")
+                conn.commit()
+                print(f"Validated {constraint} in {time.perf_counter() - start:.1f}s.")
+        print("Foreign key constraints added successfully.")
+
+
+# File-like object that feeds COPY from an iterator of chunks, so nothing lands on disk
+# Chunks are CSV text, or bytes that are already encoded (binary COPY)
+class CopyChunkStream:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = io.BytesIO()
+
+    def read(self, size=-1):
+        data = self.buffer.read(size)
+        while not data:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return b''
+            self.buffer = io.BytesIO(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+            data = self.buffer.read(size)
+        return data
+
+# Loads ride data from CSV files into the 'rides' table
+def load_rides(conn, filepath, resilient=RESILIENT_LOAD):
+    print("Loading rides...")
+    with stage('load', file=filepath) as record, open(filepath, 'r') as f:
+        record['bytes'] = os.path.getsize(filepath)
+        record['rows'] = load_rides_stream(conn, f, resilient=resilient, source=os.path.basename(filepath))
+
+# COPYs a file object or an iterator of CSV text chunks (starting with the header row) into a table
+# With copy_format 'binary', chunks is an iterator of transformed DataFrames (from transform_rides) instead,
+# which are encoded as binary COPY on the way
+# With resilient, rows COPY refuses are quarantined (see quarantine_final.py) under the name of their source
+# Returns the number of rows copied
+def copy_rides_into(cursor, table, chunks, copy_format='csv', resilient=False, source=None):
+    if resilient:
+        copier = ResilientCopy(cursor, table, copy_sql(table, copy_format), source, copy_format, COPY_BUFFER_SIZE)
+        return copier.copy(chunks)
+    # COPY skips the header row and loads the data directly
+    if copy_format == 'binary':
+        stream = CopyChunkStream(binary_copy_chunks(chunks))
+    else:
+        stream = chunks if hasattr(chunks, 'read') else CopyChunkStream(chunks)
+    cursor.copy_expert(sql=copy_sql(table, copy_format), file=stream, size=COPY_BUFFER_SIZE)
+    return cursor.rowcount
+
+# Loads ride data from a file object or an iterator of CSV text chunks (starting with the header row),
+# or from an iterator of transformed DataFrames with copy_format 'binary'
+# The rows are COPYed into a temporary table and merged into 'rides', dropping duplicate ride_ids
+# Returns the number of rows copied
+def load_rides_stream(conn, chunks, copy_format='csv', resilient=RESILIENT_LOAD, source=None):
+    with conn.cursor() as cursor:
+        cursor.execute(create_load_table_sql)
+        rows = copy_rides_into(cursor, 'rides_load', chunks, copy_format, resilient, source)
+        merge_into_rides(cursor, 'rides_load', compact=rides_is_compact(conn))
+    conn.commit()
+    return rows
+
+# Checks whether 'rides' was created partitioned by month
+def rides_is_partitioned(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = 'rides'::regclass;")
+        return cursor.fetchone()[0]
+
+# Checks whether 'rides' was created with the compact schema (integer station keys)
+def rides_is_compact(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM pg_attribute WHERE attrelid = 'rides'::regclass AND attname = 'start_station_key'
+            );
+        """)
+        return cursor.fetchone()[0]
+
+# Works out the month a ride CSV holds from its file name, or None if the name has no month in it
+def file_month(filename):
+    match = file_month_pattern.search(os.path.basename(filename))
+    return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+# Names of the monthly partition of 'rides' and of its leaf partition for one city
+def month_partition_name(month):
+    return f"rides_y{month.year}m{month.month:02d}"
+
+def city_partition_name(month, city):
+    return f"{month_partition_name(month)}_{re.sub(r'[^a-z0-9]+', '_', city.lower())}"
+
+# First day of the month after `month`, the exclusive upper bound of its partition
+def next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+# Creates the partition of a month (split by city) and its leaf partition for one city if they don't exist
+def create_month_partition(cursor, month, city):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {month_partition_name(month)} PARTITION OF rides
+        FOR VALUES FROM ('{month}') TO ('{next_month(month)}') PARTITION BY LIST (data_source_city);
+    """)
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {city_partition_name(month, city)} PARTITION OF {month_partition_name(month)}
+        FOR VALUES IN (%s);
+    """, (city,))
+
+# Builds the statements that recreate the primary key and indexes of 'rides' on another table
+# Building them on a new partition before it is attached means ATTACH only has to link them to the parent's
+def partition_index_sql(cursor, table):
     cursor.execute("""
-        ALTER TABLE rides
-        ADD CONSTRAINT fk_start_station
-        FOREIGN KEY (start_station_id) 
-        REFERENCES stations(station_id)
-        ON DELETE SET NULL;
+        SELECT pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = 'rides'::regclass AND contype = 'p';
     """)
-    
-    # Add foreign key constraint for end_station_id
+    statements = [f"ALTER TABLE {table} ADD {definition};" for (definition,) in cursor.fetchall()]
     cursor.execute("""
-        ALTER TABLE rides
-        ADD CONSTRAINT fk_end_station
-        FOREIGN KEY (end_station_id) 
-        REFERENCES stations(station_id)
-        ON DELETE SET NULL;
+        SELECT pg_get_indexdef(indexrelid) FROM pg_index WHERE indrelid = 'rides'::regclass AND NOT indisprimary;
     """)
-    conn.commit()
-    print("Foreign key constraints added successfully.")
+    for (definition,) in cursor.fetchall():
+        statements.append(re.sub(r'INDEX \S+ ON (ONLY )?\S+ ', f'INDEX ON {table} ', definition, count=1) + ';')
+    return statements
 
+# Replaces the rides of one city and month with the ones in a loaded table (prepared by prepare_load_table),
+# keeping the rides other files put there
+# The rows go into a new table that is indexed and then swapped in for the old partition with DETACH/ATTACH,
+# so re-ingesting a month never runs a mass DELETE against the rest of the data
+def swap_in_month_partition(cursor, month, city, source_table, compact=False):
+    partition = city_partition_name(month, city)
+    new_partition = f"{partition}_new"
+    in_partition = (f"started_at >= '{month}' AND started_at < '{next_month(month)}' "
+                    f"AND data_source_city IS NOT NULL AND data_source_city = %(city)s")
 
-# Loads ride data from CSV files into the 'rides' table
-def load_rides(filepath):
-    print("Loading rides...")
-    with open(filepath, 'r') as f:
-        # Skip the header row and use COPY to load data directly
-        next(f)
-        cursor.copy_expert(sql=f"""
-        COPY rides(ride_id, rideable_type, started_at, ended_at, start_station_name, start_station_id, 
-                   end_station_name, end_station_id, start_lat, start_lng, end_lat, end_lng, member_casual, 
-                   trip_duration_seconds, bike_id, gender, birth_year, data_source_city)
-        FROM STDIN WITH CSV HEADER NULL 'NULL'
-        """, file=f)
+    cursor.execute(f"DROP TABLE IF EXISTS {new_partition};")
+    cursor.execute(f"CREATE TABLE {new_partition} (LIKE rides INCLUDING DEFAULTS);")
+    columns, select_sql = select_rides_sql(source_table, compact, where=in_partition)
+    cursor.execute(f"INSERT INTO {new_partition}({', '.join(columns)}) {select_sql};", {'city': city})
+    rows = cursor.rowcount
+
+    # Rides that other files put in this partition (a ride in the file of the month before that started before
+    # midnight, or one in a file without a month) are carried over from the old partition. Their ride_sources rows
+    # say so; keep_earliest_rides has already removed the ones the loaded rows replace
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (partition,))
+    if cursor.fetchone()[0]:
+        cursor.execute(f"""
+            INSERT INTO {new_partition}({', '.join(columns)})
+            SELECT {', '.join(f"p.{column}" for column in columns)} FROM {partition} p
+            JOIN ride_sources s ON s.ride_id = p.ride_id AND s.started_at = p.started_at
+            WHERE s.source_month IS DISTINCT FROM %(month)s;
+        """, {'month': month})
+        rows += cursor.rowcount
+
+    for statement in partition_index_sql(cursor, new_partition):
+        cursor.execute(statement)
+    # With a CHECK constraint matching the partition bounds, ATTACH doesn't need to scan the table
+    cursor.execute(f"ALTER TABLE {new_partition} ADD CONSTRAINT {new_partition}_bounds CHECK ({in_partition});",
+                   {'city': city})
+
+    create_month_partition(cursor, month, city)
+    cursor.execute(f"ALTER TABLE {month_partition_name(month)} DETACH PARTITION {partition};")
+    cursor.execute(f"DROP TABLE {partition};")
+    cursor.execute(f"ALTER TABLE {month_partition_name(month)} ATTACH PARTITION {new_partition} FOR VALUES IN (%s);",
+                   (city,))
+    cursor.execute(f"ALTER TABLE {new_partition} RENAME TO {partition};")
+    cursor.execute(f"ALTER TABLE {partition} RENAME CONSTRAINT {new_partition}_bounds TO {partition}_bounds;")
+    # Give the indexes the partition's name back, so the next swap can reuse the same names
+    cursor.execute("SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = %s::regclass;", (partition,))
+    for (index,) in cursor.fetchall():
+        if index.startswith(f"{new_partition}_"):
+            cursor.execute(f"ALTER INDEX {index} RENAME TO {partition}{index[len(new_partition):]};")
+    return rows
+
+# Creates ride_sources (see createTables_final.py) for a partitioned 'rides' that was loaded before it existed
+# Nothing says which file those rides came from, so each is taken to be from the file of the month it started in
+def ensure_ride_sources_table(cursor):
+    cursor.execute("SELECT to_regclass('ride_sources') IS NOT NULL;")
+    if cursor.fetchone()[0]:
+        return
+    cursor.execute(create_ride_sources_table_sql)
+    cursor.execute("""
+        INSERT INTO ride_sources (ride_id, started_at, data_source_city, source_month)
+        SELECT DISTINCT ON (ride_id) ride_id, started_at, data_source_city::text, date_trunc('month', started_at)::date
+        FROM rides
+        ORDER BY ride_id, started_at, data_source_city::text;
+    """)
+
+# Deletes the rides whose ride_sources rows match a condition, along with those rows
+# The months the rides were in are marked for the next rollup refresh
+def delete_sourced_rides(cursor, condition, params=None):
+    cursor.execute(f"""
+        WITH sources AS (
+            DELETE FROM ride_sources WHERE {condition} RETURNING ride_id, started_at
+        ), deleted AS (
+            DELETE FROM rides USING sources
+            WHERE rides.ride_id = sources.ride_id AND rides.started_at = sources.started_at
+            RETURNING rides.started_at, rides.ended_at
+        )
+        {record_pending_months_sql('deleted')}
+    """, params)
+
+# Function to build the condition on ride_sources for the rides an earlier load of the same month and cities gave
+def own_sources_sql(month):
+    if month is None:
+        return "FALSE"
+    # Never NULL, so NOT (...) holds for the rides of files without a month
+    return "source_month IS NOT DISTINCT FROM %(month)s AND data_source_city = ANY(%(cities)s)"
+
+# Keeps one ride per ride_id, the earliest by started_at, across the loaded table and the rest of 'rides'
+# (the partitioned primary key only stops the same ride_id starting at the same time in the same city)
+# When a month is re-ingested, the rides its files gave before don't count as earlier rides: the ones in the
+# month's partitions go with the swap, and the ones that started in another month are deleted here
+def keep_earliest_rides(cursor, month, cities):
+    params = {'month': month, 'next_month': None if month is None else next_month(month), 'cities': cities}
+    # Only the ride_ids the loaded files have more than once are joined
+    cursor.execute("""
+        DELETE FROM rides_load l USING rides_load e
+        WHERE e.ride_id = l.ride_id AND (e.started_at, e.data_source_city) < (l.started_at, l.data_source_city)
+          AND l.ride_id IN (SELECT ride_id FROM rides_load GROUP BY ride_id HAVING count(*) > 1);
+    """)
+    if month is not None:
+        delete_sourced_rides(cursor, f"{own_sources_sql(month)} "
+                                     f"AND NOT (started_at >= %(month)s AND started_at < %(next_month)s)", params)
+
+    # Loaded rows that an earlier ride of the same ride_id beats are dropped, and rides they beat are deleted
+    # (ride_sources is probed once, and the few ride_ids other loads already gave are kept for both statements)
+    cursor.execute(f"""
+        CREATE TEMP TABLE rides_load_sources ON COMMIT DROP AS
+        SELECT ride_id, started_at, data_source_city FROM ride_sources
+        WHERE ride_id IN (SELECT ride_id FROM rides_load) AND NOT ({own_sources_sql(month)});
+    """, params)
+    cursor.execute("""
+        DELETE FROM rides_load l USING rides_load_sources s
+        WHERE s.ride_id = l.ride_id AND (s.started_at, s.data_source_city) < (l.started_at, l.data_source_city);
+    """)
+    delete_sourced_rides(cursor, "ride_id IN (SELECT ride_id FROM rides_load_sources JOIN rides_load USING (ride_id))")
+
+# Records where the rides of the loaded table came from, once they are in 'rides'
+# The month's own rides that are still in its files keep their rows, which are only rewritten if they changed
+def record_ride_sources(cursor, month, cities):
+    params = {'month': month, 'cities': cities}
+    cursor.execute(f"""
+        DELETE FROM ride_sources s
+        WHERE {own_sources_sql(month)} AND NOT EXISTS (SELECT 1 FROM rides_load l WHERE l.ride_id = s.ride_id);
+    """, params)
+    cursor.execute("""
+        INSERT INTO ride_sources (ride_id, started_at, data_source_city, source_month)
+        SELECT DISTINCT ON (ride_id) ride_id, started_at, data_source_city, %(month)s::date
+        FROM rides_load
+        ORDER BY ride_id, started_at, data_source_city
+        ON CONFLICT (ride_id) DO UPDATE
+        SET (started_at, data_source_city, source_month) =
+            (EXCLUDED.started_at, EXCLUDED.data_source_city, EXCLUDED.source_month)
+        WHERE (ride_sources.started_at, ride_sources.data_source_city, ride_sources.source_month)
+            IS DISTINCT FROM (EXCLUDED.started_at, EXCLUDED.data_source_city, EXCLUDED.source_month);
+    """, params)
+
+# Loads the ride CSVs of one month into a partitioned 'rides', replacing what was loaded for that month before
+# `month` is None for files without a month in their name; their rows are merged into whichever partitions they
+# belong to. Rows outside the month (rides that started before midnight on the last day) are merged the same way
+# Each ride_id is kept once, at its earliest started_at, whichever month's load brought it (see keep_earliest_rides)
+# Each source is loaded as in copy_rides_into, so with copy_format 'binary' it is an iterator of DataFrames
+# names label the sources in the quarantine of a resilient load (files are labelled with their own name)
+def load_month(conn, month, sources, copy_format='csv', resilient=RESILIENT_LOAD, names=None):
+    with stage('load_month', month=month) as record:
+        compact = rides_is_compact(conn)
+        with conn.cursor() as cursor:
+            cursor.execute(create_load_table_sql)
+            ensure_ride_sources_table(cursor)
+            record['rows'] = 0
+            for i, chunks in enumerate(sources):
+                source = names[i] if names else os.path.basename(getattr(chunks, 'name', f"{month} source {i + 1}"))
+                record['rows'] += copy_rides_into(cursor, 'rides_load', chunks, copy_format, resilient, source)
+            # Prepared once for the partitions swapped in and the rows merged outside the month alike,
+            # so the foreign keys hold for both
+            prepare_load_table(cursor, 'rides_load', compact)
+            # The cities are taken before keep_earliest_rides, so a city whose rows all lose to earlier rides
+            # still has its partition replaced
+            cursor.execute("SELECT DISTINCT data_source_city FROM rides_load;")
+            cities = [city for (city,) in cursor.fetchall()]
+            keep_earliest_rides(cursor, month, cities)
+
+            if month is not None:
+                for city in cities:
+                    rows = swap_in_month_partition(cursor, month, city, 'rides_load', compact)
+                    print(f"Swapped in {city_partition_name(month, city)} with {rows:,} rows.")
+            record_ride_sources(cursor, month, cities)
+            if month is not None:
+                cursor.execute(f"""
+                    DELETE FROM rides_load WHERE started_at >= '{month}' AND started_at < '{next_month(month)}';
+                """)
+
+            cursor.execute("""
+                SELECT DISTINCT date_trunc('month', started_at)::date, data_source_city FROM rides_load;
+            """)
+            for other_month, city in cursor.fetchall():
+                create_month_partition(cursor, other_month, city)
+            cursor.execute(merge_rides_sql('rides_load', partitioned_key_columns, compact))
+        conn.commit()
+
+# Loads ride CSV files into a partitioned 'rides', one month at a time
+def load_rides_partitioned(conn, filepaths):
+    months = {}
+    for filepath in filepaths:
+        months.setdefault(file_month(filepath), []).append(filepath)
+
+    for month, month_filepaths in sorted(months.items(), key=lambda item: (item[0] is None, item[0] or date.min)):
+        print(f"Loading {month or 'files without a month'}: {', '.join(map(os.path.basename, month_filepaths))}")
+        load_month(conn, month, open_files(month_filepaths))
+
+# Opens files one after another for load_month, closing each once it has been read
+def open_files(filepaths):
+    for filepath in filepaths:
+        with open(filepath, 'r') as f:
+            yield f
+
+# Creates the unlogged staging table empty, replacing one left by an earlier load
+# (so it always has the columns of the current preprocessed CSVs)
+def prepare_staging_table(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS rides_staging;")
+        cursor.execute(create_staging_table_sql)
     conn.commit()
 
-# Loads all preprocessed CSV files into the database
-for filename in os.listdir(preprocessed_csv_dir):
-    if filename.endswith('.csv'):
-        filepath = os.path.join(preprocessed_csv_dir, filename)
-        print(f"Processing file: {filepath}")
-        load_rides(filepath)  # Load ride data
+# Worker loop for load_rides_in_parallel: COPYs files from the queue into the staging table on its own connection
+def staging_load_worker(worker_id, file_queue, resilient=RESILIENT_LOAD):
+    stats = {'worker': worker_id, 'files': 0, 'rows': 0, 'bytes': 0, 'seconds': 0.0, 'errors': []}
+    conn = psycopg2.connect(DATABASE_URI, connection_factory=MetricsConnection)
+    try:
+        while True:
+            try:
+                filepath = file_queue.get_nowait()
+            except queue.Empty:
+                break
+            print(f"Worker {worker_id} loading file: {filepath}")
+            start = time.perf_counter()
+            try:
+                with stage('copy', file=filepath, worker=worker_id) as record:
+                    with open(filepath, 'r') as f, conn.cursor() as cursor:
+                        rows = record['rows'] = copy_rides_into(cursor, 'rides_staging', f, resilient=resilient,
+                                                                source=os.path.basename(filepath))
+                    record['bytes'] = os.path.getsize(filepath)
+                    conn.commit()
+            except Exception as e:
+                conn.rollback()
+                stats['errors'].append((filepath, repr(e)))
+                print(f"An error occurred while loading {filepath}: {e}")
+                continue
+            stats['seconds'] += time.perf_counter() - start
+            stats['files'] += 1
+            stats['rows'] += rows
+            stats['bytes'] += os.path.getsize(filepath)
+    finally:
+        conn.close()
+    return stats
+
+# Loads ride CSV files over several worker connections into the staging table, then merges them into 'rides'
+# Returns the per-worker statistics
+def load_rides_in_parallel(conn, filepaths, workers=LOAD_WORKERS, resilient=RESILIENT_LOAD):
+    prepare_staging_table(conn)
+    if resilient:
+        # Created up front, as workers creating it at the same time would conflict
+        with conn.cursor() as cursor:
+            cursor.execute(create_quarantine_table_sql)
+        conn.commit()
+
+    # Largest files first so the last worker isn't left with a big month at the end
+    file_queue = queue.Queue()
+    for filepath in sorted(filepaths, key=os.path.getsize, reverse=True):
+        file_queue.put(filepath)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        worker_stats = list(executor.map(lambda worker_id: staging_load_worker(worker_id, file_queue, resilient),
+                                         range(workers)))
+    copy_seconds = time.perf_counter() - start
+
+    print("Merging staged rides into the rides table...")
+    start = time.perf_counter()
+    compact = rides_is_compact(conn)
+    with stage('merge') as record, conn.cursor() as cursor:
+        moved_rows = record['rows'] = merge_into_rides(cursor, 'rides_staging', compact=compact)
+        cursor.execute("TRUNCATE rides_staging;")
+        conn.commit()
+    move_seconds = time.perf_counter() - start
+
+    print_load_summary(worker_stats, copy_seconds)
+    print(f"Merged {moved_rows:,} unique rides into rides in {move_seconds:.1f}s.")
+    return worker_stats
+
+# Prints per-worker and overall COPY throughput
+def print_load_summary(worker_stats, copy_seconds):
+    print(f"{'worker':>6} {'files':>6} {'rows':>12} {'MB':>9} {'seconds':>9} {'MB/s':>8} {'rows/s':>10}")
+    for stats in worker_stats:
+        mb = stats['bytes'] / 1024 ** 2
+        seconds = stats['seconds'] or float('nan')
+        print(f"{stats['worker']:>6} {stats['files']:>6} {stats['rows']:>12,} {mb:>9.1f} "
+              f"{stats['seconds']:>9.1f} {mb / seconds:>8.1f} {stats['rows'] / seconds:>10,.0f}")
+        for filepath, error in stats['errors']:
+            print(f"{'':>6} FAILED {filepath}: {error}")
+    total_mb = sum(stats['bytes'] for stats in worker_stats) / 1024 ** 2
+    total_rows = sum(stats['rows'] for stats in worker_stats)
+    print(f"{'total':>6} {sum(stats['files'] for stats in worker_stats):>6} {total_rows:>12,} {total_mb:>9.1f} "
+          f"{copy_seconds:>9.1f} {total_mb / copy_seconds:>8.1f} {total_rows / copy_seconds:>10,.0f}")
+
+# After loading all ride data, deduplicate and load stations, snap rides without a station to the nearest one,
+# add foreign key constraints and refresh the rollups of the months just loaded
+# In the compact schema the stations were already added while loading
+def finish_loading(conn):
+    compact = rides_is_compact(conn)
+    if not compact:
+        deduplicate_and_load_stations(conn)
+    snap_rides_to_stations(conn, compact)
+    add_foreign_key_constraints(conn)
+    print("Refreshing rollups...")
+    refresh_rollups(conn, compact)
+
+if __name__ == '__main__':
+    conn = psycopg2.connect(DATABASE_URI, connection_factory=MetricsConnection)
+
+    # Loads all preprocessed CSV files into the database
+    filepaths = [os.path.join(preprocessed_csv_dir, filename)
+                 for filename in os.listdir(preprocessed_csv_dir) if filename.endswith('.csv')]
+    if rides_is_partitioned(conn):
+        load_rides_partitioned(conn, filepaths)
+    elif LOAD_WORKERS > 1:
+        load_rides_in_parallel(conn, filepaths)
+    else:
+        for filepath in filepaths:
+            print(f"Processing file: {filepath}")
+            load_rides(conn, filepath)  # Load ride data
 
-# After loading all ride data, deduplicate and load stations, and add foreign key constraints
-remove_ride_duplicates_and_set_primary_key()
-deduplicate_and_load_stations()
-add_foreign_key_constraints()
+    finish_loading(conn)
 
-cursor.close()
-conn.close()
+    conn.close()
 
-print("Data loading completed.")
+    print("Data loading completed.")
@@ -0,0 +1,69 @@
+from datetime import datetime, timezone
+import hashlib
+import json
+import os
+import threading
+
+# Manifest of every archive seen by ingestion, kept next to the data directories
+MANIFEST_PATH = 'ingestion_manifest.json'
+
+# Processing states an archive moves through:
+# downloading -> downloaded -> extracted (skipped when the zips are kept) -> preprocessed
+DOWNLOADING, DOWNLOADED, EXTRACTED, PREPROCESSED = 'downloading', 'downloaded', 'extracted', 'preprocessed'
+
+# Download threads update the manifest concurrently
+_manifest_lock = threading.Lock()
+
+# Function to load the manifest, keyed by source URL (empty on the first run)
+def load_manifest(path: str = MANIFEST_PATH) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+# Function to write the manifest atomically, so a crash never leaves a half-written file
+def save_manifest(manifest: dict, path: str = MANIFEST_PATH) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+# Function to update the fields of one archive's entry and persist the manifest straight away
+def update_entry(manifest: dict, url: str, path: str = MANIFEST_PATH, **fields) -> dict:
+    with _manifest_lock:
+        entry = manifest.setdefault(url, {'url': url})
+        entry.update(fields, updated_at=datetime.now(timezone.utc).isoformat(timespec='seconds'))
+        save_manifest(manifest, path)
+        return entry
+
+# Function to move every entry in one of the given states to a new state
+def mark_entries(manifest: dict, from_states: tuple, to_state: str, path: str = MANIFEST_PATH) -> int:
+    urls = [url for url, entry in manifest.items() if entry.get('state') in from_states]
+    for url in urls:
+        update_entry(manifest, url, path, state=to_state)
+    return len(urls)
+
+# Function to fetch the size, ETag and Last-Modified of a remote archive with a HEAD request
+def remote_fingerprint(session, href: str, timeout: int = 60) -> dict:
+    response = session.head(href, allow_redirects=True, timeout=timeout)
+    response.raise_for_status()
+    size = response.headers.get('Content-Length')
+    return {'size': int(size) if size is not None else None,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')}
+
+# Function to check whether an entry describes the same version of the archive as a fresh fingerprint
+def is_unchanged(entry: dict, fingerprint: dict) -> bool:
+    if entry is None:
+        return False
+    if fingerprint['etag'] is not None and entry.get('etag') is not None:
+        return entry['etag'] == fingerprint['etag']
+    return (entry.get('size'), entry.get('last_modified')) == (fingerprint['size'], fingerprint['last_modified'])
+
+# Function to compute the SHA-256 checksum of a file
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
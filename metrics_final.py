@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import resource
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import psycopg2.extensions
+
+# JSON-lines file every script appends its stage records to (None turns the records off)
+METRICS_PATH = 'pipeline_metrics.jsonl'
+
+# Stage or substage to run under cProfile, e.g. 'read_csv' or 'copy' (None profiles nothing)
+# Each process and thread writes its cumulative profile to PROFILE_DIR/<stage>-<pid>-<thread>.prof,
+# readable with pstats or snakeviz
+PROFILE_STAGE = None
+PROFILE_DIR = 'profiles'
+
+# Stages running in the current thread, innermost last; substages and statements are counted against the innermost
+_active = threading.local()
+_write_lock = threading.Lock()
+
+# Function to get the stack of stages running in the current thread
+def active_stages():
+    if not hasattr(_active, 'stages'):
+        _active.stages = []
+    return _active.stages
+
+# Function to read the peak resident memory of this process so far, in MB
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+# Function to append one record to the metrics file
+def write_record(record, path=None):
+    path = path or METRICS_PATH
+    if not path:
+        return
+    line = json.dumps(record, default=str) + '\n'
+    with _write_lock, open(path, 'a') as f:
+        f.write(line)
+
+# Function to run a block under the profiler of a stage name, if it is the one chosen for profiling
+# Each thread keeps its own profiler; the profile is written out after each run of the block,
+# because pool workers exit without running atexit hooks
+@contextmanager
+def profiled(name):
+    if name != PROFILE_STAGE or getattr(_active, 'profiling', False):
+        yield
+        return
+    if not hasattr(_active, 'profiler'):
+        _active.profiler = cProfile.Profile()
+    _active.profiling = True
+    _active.profiler.enable()
+    try:
+        yield
+    finally:
+        _active.profiler.disable()
+        _active.profiling = False
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        _active.profiler.dump_stats(
+            os.path.join(PROFILE_DIR, f"{name}-{os.getpid()}-{threading.current_thread().name}.prof"))
+
+# Records one stage of work (for one file, month, index...) as a line in the metrics file
+# The block can fill in record['rows'] and record['bytes']; wall and CPU time, peak RSS, the time spent
+# in Postgres statements and any substages are added when it ends, along with the error if it failed
+@contextmanager
+def stage(name, file=None, **fields):
+    record = {'time': datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+              'script': os.path.basename(sys.argv[0]), 'pid': os.getpid(), 'stage': name}
+    if file is not None:
+        record['file'] = os.path.basename(file) if isinstance(file, str) else str(file)
+    record.update(fields)
+    record.update({'rows': None, 'bytes': None, 'postgres': {}, 'substages': {}, 'error': None})
+
+    stages = active_stages()
+    stages.append(record)
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        with profiled(name):
+            yield record
+    except BaseException as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        record['wall_seconds'] = round(time.perf_counter() - start, 6)
+        record['cpu_seconds'] = round(time.thread_time() - cpu_start, 6)
+        record['peak_rss_mb'] = round(peak_rss_mb(), 1)
+        stages.pop()
+        write_record(record)
+
+# Times a part of the innermost running stage (e.g. read_csv or to_csv), adding up over repeated calls
+# Used for work done many times per file, which would otherwise give one record per chunk
+@contextmanager
+def substage(name):
+    stages = active_stages()
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        with profiled(name):
+            yield
+    finally:
+        if stages:
+            totals = stages[-1]['substages'].setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+            totals['calls'] += 1
+            totals['wall_seconds'] = round(totals['wall_seconds'] + time.perf_counter() - start, 6)
+            totals['cpu_seconds'] = round(totals['cpu_seconds'] + time.thread_time() - cpu_start, 6)
+
+# Function to add to a count kept by the innermost running stage (e.g. the rows a resilient load rejected)
+def count_in_stage(field, count):
+    stages = active_stages()
+    if stages:
+        stages[-1][field] = (stages[-1].get(field) or 0) + count
+
+# Function to name the kind of a SQL statement, e.g. 'COPY', 'INSERT' or 'CREATE INDEX'
+def statement_kind(sql):
+    words = sql.split(None, 3)
+    if not words:
+        return ''
+    if words[0].upper() in ('CREATE', 'ALTER', 'DROP') and len(words) > 1:
+        # CREATE UNLOGGED TABLE, CREATE TEMP TABLE, CREATE INDEX CONCURRENTLY... are grouped by their object
+        kind = words[2] if words[1].upper() in ('UNLOGGED', 'TEMP', 'UNIQUE') and len(words) > 2 else words[1]
+        return f"{words[0]} {kind}".upper()
+    return words[0].upper()
+
+# Function to add the time of a statement to the innermost running stage
+def record_statement(sql, seconds, rowcount):
+    stages = active_stages()
+    if not stages:
+        return
+    kind = statement_kind(sql if isinstance(sql, str) else sql.decode())
+    totals = stages[-1]['postgres'].setdefault(kind, {'statements': 0, 'seconds': 0.0, 'rows': 0})
+    totals['statements'] += 1
+    totals['seconds'] = round(totals['seconds'] + seconds, 6)
+    totals['rows'] += max(rowcount, 0)
+
+# Cursor that times every statement and COPY it sends, and counts it against the running stage
+# Connections made with MetricsConnection (below) use it for every cursor
+class MetricsCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_statement(query, time.perf_counter() - start, self.rowcount)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            record_statement(sql, time.perf_counter() - start, self.rowcount)
+
+# Connection whose cursors are MetricsCursors and whose commits are timed too (flushing a big transaction's
+# WAL or emptying ON COMMIT DELETE ROWS tables happens at commit)
+# Connect with psycopg2.connect(..., connection_factory=MetricsConnection)
+class MetricsConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = MetricsCursor
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            record_statement('COMMIT', time.perf_counter() - start, 0)
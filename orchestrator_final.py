@@ -0,0 +1,372 @@
+import os
+import queue
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import psycopg2
+import ingestion_final
+from ingestion_final import list_remote_archives, make_session, sync_archive
+from archives_final import list_archive_csvs
+from manifest_final import MANIFEST_PATH, DOWNLOADED, PREPROCESSED, load_manifest, update_entry
+from preprocessing_final import city_names, preprocess_file_timed
+from loading_final import (DATABASE_URI, load_rides, load_month, open_files, file_month, rides_is_partitioned,
+                           finish_loading)
+from metrics_final import MetricsConnection
+
+# Runs in the base directory, like ingestion_final.py: archives go to zips/ and the manifest sits next to them
+zips_dir = 'zips'
+preprocessed_csv_dir = 'preprocessed_for_copy'
+
+# Concurrency of each stage: download threads, preprocessing processes and loading connections
+DOWNLOAD_WORKERS = 3
+PREPROCESS_WORKERS = 2
+LOAD_WORKERS = 1
+
+# Bounded queues between the stages. A full queue makes the stage before it wait, so downloads can't run
+# far ahead of preprocessing (zips piling up on disk) and preprocessing can't run far ahead of loading
+# (preprocessed CSVs piling up). Each item is one month of one archive
+PREPROCESS_QUEUE_SIZE = 4
+LOAD_QUEUE_SIZE = 2
+
+# Rows per chunk when preprocessing (None reads each file in one go)
+CHUNK_ROWS = None
+
+# Keep the preprocessed CSVs once they are loaded (they are deleted by default to save disk space)
+KEEP_PREPROCESSED = False
+
+# Times a merge into an unpartitioned 'rides' is retried when it deadlocks with another loader
+LOAD_RETRIES = 3
+
+# Swapping in a month partition locks the parent table, so partitioned loads run one at a time
+partition_swap_lock = threading.Lock()
+
+# Keeps track of the archives and months moving through the pipeline, and of how each stage spent its time
+# An archive is marked as preprocessed in the manifest (and its zip deleted) once every month in it is loaded;
+# if any of them failed it stays 'downloaded', so the next run picks it up again
+class PipelineTracker:
+    def __init__(self, manifest, workers):
+        self.manifest = manifest
+        self.lock = threading.Lock()
+        self.seen_files = set()
+        self.pending = {}
+        self.failed_archives = set()
+        self.errors = []
+        self.up_to_date = 0
+        self.stages = {name: {'workers': count, 'items': 0, 'rows': 0, 'busy_seconds': 0.0,
+                              'waiting_seconds': 0.0, 'blocked_seconds': 0.0}
+                       for name, count in workers.items()}
+
+    # Function to add to the counters of a stage
+    def add(self, stage_name, **amounts):
+        with self.lock:
+            for key, amount in amounts.items():
+                self.stages[stage_name][key] += amount
+
+    # Function to claim a CSV name, so a file found in more than one archive is only loaded once
+    def claim_file(self, base_directory, csv_name):
+        with self.lock:
+            if (base_directory, csv_name) in self.seen_files:
+                return False
+            self.seen_files.add((base_directory, csv_name))
+            return True
+
+    # Function to register the months of a downloaded archive before they are queued
+    def expect(self, href, zip_path, batch_count):
+        with self.lock:
+            self.pending[href] = [zip_path, batch_count]
+        if batch_count == 0:
+            self.finish_archive(href)
+
+    # Function to record a month of an archive as loaded, or as failed along with the error
+    def batch_done(self, batch, error=None):
+        with self.lock:
+            if error is not None:
+                self.failed_archives.add(batch['href'])
+                self.errors.append((batch['name'], error))
+            self.pending[batch['href']][1] -= 1
+            finished = self.pending[batch['href']][1] == 0
+        if finished:
+            self.finish_archive(batch['href'])
+
+    # Function to record an archive that couldn't be downloaded
+    def archive_failed(self, fname, error):
+        with self.lock:
+            self.errors.append((fname, error))
+
+    # Function to mark an archive whose months are all loaded as preprocessed, and delete its zip
+    def finish_archive(self, href):
+        with self.lock:
+            zip_path = self.pending.pop(href)[0]
+            if href in self.failed_archives:
+                return
+        update_entry(self.manifest, href, MANIFEST_PATH, state=PREPROCESSED)
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
+
+# Process pool of the preprocessing stage, replaced when one of its processes dies
+# An OOM kill or a crash breaks a ProcessPoolExecutor for good: the months already submitted to it fail, and
+# every later submit would raise BrokenProcessPool, so the next submit starts a new pool instead
+class PreprocessPool:
+    def __init__(self, workers, context):
+        self.workers = workers
+        self.context = context
+        self.lock = threading.Lock()
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+    # Function to run a job on the pool, replacing the pool first if it is broken
+    def submit(self, *args):
+        executor = self.executor
+        try:
+            return executor.submit(*args)
+        except BrokenProcessPool:
+            with self.lock:
+                if self.executor is executor:
+                    print("A preprocessing process died; starting a new process pool.")
+                    self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=self.context)
+            executor.shutdown(wait=False)
+            return self.executor.submit(*args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown()
+
+# Function to take the next item from a queue, counting the time spent waiting as the stage being starved
+def timed_get(work_queue, tracker, stage_name):
+    start = time.perf_counter()
+    item = work_queue.get()
+    tracker.add(stage_name, waiting_seconds=time.perf_counter() - start)
+    return item
+
+# Function to hand an item to the next stage, counting the time spent on a full queue as backpressure
+def timed_put(work_queue, item, tracker, stage_name):
+    start = time.perf_counter()
+    work_queue.put(item)
+    tracker.add(stage_name, blocked_seconds=time.perf_counter() - start)
+
+# Function to split the CSVs of a downloaded archive into batches, one per month
+# The CSVs are read straight out of the zip, with the same clean-up rules ingestion applies when extracting
+def archive_batches(href, zip_path, tracker):
+    months = {}
+    for _, member_chain, base_directory, csv_name, size in list_archive_csvs([zip_path]):
+        if not tracker.claim_file(base_directory, csv_name):
+            print(f"Skipping {csv_name} in {os.path.basename(zip_path)}, it was already queued from another archive.")
+            continue
+        source = (zip_path, tuple(member_chain), size)
+        output_path = os.path.join(preprocessed_csv_dir, f"preprocessed_{csv_name}")
+        job = (source, output_path, city_names[base_directory], 'old' in csv_name.lower())
+        months.setdefault(file_month(csv_name), []).append(job)
+
+    return [{'href': href, 'month': month, 'jobs': jobs, 'files': [], 'rows': 0,
+             'name': f"{os.path.basename(zip_path)} {month or 'without a month'}"}
+            for month, jobs in months.items()]
+
+# Stage 1: downloads one archive (unless the manifest shows it is already loaded) and queues its months
+def download_worker(fname, href, session, preprocess_queue, tracker):
+    zip_path = os.path.join(zips_dir, f"{fname}.zip")
+    start = time.perf_counter()
+    try:
+        metrics = sync_archive(href, fname, session, tracker.manifest)
+        if tracker.manifest.get(href, {}).get('state') != DOWNLOADED:
+            with tracker.lock:
+                tracker.up_to_date += 1
+            return
+        batches = archive_batches(href, zip_path, tracker)
+    except Exception as e:
+        tracker.archive_failed(fname, repr(e))
+        print(f"Failed to download {fname}: {e}")
+        return
+    tracker.add('download', items=1, busy_seconds=time.perf_counter() - start)
+    print(f"Downloaded {fname} ({metrics['mb_per_second']:.1f} MB/s)" if metrics else
+          f"Using {fname}, downloaded by an earlier run")
+
+    tracker.expect(href, zip_path, len(batches))
+    for batch in batches:
+        timed_put(preprocess_queue, batch, tracker, 'download')
+
+# Stage 2: preprocesses the files of each queued month on the process pool and queues them for loading
+# A month is only loaded if all of its files were preprocessed. Like the loaders, the worker keeps taking months
+# off its queue until its None whatever fails, or the downloads would block on a full queue forever
+def preprocess_worker(pool, preprocess_queue, load_queue, tracker):
+    while True:
+        batch = timed_get(preprocess_queue, tracker, 'preprocess')
+        if batch is None:
+            break
+        start = time.perf_counter()
+        futures = []
+        errors = []
+        for job in batch['jobs']:
+            try:
+                futures.append((job, pool.submit(preprocess_file_timed, *job, CHUNK_ROWS, 'csv')))
+            except Exception as e:
+                errors.append(f"{os.path.basename(job[1])}: {e!r}")
+        for job, future in futures:
+            try:
+                rows, _ = future.result()
+                batch['rows'] += rows
+                batch['files'].append(job[1])
+            except Exception as e:
+                errors.append(f"{os.path.basename(job[1])}: {e!r}")
+        tracker.add('preprocess', items=1, rows=batch['rows'], busy_seconds=time.perf_counter() - start)
+
+        if errors:
+            print(f"Failed to preprocess {batch['name']}: {'; '.join(errors)}")
+            remove_preprocessed_files([job[1] for job in batch['jobs']])
+            tracker.batch_done(batch, '; '.join(errors))
+            continue
+        print(f"Preprocessed {batch['name']} ({batch['rows']:,} rows)")
+        timed_put(load_queue, batch, tracker, 'preprocess')
+
+# Function to delete the preprocessed CSVs of a month, skipping any that weren't written
+def remove_preprocessed_files(filepaths):
+    for filepath in filepaths:
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+# Function to load the preprocessed files of one month into 'rides'
+def load_batch(conn, batch, partitioned):
+    if partitioned:
+        with partition_swap_lock:
+            load_month(conn, batch['month'], open_files(batch['files']))
+        return
+
+    for filepath in batch['files']:
+        for attempt in range(1, LOAD_RETRIES + 1):
+            try:
+                load_rides(conn, filepath)
+                break
+            except psycopg2.errors.DeadlockDetected:
+                conn.rollback()
+                if attempt == LOAD_RETRIES:
+                    raise
+                print(f"Retrying {filepath} after a deadlock with another loader.")
+
+# Function to open a loader's connection and check how 'rides' is laid out
+def open_loader_connection():
+    conn = psycopg2.connect(DATABASE_URI, connection_factory=MetricsConnection)
+    try:
+        partitioned = rides_is_partitioned(conn)
+        conn.commit()
+    except Exception:
+        conn.close()
+        raise
+    return conn, partitioned
+
+# Stage 3: loads each queued month on its own connection
+# The worker must keep taking months off the queue until its None, or the stages before it would block on
+# a full queue forever: a month that can't be loaded is failed, and a lost connection is reopened for the next one
+def load_worker(conn, partitioned, load_queue, tracker):
+    try:
+        while True:
+            batch = timed_get(load_queue, tracker, 'load')
+            if batch is None:
+                break
+            start = time.perf_counter()
+            try:
+                if conn.closed:
+                    conn.close()
+                    conn, partitioned = open_loader_connection()
+                load_batch(conn, batch, partitioned)
+                print(f"Loaded {batch['name']} ({batch['rows']:,} rows)")
+                tracker.batch_done(batch)
+            except Exception as e:
+                print(f"Failed to load {batch['name']}: {e}")
+                tracker.batch_done(batch, repr(e))
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    pass
+            finally:
+                tracker.add('load', items=1, rows=batch['rows'], busy_seconds=time.perf_counter() - start)
+                if not KEEP_PREPROCESSED:
+                    remove_preprocessed_files(batch['files'])
+    finally:
+        conn.close()
+
+# Function to run download, preprocessing and loading at the same time, joined by bounded queues
+# Each month moves on to the next stage as soon as it is done with one, so the run takes about as long as
+# its slowest stage rather than the sum of all three. Returns the tracker with the per-stage timings
+def run_pipeline(filenames, download_workers=DOWNLOAD_WORKERS, preprocess_workers=PREPROCESS_WORKERS,
+                 load_workers=LOAD_WORKERS):
+    # The CSVs are read straight out of the zips instead of being extracted
+    ingestion_final.EXTRACT_ZIPS = False
+    os.makedirs(zips_dir, exist_ok=True)
+    os.makedirs(preprocessed_csv_dir, exist_ok=True)
+
+    tracker = PipelineTracker(load_manifest(MANIFEST_PATH), {'download': download_workers,
+                                                              'preprocess': preprocess_workers,
+                                                              'load': load_workers})
+    preprocess_queue = queue.Queue(maxsize=PREPROCESS_QUEUE_SIZE)
+    load_queue = queue.Queue(maxsize=LOAD_QUEUE_SIZE)
+
+    # The loaders' connections are opened before anything is downloaded, so a database that can't be reached
+    # stops the run here instead of leaving the other stages waiting on a loader that never started
+    connections = []
+    try:
+        for _ in range(load_workers):
+            connections.append(open_loader_connection())
+    except Exception:
+        for conn, _ in connections:
+            conn.close()
+        raise
+    session = make_session(download_workers)
+
+    # Worker processes are spawned rather than forked, since the download threads are already running
+    context = multiprocessing.get_context('spawn')
+    with PreprocessPool(preprocess_workers, context) as pool, \
+            ThreadPoolExecutor(max_workers=preprocess_workers + load_workers) as stage_threads:
+        loaders = [stage_threads.submit(load_worker, conn, partitioned, load_queue, tracker)
+                   for conn, partitioned in connections]
+        preprocessors = [stage_threads.submit(preprocess_worker, pool, preprocess_queue, load_queue, tracker)
+                         for _ in range(preprocess_workers)]
+
+        with ThreadPoolExecutor(max_workers=download_workers) as downloaders:
+            for fname, href in filenames:
+                downloaders.submit(download_worker, fname, href, session, preprocess_queue, tracker)
+
+        # Each stage is told to stop once the one before it has handed over its last month
+        for _ in preprocessors:
+            preprocess_queue.put(None)
+        for future in preprocessors:
+            future.result()
+        for _ in loaders:
+            load_queue.put(None)
+        for future in loaders:
+            future.result()
+
+    session.close()
+    return tracker
+
+# Function to print how each stage spent its time
+# Items are archives for the download stage and months for the others; 'waiting' is time spent with nothing
+# to do, 'blocked' time spent waiting for room in the next stage's queue
+def print_pipeline_summary(tracker, seconds):
+    print(f"{'stage':<12} {'workers':>8} {'items':>7} {'rows':>12} {'busy s':>9} {'waiting s':>10} "
+          f"{'blocked s':>10}")
+    for name, stats in tracker.stages.items():
+        print(f"{name:<12} {stats['workers']:>8} {stats['items']:>7} {stats['rows']:>12,} "
+              f"{stats['busy_seconds']:>9.1f} {stats['waiting_seconds']:>10.1f} {stats['blocked_seconds']:>10.1f}")
+    stage_seconds = {name: stats['busy_seconds'] / stats['workers'] for name, stats in tracker.stages.items()}
+    print(f"Finished in {seconds:.1f}s; run one after another the stages would take about "
+          f"{sum(stage_seconds.values()):.1f}s, the slowest ({max(stage_seconds, key=stage_seconds.get)}) "
+          f"{max(stage_seconds.values()):.1f}s.")
+    print(f"{tracker.up_to_date} archives were already up to date.")
+    for name, error in tracker.errors:
+        print(f"FAILED {name}: {error}")
+
+if __name__ == '__main__':
+    filenames = list_remote_archives()
+    print(f"{len(filenames)} archives listed.")
+
+    start = time.perf_counter()
+    tracker = run_pipeline(filenames)
+
+    conn = psycopg2.connect(DATABASE_URI, connection_factory=MetricsConnection)
+    finish_loading(conn)
+    conn.close()
+
+    print_pipeline_summary(tracker, time.perf_counter() - start)
+    print("Pipeline completed.")
@@ -0,0 +1,130 @@
+import glob
+import os
+import numpy as np
+import pandas as pd
+from urllib.parse import quote
+
+# Compression codec of the Parquet files; zstd files are much smaller than snappy ones and read about as fast
+PARQUET_COMPRESSION = 'zstd'
+
+# Low-cardinality text columns, stored with Parquet dictionary encoding (and read back as categoricals)
+dictionary_columns = ['rideable_type', 'start_station_name', 'start_station_id', 'end_station_name',
+                      'end_station_id', 'member_casual']
+
+# Station id columns, where preprocessing writes missing ids as the text 'nan' (or blank, in the new format)
+station_id_columns = ['start_station_id', 'end_station_id']
+
+# Function to import pyarrow only once the Parquet sink is used, so the CSV path runs without it
+def import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Writing or reading Parquet output needs pyarrow (pip install pyarrow)") from e
+    return pa, pq
+
+# Function to build the Arrow schema of the ride files
+# data_source_city and year_month aren't stored in the files: they are the partition directories
+def rides_arrow_schema(pa):
+    return pa.schema([
+        ('ride_id', pa.string()),
+        ('rideable_type', pa.string()),
+        ('started_at', pa.timestamp('us')),
+        ('ended_at', pa.timestamp('us')),
+        ('start_station_name', pa.string()),
+        ('start_station_id', pa.string()),
+        ('end_station_name', pa.string()),
+        ('end_station_id', pa.string()),
+        ('start_lat', pa.float64()),
+        ('start_lng', pa.float64()),
+        ('end_lat', pa.float64()),
+        ('end_lng', pa.float64()),
+        ('member_casual', pa.string()),
+        ('trip_duration_seconds', pa.int32()),
+        ('trip_distance_meters', pa.int32()),
+        ('bike_id', pa.int64()),
+        ('gender', pa.int8()),
+        ('birth_year', pa.int16()),
+    ])
+
+# Function to get the directory of one city and month, laid out as Hive partitions
+# e.g. rides_parquet/data_source_city=Jersey%20City/year_month=2020-01
+def partition_directory(root_dir, city_name, year_month):
+    return os.path.join(root_dir, f"data_source_city={quote(city_name)}", f"year_month={year_month}")
+
+# Writes the preprocessed rides of one source file into the Parquet dataset, one file per month it covers
+# Files are written under a hidden temporary name and only renamed into place once the whole source is done,
+# so readers never see half a file and a failed run leaves nothing behind
+class ParquetPartitionSink:
+    def __init__(self, root_dir, name, city_name):
+        self.pa, self.pq = import_pyarrow()
+        self.schema = rides_arrow_schema(self.pa)
+        self.root_dir = root_dir
+        self.name = name
+        self.city_name = city_name
+        self.writers = {}
+        self.rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    # Function to open (on first use) the writer of one month
+    def writer_for(self, year_month):
+        if year_month not in self.writers:
+            directory = partition_directory(self.root_dir, self.city_name, year_month)
+            os.makedirs(directory, exist_ok=True)
+            tmp_path = os.path.join(directory, f".{self.name}.parquet.tmp")
+            writer = self.pq.ParquetWriter(tmp_path, self.schema, compression=PARQUET_COMPRESSION,
+                                           use_dictionary=dictionary_columns)
+            self.writers[year_month] = (writer, tmp_path, os.path.join(directory, f"{self.name}.parquet"))
+        return self.writers[year_month][0]
+
+    # Function to write a transformed DataFrame (from transform_rides), split by the month of started_at
+    def write(self, df):
+        df = df.drop(columns='data_source_city')
+        for column in station_id_columns:
+            df[column] = df[column].where(~df[column].isin(['nan', '']))
+
+        months = df['started_at'].values.astype('datetime64[M]')
+        for month in np.unique(months):
+            part = df[months == month]
+            # safe casts raise on overflow or truncation (e.g. a distance beyond int32) and fail the file,
+            # just as COPY rejects the value on the load path, rather than writing a wrapped number
+            table = self.pa.Table.from_pandas(part, schema=self.schema, preserve_index=False, safe=True)
+            self.writer_for(str(month)).write_table(table)
+            self.rows += len(part)
+
+    # Function to finish the files and move them into place, replacing any earlier output of the same source
+    def close(self):
+        for path in glob.glob(os.path.join(glob.escape(self.root_dir), '*', '*', f"{glob.escape(self.name)}.parquet")):
+            os.remove(path)
+        for writer, tmp_path, path in self.writers.values():
+            writer.close()
+            os.replace(tmp_path, path)
+        self.writers = {}
+
+    # Function to drop the files of a source that failed part way
+    def abort(self):
+        for writer, tmp_path, _ in self.writers.values():
+            writer.close()
+            os.remove(tmp_path)
+        self.writers = {}
+
+# Function to read rides from the Parquet dataset into a DataFrame
+# Filters on the partition columns skip whole directories, e.g.
+# read_rides(parquet_dir, filters=[('data_source_city', '=', 'NYC'), ('year_month', '>=', '2020-01')])
+def read_rides(root_dir, columns=None, filters=None):
+    pa, pq = import_pyarrow()
+    table = pq.read_table(root_dir, columns=columns, filters=filters, partitioning='hive',
+                          read_dictionary=dictionary_columns if columns is None else
+                          [column for column in dictionary_columns if column in columns])
+    # Integer columns with gaps come back as pandas nullable integers rather than floats
+    integer_dtypes = {pa.int8(): pd.Int8Dtype(), pa.int16(): pd.Int16Dtype(), pa.int32(): pd.Int32Dtype(),
+                      pa.int64(): pd.Int64Dtype()}
+    return table.to_pandas(types_mapper=integer_dtypes.get)
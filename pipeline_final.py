@@ -0,0 +1,74 @@
+import psycopg2
+from loading_final import (DATABASE_URI, RESILIENT_LOAD, load_rides_stream, finish_loading, rides_is_partitioned,
+                          file_month, load_month)
+from preprocessing_final import (list_raw_jobs, source_name, source_size, iter_preprocessed_csv,
+                                 iter_transformed_rides, mark_archives_preprocessed)
+from metrics_final import MetricsConnection, stage
+
+# Rows per chunk streamed into COPY; bounds the memory held by each file in flight
+PIPELINE_CHUNK_ROWS = 250_000
+
+# How the chunks are sent to COPY: 'csv' text, or 'binary', which encodes the transformed DataFrames in Postgres'
+# binary COPY format so the server doesn't have to parse timestamps and numbers from text (the rows stored are
+# the same either way)
+COPY_FORMAT = 'csv'
+
+# Function to preprocess a raw CSV source into chunks for COPY, yielding (row_count, chunk) pairs
+# Chunks are CSV text (header row first) or transformed DataFrames, following copy_format
+def iter_copy_chunks(source, city_name, is_old_format, chunk_rows, copy_format):
+    if copy_format == 'binary':
+        for df, _ in iter_transformed_rides(source, city_name, is_old_format, chunk_rows):
+            yield len(df), df
+    else:
+        yield from iter_preprocessed_csv(source, city_name, is_old_format, chunk_rows)
+
+# Function to preprocess a raw CSV source (file path or archive member) and stream it straight into the rides table
+# Each transformed chunk is handed to COPY from memory, so no preprocessed CSV is written to disk
+def stream_file_to_rides(conn, source, city_name, is_old_format, chunk_rows=PIPELINE_CHUNK_ROWS,
+                         copy_format=COPY_FORMAT, resilient=RESILIENT_LOAD):
+    rows = 0
+
+    def chunks():
+        nonlocal rows
+        for chunk_row_count, chunk in iter_copy_chunks(source, city_name, is_old_format, chunk_rows, copy_format):
+            rows += chunk_row_count
+            yield chunk
+
+    with stage('stream_load', file=source_name(source), copy_format=copy_format) as record:
+        record['bytes'] = source_size(source)
+        load_rides_stream(conn, chunks(), copy_format, resilient, source_name(source))
+        record['rows'] = rows
+    return rows
+
+# Function to preprocess and stream each month's raw CSVs into a partitioned rides table
+# All the files of a month are loaded together and swapped in as that month's partitions
+def stream_months_to_partitions(conn, jobs, chunk_rows=PIPELINE_CHUNK_ROWS, copy_format=COPY_FORMAT,
+                                resilient=RESILIENT_LOAD):
+    months = {}
+    for source, _, city_name, is_old_format in jobs:
+        months.setdefault(file_month(source_name(source)), []).append((source, city_name, is_old_format))
+
+    for month, month_jobs in months.items():
+        print(f"Streaming {month or 'files without a month'}: {', '.join(source_name(job[0]) for job in month_jobs)}")
+        sources = ((chunk for _, chunk in iter_copy_chunks(source, city_name, is_old_format, chunk_rows, copy_format))
+                   for source, city_name, is_old_format in month_jobs)
+        load_month(conn, month, sources, copy_format, resilient, [source_name(job[0]) for job in month_jobs])
+
+if __name__ == '__main__':
+    conn = psycopg2.connect(DATABASE_URI, connection_factory=MetricsConnection)
+
+    # Preprocess and load every raw file; preprocessing_final.py + loading_final.py remain the file-based mode
+    if rides_is_partitioned(conn):
+        stream_months_to_partitions(conn, list_raw_jobs())
+    else:
+        for source, _, city_name, is_old_format in list_raw_jobs():
+            print(f"Streaming file: {source_name(source)}")
+            rows = stream_file_to_rides(conn, source, city_name, is_old_format)
+            print(f"Loaded {rows:,} rows.")
+
+    mark_archives_preprocessed()
+    finish_loading(conn)
+
+    conn.close()
+
+    print("Pipeline completed.")
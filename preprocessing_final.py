@@ -1,77 +1,715 @@
 import os
+import hashlib
+import numpy as np
 import pandas as pd
 import uuid
 import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack, contextmanager
+from archives_final import list_archive_csvs, open_archive_member
+from manifest_final import MANIFEST_PATH, DOWNLOADED, EXTRACTED, PREPROCESSED, load_manifest, mark_entries
+from parquet_final import ParquetPartitionSink
+from metrics_final import stage, substage
+from spatial_final import haversine_meters
 
 # Main script execution
 base_dir = 'YOUR_BASE_DIR'
 nyc_dir = os.path.join(base_dir, 'nyc_data')
 jersey_city_dir = os.path.join(base_dir, 'jersey_city_data')
 
+# Downloaded archives, read directly when READ_FROM_ZIPS is on (run ingestion with EXTRACT_ZIPS off)
+zips_dir = os.path.join(base_dir, 'zips')
+READ_FROM_ZIPS = False
+
+# Manifest written by ingestion, used to mark archives as preprocessed
+manifest_path = os.path.join(base_dir, MANIFEST_PATH)
+
+# City name stored in data_source_city for each data directory
+city_names = {'nyc_data': 'NYC', 'jersey_city_data': 'Jersey City'}
+
 # New directory for preprocessed CSVs ready for COPY
 preprocessed_csv_dir = os.path.join(base_dir, 'preprocessed_for_copy')
-os.makedirs(preprocessed_csv_dir, exist_ok=True)
+
+# What preprocessing writes: 'csv' for loading_final.py, 'parquet' for the columnar dataset, or 'both'
+OUTPUT_FORMAT = 'csv'
+
+# Parquet dataset of the preprocessed rides, partitioned by city and month (needs pyarrow)
+parquet_dir = os.path.join(base_dir, 'rides_parquet')
+
+# Number of processes used to hash ride_ids for old format files (1 hashes in-process)
+RIDE_ID_WORKERS = 1
 
 # Function to generate UUIDs
 def generate_uuid(started_at, start_station_id, bike_id):
     unique_string = f"{started_at}-{start_station_id}-{bike_id}"
     return uuid.uuid5(uuid.NAMESPACE_DNS, unique_string).hex
 
-# Modified function to preprocess CSV files and save them for COPY
-def preprocess_and_save_csv_for_copy(directory, city_name):
+# Hex characters for the RFC 4122 variant nibble, indexed by the original nibble
+_UUID_VARIANT_HEX = {c: '89ab'[int(c, 16) & 0x3] for c in '0123456789abcdef'}
+
+# Function to hash a list of key strings into UUIDv5 hex values
+# Produces exactly uuid.uuid5(uuid.NAMESPACE_DNS, key).hex for every key
+def uuid5_hex_batch(keys):
+    namespace_sha1 = hashlib.sha1(uuid.NAMESPACE_DNS.bytes)
+    variant = _UUID_VARIANT_HEX
+    hex_values = []
+    for key in keys:
+        sha1 = namespace_sha1.copy()
+        sha1.update(key.encode('utf-8'))
+        digest = sha1.hexdigest()
+        hex_values.append(f"{digest[:12]}5{digest[13:16]}{variant[digest[16]]}{digest[17:32]}")
+    return hex_values
+
+# Function to render a datetime column the same way str(pd.Timestamp) renders each value
+def timestamp_strings(series):
+    if not pd.api.types.is_datetime64_dtype(series):
+        return series.map(str)
+
+    values = series.values.astype('datetime64[ns]')
+    nat = np.isnat(values)
+    text = pd.Series(np.datetime_as_string(values, unit='s'), index=series.index).str.replace('T', ' ', regex=False)
+    text[nat] = 'NaT'
+
+    # Sub-second parts are only shown when non-zero, with 6 digits (or 9 when nanoseconds are set)
+    sub_second = np.where(nat, 0, values.view('int64') % 1_000_000_000)
+    with_micro = (sub_second != 0) & (sub_second % 1000 == 0)
+    with_nano = sub_second % 1000 != 0
+    if with_micro.any():
+        text[with_micro] += '.' + pd.Series(sub_second[with_micro] // 1000).astype(str).str.zfill(6).values
+    if with_nano.any():
+        text[with_nano] += '.' + pd.Series(sub_second[with_nano]).astype(str).str.zfill(9).values
+    return text
+
+# Function to generate UUIDs for whole columns at once
+# Returns the same values as generate_uuid applied row by row, optionally hashing across a process pool
+def generate_uuids(started_at, start_station_id, bike_id, workers=RIDE_ID_WORKERS):
+    keys = (timestamp_strings(started_at) + '-' + start_station_id.astype(str) + '-' + bike_id.astype(str)).tolist()
+
+    if workers <= 1 or len(keys) < workers:
+        return pd.Series(uuid5_hex_batch(keys), index=started_at.index)
+
+    batch_size = -(-len(keys) // workers)
+    batches = [keys[i:i + batch_size] for i in range(0, len(keys), batch_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        hex_values = [value for batch in executor.map(uuid5_hex_batch, batches) for value in batch]
+    return pd.Series(hex_values, index=started_at.index)
+
+# Column names of the old (pre-February 2021) and new data formats, by position
+old_format_columns = ['trip_duration_seconds', 'started_at', 'ended_at',
+                      'start_station_id', 'start_station_name', 'start_lat',
+                      'start_lng', 'end_station_id', 'end_station_name', 'end_lat',
+                      'end_lng', 'bike_id', 'user_type', 'birth_year', 'gender']
+new_format_columns = ['ride_id', 'rideable_type', 'started_at', 'ended_at',
+                      'start_station_name', 'start_station_id', 'end_station_name',
+                      'end_station_id', 'start_lat', 'start_lng', 'end_lat', 'end_lng',
+                      'member_casual']
+
+# Final column order of the preprocessed CSVs, matching the COPY column list
+final_columns = ['ride_id', 'rideable_type', 'started_at', 'ended_at',
+                 'start_station_name', 'start_station_id', 'end_station_name', 'end_station_id',
+                 'start_lat', 'start_lng', 'end_lat', 'end_lng', 'member_casual',
+                 'trip_duration_seconds', 'trip_distance_meters', 'bike_id', 'gender', 'birth_year', 'data_source_city']
+
+# Numeric columns (by position) whose inferred dtype shows up in the output or in generated ride_ids
+old_format_numeric_indices = [0, 3, 5, 6, 9, 10, 11, 14]
+new_format_numeric_indices = [8, 9, 10, 11]
+
+# Markers pandas reads as missing by default; the Arrow parser is given the same ones
+na_markers = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A',
+              'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
+# Datetime columns, in both formats
+datetime_columns = ['started_at', 'ended_at']
+
+# Layouts of the raw ride CSVs. A file's layout is found from its header (see detect_csv_format), not its name;
+# the old format's header is written in lower case, or in title case from late 2016 to early 2017
+# Each layout gives its header and the names its columns get, by position, and how to type them:
+#   dtypes: explicit types, so the parser infers nothing ('category' for columns with few distinct values,
+#           which also keeps them small in memory)
+#   datetime_formats: the formats its datetimes may be written in; the one matching the first row is used
+#   raw_columns: kept exactly as written, so a blank station id stays blank
+#   inferred_columns: typed by the parser, because ride_ids hash the value as pandas renders the inferred type
+# A file that doesn't fit its layout's types (e.g. a missing bike id) is read again with every type inferred
+csv_formats = {
+    'old': {
+        'header': ['tripduration', 'starttime', 'stoptime', 'start station id', 'start station name',
+                   'start station latitude', 'start station longitude', 'end station id', 'end station name',
+                   'end station latitude', 'end station longitude', 'bikeid', 'usertype', 'birth year', 'gender'],
+        'columns': old_format_columns,
+        'dtypes': {'trip_duration_seconds': 'int64', 'start_station_name': 'category', 'start_lat': 'float64',
+                   'start_lng': 'float64', 'end_station_id': 'float64', 'end_station_name': 'category',
+                   'end_lat': 'float64', 'end_lng': 'float64', 'bike_id': 'int64', 'user_type': 'category',
+                   'birth_year': 'str', 'gender': 'int64'},
+        'datetime_formats': ['ISO8601', '%m/%d/%Y %H:%M:%S', '%m/%d/%Y %H:%M'],
+        'raw_columns': [],
+        'inferred_columns': ['start_station_id'],
+    },
+    'new': {
+        'header': new_format_columns,
+        'columns': new_format_columns,
+        'dtypes': {'ride_id': 'str', 'rideable_type': 'category', 'start_station_name': 'category',
+                   'end_station_name': 'category', 'start_lat': 'float64', 'start_lng': 'float64',
+                   'end_lat': 'float64', 'end_lng': 'float64', 'member_casual': 'category'},
+        'datetime_formats': ['ISO8601'],
+        'raw_columns': ['start_station_id', 'end_station_id'],
+        'inferred_columns': [],
+    },
+}
+
+# Rows per chunk when streaming files; None reads each file in one go
+CHUNK_ROWS = None
+
+# Parser for whole-file reads: 'pyarrow' (multi-threaded, needs pyarrow), 'c' (pandas' own) or 'auto' for pyarrow
+# when it is installed. Chunked reads always use the C parser
+CSV_ENGINE = 'auto'
+
+# Worker processes for preprocessing files in parallel (1 runs serially, None sizes the pool from CPUs and memory)
+PREPROCESS_WORKERS = 1
+# Rough peak memory of a worker, per byte of CSV for full reads and per row for chunked reads
+WORKER_MEMORY_PER_CSV_BYTE = 8
+WORKER_BYTES_PER_CHUNK_ROW = 4096
+
+# Function to build the pd.read_csv arguments for a file format, with every type inferred
+# Used for files whose header isn't in csv_formats, or whose values don't fit its types
+def read_csv_options(is_old_format):
+    datetime_cols_indices = [1, 2] if is_old_format else [2, 3]
+    converters = {5: str, 7: str} if not is_old_format else {}
+    return {'parse_dates': datetime_cols_indices, 'converters': converters}
+
+# Function to turn a CSV header into the key it is looked up by in csv_formats
+# Lower case without spaces or underscores, so 'Start Station ID' and 'start station id' match
+def header_key(names):
+    return tuple(str(name).lower().replace(' ', '').replace('_', '') for name in names)
+
+csv_format_keys = {header_key(layout['header']): name for name, layout in csv_formats.items()}
+
+# Function to pick the first of a layout's datetime formats that reads a sample value (None lets pandas infer it)
+def match_datetime_format(text, datetime_formats):
+    for datetime_format in datetime_formats:
+        try:
+            pd.to_datetime(pd.Series([text]), format=datetime_format)
+            return datetime_format
+        except ValueError:
+            continue
+    return None
+
+# Function to work out how to read a raw CSV from its header and first row
+# Returns the read plan: the layout name, the file's own column names and the format of its datetimes.
+# Files whose header isn't in csv_formats are read with every type inferred, with the format from the file name
+def detect_csv_format(handle, is_old_format):
+    first_rows = read_raw_csv(handle, nrows=1, dtype=str, keep_default_na=False)
+    header = list(first_rows.columns)
+    format_name = csv_format_keys.get(header_key(header))
+    plan = {'format': format_name, 'header': header, 'typed': format_name is not None,
+            'is_old_format': is_old_format if format_name is None else format_name == 'old', 'datetime_format': None}
+    if format_name is None:
+        print(f"Unknown header {header}, reading it with inferred types.")
+    elif len(first_rows):
+        started_at = header[csv_formats[format_name]['columns'].index('started_at')]
+        plan['datetime_format'] = match_datetime_format(first_rows[started_at].iloc[0],
+                                                        csv_formats[format_name]['datetime_formats'])
+    return plan
+
+# Function to switch a read plan to inferred types, after the file turned out not to fit its layout's
+def use_inferred_types(plan, error):
+    print(f"Values don't fit the {plan['format']} format's types ({error}), reading with inferred types.")
+    plan['typed'] = False
+
+# Function to get the names a file gives the columns of its layout
+def file_column_names(plan):
+    return dict(zip(csv_formats[plan['format']]['columns'], plan['header']))
+
+# Function to build the pd.read_csv arguments that give a file the explicit types of its layout
+# Datetimes are read as text and parsed once afterwards, with the format found by detect_csv_format
+def typed_read_csv_options(plan):
+    layout = csv_formats[plan['format']]
+    names = file_column_names(plan)
+    dtype = {names[column]: dtype for column, dtype in layout['dtypes'].items()}
+    dtype.update({names[column]: 'str' for column in datetime_columns})
+    return {'dtype': dtype, 'converters': {names[column]: str for column in layout['raw_columns']}}
+
+# Function to import the Arrow CSV parser, or get None if pyarrow isn't installed
+def import_arrow_csv():
+    try:
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+    except ImportError:
+        return None, None
+    return pa, pa_csv
+
+# Function to read a whole raw CSV with the Arrow parser, which splits the work across threads
+# Arrow only reads missing values in non-text columns, so text columns are read as written and the markers
+# pandas reads as missing are cleared from them afterwards (apart from the raw columns)
+def read_arrow_csv(handle, plan):
+    pa, pa_csv = import_arrow_csv()
+    layout = csv_formats[plan['format']]
+    names = file_column_names(plan)
+    arrow_types = {'int64': pa.int64(), 'float64': pa.float64(), 'str': pa.string(),
+                   'category': pa.dictionary(pa.int32(), pa.string())}
+    column_types = {names[column]: arrow_types[dtype] for column, dtype in layout['dtypes'].items()}
+    column_types.update({names[column]: pa.string() for column in datetime_columns + layout['raw_columns']})
+
+    if hasattr(handle, 'seek'):
+        handle.seek(0)
+    table = pa_csv.read_csv(handle, convert_options=pa_csv.ConvertOptions(
+        column_types=column_types, null_values=na_markers, strings_can_be_null=False))
+    if table.column_names != plan['header']:
+        raise ValueError(f"Arrow read the header as {table.column_names}")
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    del table
+
+    for column, name in names.items():
+        if column in layout['raw_columns']:
+            continue
+        if isinstance(df[name].dtype, pd.CategoricalDtype):
+            missing = df[name].cat.categories.intersection(na_markers)
+            if len(missing):
+                df[name] = df[name].cat.remove_categories(missing)
+        elif df[name].dtype == object:
+            df[name] = df[name].mask(df[name].isin(na_markers))
+    return df
+
+# Function to give a DataFrame read with a layout's types its column names and parse its datetimes
+# The Arrow parser reads a missing integer as a float rather than failing, so the integer columns are checked too
+def apply_csv_format(df, plan):
+    layout = csv_formats[plan['format']]
+    df.columns = layout['columns']
+    for column, dtype in layout['dtypes'].items():
+        if dtype in ('int64', 'float64') and df[column].dtype != dtype:
+            raise ValueError(f"{column} was read as {df[column].dtype}")
+    df['started_at'] = pd.to_datetime(df['started_at'], format=plan['datetime_format'])
+    df['ended_at'] = pd.to_datetime(df['ended_at'], format=plan['datetime_format'], errors='coerce')
+    return df
+
+# Function to pick the parser for whole-file reads
+def csv_engine():
+    if CSV_ENGINE == 'auto':
+        return 'pyarrow' if import_arrow_csv()[1] is not None else 'c'
+    return CSV_ENGINE
+
+# Function to read a whole raw CSV following its read plan
+# Falls back to inferred types (as read_csv_options) when the values don't fit the layout's types
+def read_rides_csv(handle, plan):
+    if plan['typed']:
+        try:
+            if csv_engine() == 'pyarrow':
+                df = read_arrow_csv(handle, plan)
+            else:
+                df = read_raw_csv(handle, **typed_read_csv_options(plan))
+            return apply_csv_format(df, plan)
+        except ValueError as e:
+            use_inferred_types(plan, e)
+    return read_raw_csv(handle, **read_csv_options(plan['is_old_format']))
+
+# Function to clean a raw DataFrame and arrange it in the final column order
+def transform_rides(df, is_old_format, city_name):
+    # Assign column names based on format and position
+    if is_old_format:
+        df.columns = old_format_columns
+        df['member_casual'] = df['user_type'].map({'Subscriber': 'casual', 'Customer': 'member'})
+        df.drop('user_type', axis=1, inplace=True)  # Remove the user_type column
+        df['rideable_type'] = pd.NA
+        df['ride_id'] = generate_uuids(df['started_at'], df['start_station_id'], df['bike_id'])
+        df['birth_year'] = df['birth_year'].replace({r'\\N': pd.NA, r'\N': pd.NA})
+        df['birth_year'] = df['birth_year'].astype('Int64')
+    else:  # New format
+        df.columns = new_format_columns
+        df['trip_duration_seconds'] = pd.NA
+        df['bike_id'] = pd.NA
+        df['gender'] = pd.NA
+        df['birth_year'] = pd.NA
+
+    # Files read with their layout's types have their datetimes parsed already
+    if not pd.api.types.is_datetime64_dtype(df['started_at']):
+        df['started_at'] = pd.to_datetime(df['started_at'])
+    if not pd.api.types.is_datetime64_dtype(df['ended_at']):
+        df['ended_at'] = pd.to_datetime(df['ended_at'], errors='coerce')
+    df['data_source_city'] = city_name
+    # Convert start_station_id and end_station_id to strings without their decimal parts
+    df['start_station_id'] = normalize_station_ids(df['start_station_id'])
+    df['end_station_id'] = normalize_station_ids(df['end_station_id'])
+    df['trip_distance_meters'] = trip_distance_meters(df)
+
+    return df[final_columns]
+
+# Function to compute the straight-line (great-circle) distance of each ride from its start to its end point,
+# in whole metres, in one vectorized pass; rides missing a coordinate get no distance
+def trip_distance_meters(df):
+    coordinates = [pd.to_numeric(df[column], errors='coerce')
+                   for column in ['start_lat', 'start_lng', 'end_lat', 'end_lng']]
+    distance = pd.Series(np.rint(haversine_meters(*coordinates)), index=df.index)
+    return distance.astype('Int64')
+
+# Function to render station ids as text without their decimal parts ('72.0' -> '72', '5905.14' -> '5905')
+# Gives the same text as str(id) with every '.<digits>' removed, but float ids are truncated as numbers and
+# text ids are cut at their dot in one pass, so the regex only runs on the odd id that needs it
+def normalize_station_ids(series):
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return series.astype(str)
+    if not pd.api.types.is_float_dtype(series.dtype):
+        return strip_decimal_parts(series.astype(str))
+
+    values = series.to_numpy(dtype='float64')
+    missing = np.isnan(values)
+    # Only ids that str() writes as '<integer>.<digits>' are truncated: not exponents, fractions or '-0.0'
+    magnitude = np.abs(values)
+    plain = np.isfinite(values) & (magnitude < 1e15) & ((magnitude >= 1) | ((values == 0) & ~np.signbit(values)))
+    text = np.trunc(np.where(plain, values, 0)).astype('int64').astype(str).astype(object)
+    text[missing] = 'nan'
+    others = ~plain & ~missing
+    if others.any():
+        text[others] = strip_decimal_parts(series[others].astype(str)).to_numpy()
+    return pd.Series(text, index=series.index)
+
+# Function to remove every '.<digits>' from text ids, as re.sub(r'\.\d+', '', id) does
+# With pyarrow installed, ids with one dot followed only by digits (the usual '5905.14') are cut at the dot
+# with Arrow's string kernels; the rest, and all ids without pyarrow, go through the regex
+def strip_decimal_parts(text):
+    pa, _ = import_arrow_csv()
+    if pa is None:
+        return text.str.replace(r'\.\d+', '', regex=True)
+    import pyarrow.compute as pc
+
+    values = text.to_numpy(dtype=object).copy()
+    parts = pc.split_pattern(pa.array(values, type=pa.string()), '.', max_splits=1)
+    dotted = np.flatnonzero(pc.greater(pc.list_value_length(parts), 1).to_numpy(zero_copy_only=False))
+    if len(dotted) == 0:
+        return text
+    dotted_parts = parts.take(pa.array(dotted))
+    digits_only = pc.utf8_is_decimal(pc.list_element(dotted_parts, 1)).to_numpy(zero_copy_only=False)
+    values[dotted[digits_only]] = pc.list_element(dotted_parts, 0).to_numpy(zero_copy_only=False)[digits_only]
+    others = dotted[~digits_only]
+    if len(others):
+        values[others] = text.iloc[others].str.replace(r'\.\d+', '', regex=True).to_numpy()
+    return pd.Series(values, index=text.index)
+
+# Precision units in the order to_csv prefers them, from coarsest to finest
+_DATETIME_UNITS = ['D', 's', 'ms', 'us', 'ns']
+
+# Function to find the precision to_csv would use for a datetime column (None if all values are NaT)
+def datetime_unit(series):
+    values = series.values.astype('datetime64[ns]')
+    ticks = values[~np.isnat(values)].view('int64')
+    if len(ticks) == 0:
+        return None
+    for unit, ns_per_unit in zip(_DATETIME_UNITS, [86_400 * 10**9, 10**9, 10**6, 10**3]):
+        if (ticks % ns_per_unit == 0).all():
+            return unit
+    return 'ns'
+
+# Function to combine the datetime precisions of two chunks
+def finest_datetime_unit(unit_a, unit_b):
+    if unit_a is None or unit_b is None:
+        return unit_a or unit_b
+    return max(unit_a, unit_b, key=_DATETIME_UNITS.index)
+
+# Function to combine the dtypes pandas inferred for the same column in two chunks
+def merged_dtype(dtype_a, dtype_b):
+    if dtype_a is None or dtype_a == dtype_b:
+        return dtype_b
+    if dtype_a.kind in 'if' and dtype_b.kind in 'if':
+        return np.dtype('float64')
+    return np.dtype('object')
+
+# Function to scan a file in chunks for the column-wide properties that to_csv depends on
+# A full read formats every datetime column with one precision and infers one dtype per column,
+# so streamed chunks need both up front to reproduce the same output
+# With the layout's explicit types only the inferred columns can differ, and the scan also checks that the
+# typed numeric columns read without error (so a file that needs inferred types is known before any chunk is used)
+def scan_file_layout(handle, plan, chunk_rows):
+    header = plan['header']
+    if plan['typed']:
+        layout = csv_formats[plan['format']]
+        names = file_column_names(plan)
+        datetime_names = [names[column] for column in datetime_columns]
+        numeric_names = [names[column] for column in layout['inferred_columns']]
+        typed_dtypes = {names[column]: dtype for column, dtype in layout['dtypes'].items()
+                        if dtype in ('int64', 'float64')}
+        options = {'dtype': {**typed_dtypes, **{name: 'str' for name in datetime_names}}}
+        datetime_format = plan['datetime_format']
+    else:
+        datetime_indices = read_csv_options(plan['is_old_format'])['parse_dates']
+        numeric_indices = old_format_numeric_indices if plan['is_old_format'] else new_format_numeric_indices
+        datetime_names = [header[i] for i in datetime_indices]
+        numeric_names = [header[i] for i in numeric_indices]
+        typed_dtypes = {}
+        options = {'parse_dates': datetime_names}
+        datetime_format = None
+
+    units = dict.fromkeys(datetime_names)
+    dtypes = dict.fromkeys(numeric_names)
+    for chunk in read_raw_csv(handle, usecols=datetime_names + numeric_names + list(typed_dtypes),
+                              chunksize=chunk_rows, **options):
+        started_at, ended_at = datetime_names
+        chunk[started_at] = pd.to_datetime(chunk[started_at], format=datetime_format)
+        chunk[ended_at] = pd.to_datetime(chunk[ended_at], format=datetime_format, errors='coerce')
+        for name in datetime_names:
+            units[name] = finest_datetime_unit(units[name], datetime_unit(chunk[name]))
+        for name in numeric_names:
+            dtypes[name] = merged_dtype(dtypes[name], chunk[name].dtype)
+
+    # Only columns whose dtype differs from what a single chunk may infer need to be forced
+    forced_dtypes = {name: dtype for name, dtype in dtypes.items() if dtype is not None and dtype.kind != 'i'}
+    return dict(zip(['started_at', 'ended_at'], [units[name] for name in datetime_names])), forced_dtypes
+
+# Function to render a datetime column as text with a fixed precision, leaving NaT as missing
+def format_datetime_column(series, unit):
+    values = series.values.astype('datetime64[ns]')
+    text = pd.Series(np.datetime_as_string(values, unit=unit), index=series.index, dtype=object)
+    text = text.str.replace('T', ' ', regex=False)
+    text[np.isnat(values)] = np.nan
+    return text
+
+# Function to open a raw CSV source, which is either a file path or an archive member
+# Archive members are (zip_path, member_chain, size) tuples from list_archive_jobs and are read
+# straight out of the zip; file paths are handed to pandas as they are
+@contextmanager
+def open_source(source):
+    if isinstance(source, str):
+        yield source
+    else:
+        zip_path, member_chain, _ = source
+        with open_archive_member(zip_path, list(member_chain)) as member:
+            yield member
+
+# Function to describe a raw CSV source in progress messages
+def source_name(source):
+    if isinstance(source, str):
+        return source
+    zip_path, member_chain, _ = source
+    return f"{zip_path}:{'/'.join(member_chain)}"
+
+# Function to get the uncompressed size of a raw CSV source, in bytes
+def source_size(source):
+    return os.path.getsize(source) if isinstance(source, str) else source[2]
+
+# Function to read a raw CSV from a path or an open file object, rewinding file objects first
+# so the same archive member can be read more than once
+def read_raw_csv(handle, **kwargs):
+    if hasattr(handle, 'seek'):
+        handle.seek(0)
+    return pd.read_csv(handle, **kwargs)
+
+# Function to read and transform a single CSV source, yielding (DataFrame, datetime units) pairs
+# With chunk_rows set, the file is read and transformed in chunks so memory stays flat; the units are the
+# precisions a full read would format each datetime column with (None for a full read, which needs none)
+# The format is read from the file's header; is_old_format (from the file name) is only used for unknown headers
+def iter_transformed_rides(source, city_name, is_old_format, chunk_rows=None):
+    with open_source(source) as handle:
+        plan = detect_csv_format(handle, is_old_format)
+        if chunk_rows is None:
+            with substage('read_csv'):
+                df = read_rides_csv(handle, plan)
+            with substage('transform'):
+                df = transform_rides(df, plan['is_old_format'], city_name)
+            yield df, None
+            return
+
+        with substage('scan_layout'):
+            try:
+                units, forced_dtypes = scan_file_layout(handle, plan, chunk_rows)
+            except ValueError as e:
+                if not plan['typed']:
+                    raise
+                use_inferred_types(plan, e)
+                units, forced_dtypes = scan_file_layout(handle, plan, chunk_rows)
+        options = typed_read_csv_options(plan) if plan['typed'] else read_csv_options(plan['is_old_format'])
+        options['dtype'] = {**options.get('dtype', {}), **forced_dtypes}
+        reader = read_raw_csv(handle, chunksize=chunk_rows, **options)
+        while True:
+            with substage('read_csv'):
+                chunk = next(reader, None)
+                if chunk is not None and plan['typed']:
+                    chunk = apply_csv_format(chunk, plan)
+            if chunk is None:
+                break
+            with substage('transform'):
+                df = transform_rides(chunk, plan['is_old_format'], city_name)
+            yield df, units
+
+# Function to render transformed rides as CSV text ready for COPY (without the header row)
+# Datetime columns of a chunk are formatted with the given units in place
+def rides_csv_text(df, units=None):
+    with substage('to_csv'):
+        for column, unit in (units or {}).items():
+            if unit is not None:
+                df[column] = format_datetime_column(df[column], unit)
+        return df.to_csv(None, index=False, na_rep='NULL', header=False)
+
+# Function to preprocess a single CSV source into CSV text ready for COPY, yielding (row_count, text) pairs
+# The header row comes first
+def iter_preprocessed_csv(source, city_name, is_old_format, chunk_rows=None):
+    yield 0, ','.join(final_columns) + '\n'
+    for df, units in iter_transformed_rides(source, city_name, is_old_format, chunk_rows):
+        yield len(df), rides_csv_text(df, units)
+
+# Function to name a source's files in the Parquet dataset after its preprocessed CSV
+def parquet_name(output_path):
+    return os.path.splitext(os.path.basename(output_path))[0].removeprefix('preprocessed_')
+
+# Function to preprocess a single CSV source and save it for COPY, and/or into the Parquet dataset
+# Both outputs are written from the same pass over the file
+def preprocess_file(source, output_path, city_name, is_old_format, chunk_rows=None, output_format='csv'):
+    rows = 0
+    with ExitStack() as stack:
+        record = stack.enter_context(stage('preprocess', file=source_name(source), output_format=output_format))
+        record['bytes'] = source_size(source)
+        csv_output = None
+        if output_format in ('csv', 'both'):
+            csv_output = stack.enter_context(open(output_path, 'w', newline=''))
+            csv_output.write(','.join(final_columns) + '\n')
+        parquet_sink = None
+        if output_format in ('parquet', 'both'):
+            parquet_sink = stack.enter_context(ParquetPartitionSink(parquet_dir, parquet_name(output_path), city_name))
+
+        for df, units in iter_transformed_rides(source, city_name, is_old_format, chunk_rows):
+            if parquet_sink is not None:
+                with substage('write_parquet'):
+                    parquet_sink.write(df)
+            if csv_output is not None:
+                text = rides_csv_text(df, units)
+                with substage('write_csv'):
+                    csv_output.write(text)
+            rows += len(df)
+        record['rows'] = rows
+    return rows
+
+# Function to list the files in a directory that need preprocessing
+# Yields (file_path, output_path, city_name, is_old_format) for each CSV
+def list_preprocessing_jobs(directory, city_name):
     for filename in os.listdir(directory):
         if filename.endswith('.csv'):
             file_path = os.path.join(directory, filename)
-            print(f"Processing file: {file_path}")
-
-             # Assume new format unless specified in the filename
+            # Assume new format unless specified in the filename
             is_old_format = 'old' in filename.lower()
-            datetime_cols_indices = [1, 2] if is_old_format else [2, 3]
-            converters = {5: str, 7: str} if not is_old_format else {}
-            df = pd.read_csv(file_path, parse_dates=datetime_cols_indices, converters=converters)
-
-            # Assign column names based on format and position
-            if is_old_format:
-                df.columns = ['trip_duration_seconds', 'started_at', 'ended_at',
-                              'start_station_id', 'start_station_name', 'start_lat',
-                              'start_lng', 'end_station_id', 'end_station_name', 'end_lat',
-                              'end_lng', 'bike_id', 'user_type', 'birth_year', 'gender']
-                df['member_casual'] = df['user_type'].map({'Subscriber': 'casual', 'Customer': 'member'})
-                df.drop('user_type', axis=1, inplace=True)  # Remove the user_type column
-                df['rideable_type'] = pd.NA
-                df['ride_id'] = df.apply(lambda x: generate_uuid(x['started_at'], x['start_station_id'], x['bike_id']), axis=1)
-                df['birth_year'] = df['birth_year'].replace({r'\\N': pd.NA, r'\N': pd.NA})
-                df['birth_year'] = df['birth_year'].astype('Int64')
-            else:  # New format
-                df.columns = ['ride_id', 'rideable_type', 'started_at', 'ended_at',
-                              'start_station_name', 'start_station_id', 'end_station_name',
-                              'end_station_id', 'start_lat', 'start_lng', 'end_lat', 'end_lng',
-                              'member_casual']
-                df['trip_duration_seconds'] = pd.NA
-                df['bike_id'] = pd.NA
-                df['gender'] = pd.NA
-                df['birth_year'] = pd.NA
-
-            df['started_at'] = pd.to_datetime(df['started_at'])
-            df['ended_at'] = pd.to_datetime(df['ended_at'], errors='coerce')
-            df['data_source_city'] = city_name
-            # Convert start_station_id and end_station_id to strings before replacing decimal parts
-            df['start_station_id'] = df['start_station_id'].astype(str).str.replace(r'\.\d+', '', regex=True)
-            df['end_station_id'] = df['end_station_id'].astype(str).str.replace(r'\.\d+', '', regex=True)
-
-            # Define final column order and save preprocessed CSV
-            final_columns = ['ride_id', 'rideable_type', 'started_at', 'ended_at',
-                             'start_station_name', 'start_station_id', 'end_station_name', 'end_station_id',
-                             'start_lat', 'start_lng', 'end_lat', 'end_lng', 'member_casual',
-                             'trip_duration_seconds', 'bike_id', 'gender', 'birth_year', 'data_source_city']
-            df = df[final_columns]
             preprocessed_csv_path = os.path.join(preprocessed_csv_dir, f"preprocessed_{filename}")
-            df.to_csv(preprocessed_csv_path, index=False, na_rep='NULL', header=True)
+            yield file_path, preprocessed_csv_path, city_name, is_old_format
+
+# Function to list the CSVs inside the downloaded archives that need preprocessing
+# Uses the same (source, output_path, city_name, is_old_format) layout as list_preprocessing_jobs
+def list_archive_jobs(zip_directory):
+    zip_paths = [os.path.join(zip_directory, name) for name in os.listdir(zip_directory) if name.endswith('.zip')]
+    for zip_path, member_chain, base_directory, csv_name, size in list_archive_csvs(zip_paths):
+        source = (zip_path, tuple(member_chain), size)
+        preprocessed_csv_path = os.path.join(preprocessed_csv_dir, f"preprocessed_{csv_name}")
+        yield source, preprocessed_csv_path, city_names[base_directory], 'old' in csv_name.lower()
+
+# Function to list every raw CSV to preprocess, from the archives or the extracted data directories
+def list_raw_jobs(read_from_zips=READ_FROM_ZIPS):
+    if read_from_zips:
+        return list(list_archive_jobs(zips_dir))
+    return [*list_preprocessing_jobs(nyc_dir, 'NYC'), *list_preprocessing_jobs(jersey_city_dir, 'Jersey City')]
+
+# Modified function to preprocess CSV files and save them for COPY
+def preprocess_and_save_csv_for_copy(directory, city_name, chunk_rows=CHUNK_ROWS, output_format=OUTPUT_FORMAT):
+    for file_path, preprocessed_csv_path, city_name, is_old_format in list_preprocessing_jobs(directory, city_name):
+        print(f"Processing file: {file_path}")
+        preprocess_file(file_path, preprocessed_csv_path, city_name, is_old_format, chunk_rows, output_format)
+
+# Function to read the memory available to new processes, in bytes (None if unknown)
+def available_memory_bytes():
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+# Function to pick a worker count from the CPU count and the memory each worker is expected to need
+# A full read peaks at several times the CSV size; a chunked read at roughly a few KB per buffered row
+def choose_worker_count(largest_file_bytes, job_count, chunk_rows=CHUNK_ROWS):
+    workers = min(os.cpu_count() or 1, job_count)
+    per_worker_bytes = chunk_rows * WORKER_BYTES_PER_CHUNK_ROW if chunk_rows else largest_file_bytes * WORKER_MEMORY_PER_CSV_BYTE
+    memory = available_memory_bytes()
+    if memory is not None and per_worker_bytes > 0:
+        workers = min(workers, memory // per_worker_bytes)
+    return max(1, int(workers))
+
+# Function run in each worker process to preprocess one file and time it
+def preprocess_file_timed(source, output_path, city_name, is_old_format, chunk_rows, output_format):
+    start = time.perf_counter()
+    rows = preprocess_file(source, output_path, city_name, is_old_format, chunk_rows, output_format)
+    return rows, time.perf_counter() - start
+
+# Function to preprocess a list of jobs (from list_raw_jobs) across a process pool
+# Files are scheduled largest first and fail individually; returns one result dict per file
+def preprocess_in_parallel(jobs, workers=PREPROCESS_WORKERS, chunk_rows=CHUNK_ROWS, output_format=OUTPUT_FORMAT):
+    jobs = sorted(jobs, key=lambda job: source_size(job[0]), reverse=True)
+    if not jobs:
+        return []
+    if workers is None:
+        workers = choose_worker_count(source_size(jobs[0][0]), len(jobs), chunk_rows)
+    print(f"Preprocessing {len(jobs)} files with {workers} worker processes...")
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(preprocess_file_timed, *job, chunk_rows, output_format): job for job in jobs}
+        for future in as_completed(futures):
+            source, output_path = futures[future][:2]
+            file_path = source_name(source)
+            try:
+                rows, seconds = future.result()
+                results.append({'file': file_path, 'rows': rows, 'seconds': seconds, 'error': None})
+                print(f"Processed file: {file_path} ({rows:,} rows in {seconds:.1f}s)")
+            except Exception as e:
+                results.append({'file': file_path, 'rows': 0, 'seconds': 0.0, 'error': repr(e)})
+                print(f"An error occurred while processing {file_path}: {e}")
+                # Don't leave a partial output behind for the loader to pick up
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+    return results
+
+# Function to record in the ingestion manifest that every fetched archive has been preprocessed,
+# so the next ingestion run only fetches new or changed months
+def mark_archives_preprocessed(read_from_zips=READ_FROM_ZIPS):
+    if not os.path.exists(manifest_path):
+        return
+    ready_states = (EXTRACTED, DOWNLOADED) if read_from_zips else (EXTRACTED,)
+    marked = mark_entries(load_manifest(manifest_path), ready_states, PREPROCESSED, manifest_path)
+    print(f"Marked {marked} archives as preprocessed in the manifest.")
+
+# Function to print the per-file summary of a parallel preprocessing run
+def print_preprocessing_summary(results):
+    print(f"{'file':<60} {'rows':>12} {'seconds':>9} {'rows/s':>10}")
+    for result in sorted(results, key=lambda result: result['file']):
+        name = os.path.basename(result['file'])
+        if result['error']:
+            print(f"{name:<60} FAILED: {result['error']}")
+        else:
+            rate = result['rows'] / result['seconds'] if result['seconds'] else 0
+            print(f"{name:<60} {result['rows']:>12,} {result['seconds']:>9.1f} {rate:>10,.0f}")
+    failed = sum(1 for result in results if result['error'])
+    print(f"{len(results) - failed} files succeeded, {failed} failed, "
+          f"{sum(result['rows'] for result in results):,} rows in total.")
+
+if __name__ == '__main__':
+    os.makedirs(preprocessed_csv_dir, exist_ok=True)
 
-preprocess_and_save_csv_for_copy(nyc_dir, 'NYC')
-preprocess_and_save_csv_for_copy(jersey_city_dir, 'Jersey City')
+    if PREPROCESS_WORKERS == 1:
+        for source, preprocessed_csv_path, city_name, is_old_format in list_raw_jobs():
+            print(f"Processing file: {source_name(source)}")
+            preprocess_file(source, preprocessed_csv_path, city_name, is_old_format, CHUNK_ROWS, OUTPUT_FORMAT)
+        failed = 0
+    else:
+        results = preprocess_in_parallel(list_raw_jobs())
+        print_preprocessing_summary(results)
+        failed = sum(1 for result in results if result['error'])
 
-shutil.rmtree(nyc_dir, ignore_errors=True)
-shutil.rmtree(jersey_city_dir, ignore_errors=True)
+    # Keep the raw data around if any file failed so it can be fixed and re-run
+    if failed:
+        print(f"{failed} files failed; keeping the raw data.")
+    else:
+        mark_archives_preprocessed()
+        if READ_FROM_ZIPS:
+            shutil.rmtree(zips_dir, ignore_errors=True)
+        else:
+            shutil.rmtree(nyc_dir, ignore_errors=True)
+            shutil.rmtree(jersey_city_dir, ignore_errors=True)
 
-print("Data preprocessing completed.")
\ No newline at end of file
+    print("Data preprocessing completed.")
@@ -0,0 +1,301 @@
+import io
+import re
+import csv
+import itertools
+from collections import Counter
+import numpy as np
+import pandas as pd
+import psycopg2
+from binarycopy_final import rides_binary_types, binary_copy_header, binary_copy_row_list, binary_copy_trailer
+from metrics_final import substage, count_in_stage
+
+# Lines of a preprocessed CSV file COPYed at a time in resilient loads; a failing batch is all that is re-checked
+RESILIENT_BATCH_ROWS = 100_000
+
+# SQL statement to create the table rejected rows are kept in, with the reason they were rejected for
+# row_data is the row as a line of preprocessed CSV, so it can be fixed and loaded again
+create_quarantine_table_sql = """
+CREATE TABLE IF NOT EXISTS rides_quarantine (
+    quarantined_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    source VARCHAR(255) NOT NULL,  -- File (or archive member) the row was loaded from
+    reason TEXT NOT NULL,
+    row_data TEXT NOT NULL
+);
+"""
+
+# Limits of the load table columns (rides_csv_columns_sql in loading_final.py) beyond their types
+not_null_columns = ['ride_id', 'started_at', 'data_source_city']
+text_lengths = {column: 255 for column, column_type in rides_binary_types.items() if column_type == 'text'}
+text_lengths['member_casual'] = 50
+# DECIMAL(9, 6) leaves 3 digits before the point
+numeric_limit = 1000
+int_range = (-2 ** 31, 2 ** 31 - 1)
+
+# List csv.writer can write to, which collects each row it writes as a string of its own
+class RowLines(list):
+    write = list.append
+
+# Function to write values as one line of CSV, with missing values as 'NULL' like the preprocessed CSVs
+def csv_line(values):
+    lines = RowLines()
+    csv.writer(lines, lineterminator='').writerow(['NULL' if pd.isna(value) else value for value in values])
+    return lines[0]
+
+# Function to find the problems of one column that COPY would certainly refuse a row for
+# Yields (mask, describe) pairs, where describe turns a flagged position into its reason
+def column_problems(series, column):
+    column_type = rides_binary_types[column]
+    if column_type == 'text':
+        codes, uniques = pd.factorize(series)
+        # Problems are worked out once per distinct value, the last one standing for missing values
+        texts = pd.Series([str(value) for value in uniques] + ['NULL'], dtype=object)
+        positions = np.where(codes < 0, len(uniques), codes)
+        missing = (texts == 'NULL').to_numpy()[positions]
+        # Trailing spaces beyond the length are cut off rather than refused
+        too_long = (texts.str.len() > text_lengths[column]).to_numpy()
+        too_long[too_long] = (texts[too_long].str.rstrip(' ').str.len() > text_lengths[column]).to_numpy()
+        too_long = too_long[positions]
+        yield too_long, lambda i: f"{column}: longer than {text_lengths[column]} characters"
+        has_nul = texts.str.contains('\x00', regex=False).to_numpy()[positions]
+        yield has_nul, lambda i: f"{column}: contains a NUL character"
+    elif series.dtype == object:
+        # Rows read as text: 'NULL' is missing, and an empty value is never a valid number or timestamp
+        missing = (series.isna() | (series == 'NULL')).to_numpy()
+        empty = (series == '').to_numpy()
+        yield empty, lambda i: f"{column}: empty value"
+        if column_type != 'timestamp':
+            numbers = pd.to_numeric(series.where(~missing & ~empty), errors='coerce').to_numpy(dtype='float64')
+    else:
+        missing = series.isna().to_numpy()
+        if column_type != 'timestamp':
+            numbers = series.to_numpy(dtype='float64', na_value=np.nan)
+
+    if column_type == 'numeric':
+        with np.errstate(invalid='ignore'):
+            out_of_range = np.isinf(numbers) | (np.round(np.abs(numbers), 6) >= numeric_limit)
+        yield out_of_range, lambda i: f"{column}: {series.iloc[i]} is out of range for DECIMAL(9, 6)"
+    elif column_type == 'int4':
+        out_of_range = (numbers < int_range[0]) | (numbers > int_range[1])
+        yield out_of_range, lambda i: f"{column}: {series.iloc[i]} is out of range for INT"
+    if column in not_null_columns:
+        yield missing, lambda i: f"{column}: missing"
+
+# Function to check rides against the limits of the load table in bulk, before they are COPYed
+# Works on transformed DataFrames and on rows read as text from a preprocessed CSV. Only rows COPY would certainly
+# refuse are flagged (missing required values, values too long or out of range); anything else is left to COPY
+# Returns the reason each flagged row is rejected for, by position
+def validate_rides(df):
+    problems = {}
+    with substage('validate'):
+        for column in df.columns:
+            for mask, describe in column_problems(df[column], column):
+                for position in np.flatnonzero(mask):
+                    problems.setdefault(position, []).append(describe(position))
+    return {position: '; '.join(reasons) for position, reasons in problems.items()}
+
+# Function to turn an error raised by COPY into a reason, naming the column COPY was reading if it says which
+def error_reason(error):
+    message = error.diag.message_primary or str(error).strip()
+    column = re.search(r', column (\w+)', error.diag.context or '')
+    return f"{column.group(1)}: {message}" if column else message
+
+# Function to read the header row of CSV text (a file object, or chunks with the header row first)
+# and the blocks of whole rows after it: chunks are kept as they are, files are read batch_rows lines at a time
+def csv_blocks(chunks, batch_rows=RESILIENT_BATCH_ROWS):
+    if hasattr(chunks, 'read'):
+        header = chunks.readline()
+        blocks = file_blocks(chunks, batch_rows)
+    else:
+        chunks = iter(chunks)
+        header, _, rest = next(chunks, '').partition('\n')
+        header += '\n'
+        blocks = itertools.chain([rest] if rest else [], chunks)
+    return header, blocks
+
+# Function to read a CSV file in blocks of batch_rows lines, extended while a quoted value runs on to the next line
+def file_blocks(f, batch_rows):
+    while True:
+        lines = list(itertools.islice(f, batch_rows))
+        if not lines:
+            return
+        block = ''.join(lines)
+        quotes = block.count('"')
+        while quotes % 2:
+            line = f.readline()
+            if not line:
+                break
+            block += line
+            quotes += line.count('"')
+        yield block
+
+# Function to read a block of CSV rows as text, keeping every value as written ('NULL' included)
+# Returns the rows with one value per column as a DataFrame along with each of them encoded as a line of CSV,
+# and the (reason, row_data) pairs of the other rows
+def read_csv_block(block, columns):
+    lines = [line + '\n' for line in block.split('\n')]
+    lines[-1] = lines[-1][:-1]
+    if any(line.count('"') % 2 for line in lines):
+        # A quoted value runs over several lines: the rows are read from the whole block and written out again
+        lines = None
+        rows = ((None, record) for record in csv.reader(io.StringIO(block)))
+    else:
+        rows = zip(lines, csv.reader(lines))
+
+    records, encoded, malformed = [], [], []
+    for line, record in rows:
+        if len(record) == len(columns):
+            records.append(record)
+            encoded.append(line)
+        elif record:
+            malformed.append((f"columns: {len(record)} values instead of {len(columns)}", csv_line(record)))
+    if lines is None:
+        encoded = RowLines()
+        csv.writer(encoded, lineterminator='\n').writerows(records)
+    return pd.DataFrame(records, columns=columns, dtype=object), [line.encode('utf-8') for line in encoded], malformed
+
+# Copies the rides of one source into a load table without letting a few bad rows fail the whole source
+# CSV text goes to COPY a batch at a time as it is, each batch in a savepoint; only a batch whose COPY fails is read
+# and validated, and transformed DataFrames (binary COPY) are validated before they are encoded. Rows that pass
+# validation but still fail are isolated by splitting their batch in halves until COPY refuses single rows.
+# Rejected rows are written to rides_quarantine with their reason, in the same transaction as the good ones
+class ResilientCopy:
+    def __init__(self, cursor, table, copy_statement, source, copy_format='csv', buffer_size=8192):
+        self.cursor = cursor
+        self.table = table
+        self.copy_statement = copy_statement
+        self.source = source or table
+        self.copy_format = copy_format
+        self.buffer_size = buffer_size
+        self.header = None
+        self.columns = None
+        self.rows = 0
+        self.rejected = []
+
+    # Function to COPY a file object or chunks as copy_rides_into in loading_final.py takes them
+    # Returns the number of rows copied
+    def copy(self, chunks):
+        self.cursor.execute(create_quarantine_table_sql)
+        if self.copy_format == 'binary':
+            for df in chunks:
+                self.columns = list(df.columns)
+                self.copy_frame(df)
+        else:
+            header, blocks = csv_blocks(chunks)
+            self.header = header.encode('utf-8')
+            self.columns = next(csv.reader([header]))
+            for block in blocks:
+                self.copy_csv_block(block)
+        self.reject_unmergeable_rows()
+        self.write_quarantine()
+        return self.rows
+
+    # Function to COPY encoded rows inside a savepoint, so a failure only undoes them
+    # Returns the error COPY raised, or None once the rows are in
+    def try_copy(self, data):
+        self.cursor.execute("SAVEPOINT resilient_copy;")
+        try:
+            self.cursor.copy_expert(sql=self.copy_statement, file=io.BytesIO(data), size=self.buffer_size)
+        except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+            self.cursor.execute("ROLLBACK TO SAVEPOINT resilient_copy;")
+            return e
+        self.rows += self.cursor.rowcount
+        self.cursor.execute("RELEASE SAVEPOINT resilient_copy;")
+        return None
+
+    # Function to join rows encoded one by one into the data of a COPY (CSV text starts with its header row)
+    def copy_data(self, encoded):
+        if self.copy_format == 'binary':
+            return b''.join([binary_copy_header, *encoded, binary_copy_trailer])
+        return self.header + b''.join(encoded)
+
+    # Function to COPY a block of CSV rows as it is, falling back to validating and bisecting it if COPY fails
+    def copy_csv_block(self, block):
+        if self.try_copy(self.header + block.encode('utf-8')) is None:
+            return
+        df, encoded, malformed = read_csv_block(block, self.columns)
+        self.rejected.extend(malformed)
+        self.copy_frame(df, encoded)
+
+    # Function to validate rows in bulk and COPY the ones that pass, bisecting if COPY still fails
+    # Each row is encoded once (encoded holds the lines of rows read from CSV text), so halves are only joined
+    def copy_frame(self, df, encoded=None):
+        reasons = validate_rides(df)
+        if reasons:
+            positions = sorted(reasons)
+            self.reject(df.iloc[positions], [reasons[position] for position in positions])
+            keep = np.setdiff1d(np.arange(len(df)), positions)
+            df = df.iloc[keep]
+            encoded = [encoded[i] for i in keep] if encoded is not None else None
+        if len(df):
+            self.copy_or_bisect(df, binary_copy_row_list(df) if encoded is None else encoded, 0, len(df))
+
+    # Function to COPY rows start to end, splitting them in halves while COPY fails until the rows it refuses
+    # are isolated. With k bad rows among n, that takes about 2k log2(n / k) COPYs of ever smaller batches
+    def copy_or_bisect(self, df, encoded, start, end):
+        error = self.try_copy(self.copy_data(encoded[start:end]))
+        if error is None:
+            return
+        if end - start == 1:
+            self.reject(df.iloc[start:end], [error_reason(error)])
+            return
+        with substage('bisect'):
+            middle = (start + end) // 2
+            self.copy_or_bisect(df, encoded, start, middle)
+            self.copy_or_bisect(df, encoded, middle, end)
+
+    # Function to keep rejected rows with their reasons
+    def reject(self, df, reasons):
+        self.rejected.extend(zip(reasons, (csv_line(row) for row in df.itertuples(index=False))))
+
+    # Function to move the copied rows that the merge into 'rides' would fail on to the quarantine
+    # The compact schema stores some columns as enums and SMALLINTs, which take fewer values than the load table's
+    # columns; the rows of earlier sources in the load table have been checked already, so only new ones are found
+    def reject_unmergeable_rows(self):
+        self.cursor.execute("""
+            SELECT a.attname, t.typname, t.typtype = 'e'
+            FROM pg_attribute a JOIN pg_type t ON t.oid = a.atttypid
+            WHERE a.attrelid = 'rides'::regclass AND a.attnum > 0 AND NOT a.attisdropped;
+        """)
+        checks = []
+        for column, type_name, is_enum in self.cursor.fetchall():
+            if column not in (self.columns or []):
+                continue
+            if is_enum:
+                checks.append((f"{column}::text <> ALL(enum_range(NULL::{type_name})::text[])",
+                               f"'{column}: ' || {column} || ' is not a value of {type_name}'"))
+            elif type_name == 'int2':
+                checks.append((f"{column} NOT BETWEEN -32768 AND 32767",
+                               f"'{column}: ' || {column} || ' is out of range for SMALLINT'"))
+        if not checks:
+            return
+
+        reasons = ", ".join(f"CASE WHEN {condition} THEN {reason} END" for condition, reason in checks)
+        self.cursor.execute(f"""
+            DELETE FROM {self.table} WHERE {" OR ".join(f"({condition})" for condition, _ in checks)}
+            RETURNING concat_ws('; ', {reasons}), {", ".join(self.columns)};
+        """)
+        rows = self.cursor.fetchall()
+        self.rows -= len(rows)
+        self.rejected.extend((reason, csv_line(row)) for reason, *row in rows)
+
+    # Function to write the rejected rows to rides_quarantine and report how many rows of the source were rejected
+    def write_quarantine(self):
+        count_in_stage('rejected', len(self.rejected))
+        if not self.rejected:
+            print(f"Rejected 0 of {self.rows:,} rows of {self.source}.")
+            return
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        # Postgres text can't hold NUL characters, so the ones that got a row rejected are written escaped
+        writer.writerows((self.source, reason, row_data.replace('\x00', '\\x00'))
+                         for reason, row_data in self.rejected)
+        buffer.seek(0)
+        with substage('quarantine'):
+            self.cursor.copy_expert(sql="COPY rides_quarantine (source, reason, row_data) FROM STDIN WITH CSV",
+                                    file=buffer, size=self.buffer_size)
+
+        kinds = Counter(reason.split(':', 1)[0] for reason, _ in self.rejected)
+        summary = ", ".join(f"{kind}: {count:,}" for kind, count in kinds.most_common())
+        print(f"Rejected {len(self.rejected):,} of {self.rows + len(self.rejected):,} rows of {self.source} "
+              f"({summary}); they are kept in rides_quarantine.")
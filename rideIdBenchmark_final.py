@@ -0,0 +1,42 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+from preprocessing_final import generate_uuid, generate_uuids
+
+# Benchmark setup
+ROWS = 1_000_000
+WORKER_COUNTS = [1, os.cpu_count() or 1]
+
+# Function to build a frame that looks like the ride_id inputs of an old format file
+def build_old_format_sample(rows: int) -> pd.DataFrame:
+    rng = np.random.default_rng(42)
+    started_at = pd.Timestamp('2019-01-01') + pd.to_timedelta(rng.integers(0, 31 * 86400 * 1000, rows), unit='ms')
+    start_station_id = rng.choice([72.0, 79.0, 3255.0, np.nan], rows)
+    bike_id = rng.integers(14000, 40000, rows)
+    return pd.DataFrame({'started_at': started_at, 'start_station_id': start_station_id, 'bike_id': bike_id})
+
+# Function to time the row-by-row apply path used before batching
+def run_apply(df: pd.DataFrame) -> pd.Series:
+    return df.apply(lambda x: generate_uuid(x['started_at'], x['start_station_id'], x['bike_id']), axis=1)
+
+# Function to time the batched path with a given number of worker processes
+def run_batch(df: pd.DataFrame, workers: int) -> pd.Series:
+    return generate_uuids(df['started_at'], df['start_station_id'], df['bike_id'], workers=workers)
+
+if __name__ == '__main__':
+    df = build_old_format_sample(ROWS)
+    print(f"Generating ride_ids for {ROWS:,} rows...")
+
+    start = time.perf_counter()
+    expected = run_apply(df)
+    apply_seconds = time.perf_counter() - start
+    print(f"apply:            {apply_seconds:8.2f}s  {ROWS / apply_seconds:12,.0f} rows/s")
+
+    for workers in WORKER_COUNTS:
+        start = time.perf_counter()
+        result = run_batch(df, workers)
+        seconds = time.perf_counter() - start
+        matches = result.equals(expected)
+        print(f"batch ({workers:2d} procs): {seconds:8.2f}s  {ROWS / seconds:12,.0f} rows/s  "
+              f"speedup {apply_seconds / seconds:5.1f}x  identical={matches}")
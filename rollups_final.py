@@ -0,0 +1,182 @@
+import time
+import pandas as pd
+import psycopg2
+from metrics_final import MetricsConnection, stage
+
+# Database connection setup
+DATABASE_URI = 'YOUR_DATABASE_URI'
+
+# SQL statement to create the rollup tables, which hold pre-aggregated counts of 'rides' for dashboards
+# station_hourly_flows: departures (by started_at) and arrivals (by ended_at) per station, hour and rider type
+# daily_rides: rides per day (by started_at), city, rider type and bike type
+# rollup_pending_months: months whose rides changed since the rollups were last refreshed
+create_rollup_tables_sql = """
+CREATE TABLE IF NOT EXISTS station_hourly_flows (
+    hour TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    data_source_city VARCHAR(255) NOT NULL,
+    station_id VARCHAR(255) NOT NULL,
+    member_casual VARCHAR(50) NULL,
+    departures INT NOT NULL,
+    arrivals INT NOT NULL,
+    departure_seconds BIGINT NOT NULL,  -- Summed duration of the rides starting here
+    arrival_seconds BIGINT NOT NULL     -- Summed duration of the rides ending here
+);
+CREATE INDEX IF NOT EXISTS idx_station_hourly_flows_hour ON station_hourly_flows (hour);
+CREATE INDEX IF NOT EXISTS idx_station_hourly_flows_station_id ON station_hourly_flows (station_id, hour);
+
+CREATE TABLE IF NOT EXISTS daily_rides (
+    day DATE NOT NULL,
+    data_source_city VARCHAR(255) NOT NULL,
+    member_casual VARCHAR(50) NULL,
+    rideable_type VARCHAR(255) NULL,
+    rides INT NOT NULL,
+    duration_seconds BIGINT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_daily_rides_day ON daily_rides (day);
+
+CREATE TABLE IF NOT EXISTS rollup_pending_months (
+    month DATE PRIMARY KEY
+);
+"""
+
+# SQL statement to drop the rollup tables
+drop_rollup_tables_sql = """
+DROP TABLE IF EXISTS station_hourly_flows, daily_rides, rollup_pending_months;
+"""
+
+# Duration of a ride in seconds (new-format files have no trip_duration_seconds, so it is worked out again)
+ride_seconds_sql = "coalesce(EXTRACT(EPOCH FROM r.ended_at - r.started_at), 0)"
+
+# Function to build the statement that records the months a load table touches, so only they get refreshed
+# A ride counts towards the month it starts in (departures, daily_rides) and the one it ends in (arrivals)
+def record_pending_months_sql(source_table):
+    return f"""
+        INSERT INTO rollup_pending_months (month)
+        SELECT date_trunc('month', started_at)::date FROM {source_table}
+        UNION
+        SELECT date_trunc('month', ended_at)::date FROM {source_table} WHERE ended_at IS NOT NULL
+        ON CONFLICT (month) DO NOTHING;
+    """
+
+# Function to build the station id expression and join for one end of a ride ('start' or 'end')
+# The compact schema refers to stations by key, so the id is looked up in 'stations'
+def station_id_sql(end, compact):
+    if compact:
+        return "s.station_id", f"LEFT JOIN stations s ON s.station_key = r.{end}_station_key"
+    return f"r.{end}_station_id", ""
+
+# Function to build the statement that fills station_hourly_flows for one month (%(start)s to %(end)s)
+# Arrivals also filter on started_at, which lets a partitioned 'rides' skip the months after this one
+def refresh_station_hourly_flows_sql(compact=False):
+    start_station, start_join = station_id_sql('start', compact)
+    end_station, end_join = station_id_sql('end', compact)
+    return f"""
+        INSERT INTO station_hourly_flows (hour, data_source_city, station_id, member_casual, departures, arrivals,
+                                          departure_seconds, arrival_seconds)
+        SELECT hour, data_source_city, station_id, member_casual,
+               sum(departures), sum(arrivals), sum(departure_seconds), sum(arrival_seconds)
+        FROM (
+            SELECT date_trunc('hour', r.started_at) AS hour, r.data_source_city::text AS data_source_city,
+                   {start_station} AS station_id, r.member_casual::text AS member_casual,
+                   1 AS departures, 0 AS arrivals, {ride_seconds_sql} AS departure_seconds, 0 AS arrival_seconds
+            FROM rides r {start_join}
+            WHERE r.started_at >= %(start)s AND r.started_at < %(end)s
+            UNION ALL
+            SELECT date_trunc('hour', r.ended_at), r.data_source_city::text,
+                   {end_station}, r.member_casual::text,
+                   0, 1, 0, {ride_seconds_sql}
+            FROM rides r {end_join}
+            WHERE r.ended_at >= %(start)s AND r.ended_at < %(end)s AND r.started_at < %(end)s
+        ) AS flows
+        WHERE station_id IS NOT NULL AND station_id NOT IN ('nan', '')
+        GROUP BY hour, data_source_city, station_id, member_casual;
+    """
+
+# SQL statement that fills daily_rides for one month (%(start)s to %(end)s)
+refresh_daily_rides_sql = f"""
+    INSERT INTO daily_rides (day, data_source_city, member_casual, rideable_type, rides, duration_seconds)
+    SELECT r.started_at::date, r.data_source_city::text, r.member_casual::text, r.rideable_type::text,
+           count(*), sum({ride_seconds_sql})
+    FROM rides r
+    WHERE r.started_at >= %(start)s AND r.started_at < %(end)s
+    GROUP BY 1, 2, 3, 4;
+"""
+
+# Function to recompute the rollups of the months whose rides changed since the last refresh
+# Each month is replaced on its own (delete and re-aggregate in one transaction), so the other months are
+# never rescanned and an interrupted refresh carries on with the months still pending
+def refresh_rollups(conn, compact=False):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT month FROM rollup_pending_months ORDER BY month;")
+        months = [month for (month,) in cursor.fetchall()]
+
+        for month in months:
+            start = time.perf_counter()
+            with stage('rollup_refresh', month=month) as record:
+                cursor.execute("SELECT %s::date + interval '1 month';", (month,))
+                params = {'start': month, 'end': cursor.fetchone()[0]}
+                cursor.execute("DELETE FROM station_hourly_flows WHERE hour >= %(start)s AND hour < %(end)s;", params)
+                cursor.execute(refresh_station_hourly_flows_sql(compact), params)
+                record['rows'] = cursor.rowcount
+                cursor.execute("DELETE FROM daily_rides WHERE day >= %(start)s AND day < %(end)s;", params)
+                cursor.execute(refresh_daily_rides_sql, params)
+                cursor.execute("DELETE FROM rollup_pending_months WHERE month = %s;", (month,))
+                conn.commit()
+            print(f"Refreshed rollups for {month:%Y-%m} in {time.perf_counter() - start:.1f}s.")
+    if not months:
+        print("Rollups are up to date.")
+    return months
+
+# Function to run a rollup query and return the result as a DataFrame
+def query_frame(conn, sql, params):
+    with conn.cursor() as cursor:
+        cursor.execute(sql, params)
+        return pd.DataFrame(cursor.fetchall(), columns=[column.name for column in cursor.description])
+
+# Function to get departures and arrivals per station and hour between two times
+# station_ids limits the result to some stations; by_member_casual splits the counts by rider type
+def station_flows(conn, start, end, station_ids=None, by_member_casual=False):
+    member_casual = "member_casual, " if by_member_casual else ""
+    return query_frame(conn, f"""
+        SELECT station_id, hour, {member_casual}sum(departures) AS departures, sum(arrivals) AS arrivals
+        FROM station_hourly_flows
+        WHERE hour >= %(start)s AND hour < %(end)s
+          AND (%(station_ids)s::text[] IS NULL OR station_id = ANY(%(station_ids)s::text[]))
+        GROUP BY station_id, hour{", member_casual" if by_member_casual else ""}
+        ORDER BY station_id, hour;
+    """, {'start': start, 'end': end, 'station_ids': list(station_ids) if station_ids is not None else None})
+
+# Function to get the busiest stations (departures plus arrivals) between two times
+def busiest_stations(conn, start, end, limit=10):
+    return query_frame(conn, """
+        SELECT f.station_id, min(s.station_name) AS station_name,
+               sum(f.departures) AS departures, sum(f.arrivals) AS arrivals
+        FROM station_hourly_flows f
+        LEFT JOIN stations s ON s.station_id = f.station_id
+        WHERE f.hour >= %(start)s AND f.hour < %(end)s
+        GROUP BY f.station_id
+        ORDER BY sum(f.departures) + sum(f.arrivals) DESC
+        LIMIT %(limit)s;
+    """, {'start': start, 'end': end, 'limit': limit})
+
+# Function to get member and casual rides per day between two dates, optionally for one city
+def member_casual_by_day(conn, start, end, city=None):
+    return query_frame(conn, """
+        SELECT day, member_casual, sum(rides) AS rides,
+               (sum(duration_seconds) / nullif(sum(rides), 0) / 60.0)::float8 AS average_minutes
+        FROM daily_rides
+        WHERE day >= %(start)s AND day < %(end)s AND (%(city)s IS NULL OR data_source_city = %(city)s)
+        GROUP BY day, member_casual
+        ORDER BY day, member_casual;
+    """, {'start': start, 'end': end, 'city': city})
+
+if __name__ == '__main__':
+    # Refreshes the rollups of any months loaded since the last refresh (loading_final.py does this itself)
+    from loading_final import rides_is_compact
+
+    conn = psycopg2.connect(DATABASE_URI, connection_factory=MetricsConnection)
+    with conn.cursor() as cursor:
+        cursor.execute(create_rollup_tables_sql)
+    conn.commit()
+    refresh_rollups(conn, rides_is_compact(conn))
+    conn.close()
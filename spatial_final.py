@@ -0,0 +1,150 @@
+import numpy as np
+import pandas as pd
+from rollups_final import query_frame
+
+# Mean radius of the Earth in metres, used for every distance in the pipeline
+EARTH_RADIUS_METERS = 6_371_008.8
+METERS_PER_DEGREE = EARTH_RADIUS_METERS * np.pi / 180
+
+# Side of the grid cells StationIndex sorts stations into, in metres
+GRID_CELL_METERS = 250
+
+# Rings of cells searched around a point for its nearest station; points with no station that close
+# (bad coordinates far outside the city) are compared with every station instead
+NEAREST_MAX_RINGS = 8
+
+# Function to compute the great-circle (haversine) distance in metres between arrays of coordinates
+# Missing coordinates give NaN
+def haversine_meters(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(values, dtype='float64')) for values in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+# Function to list the cell offsets at a ring around a cell (ring 0 is the cell itself)
+def ring_offsets(ring):
+    if ring == 0:
+        return [(0, 0)]
+    return [(dx, dy) for dx in range(-ring, ring + 1) for dy in range(-ring, ring + 1) if max(abs(dx), abs(dy)) == ring]
+
+# In-memory grid index of the stations, for radius and nearest-station lookups without scanning every station
+# Stations are sorted by the grid cell they fall in, so the stations of a cell are one slice of the sorted arrays,
+# found with a binary search. A point only needs the cells around it: its radius, or rings of cells until a
+# station is found that is closer than anything in the next ring could be
+class StationIndex:
+    def __init__(self, stations, cell_meters=GRID_CELL_METERS):
+        self.stations = stations.dropna(subset=['latitude', 'longitude']).reset_index(drop=True)
+        self.lats = self.stations['latitude'].to_numpy(dtype='float64')
+        self.lngs = self.stations['longitude'].to_numpy(dtype='float64')
+        self.cell_meters = cell_meters
+        self.cell_lat = cell_meters / METERS_PER_DEGREE
+        # Cells are at least cell_meters wide up to NEAREST_MAX_RINGS cells beyond the stations' furthest latitude
+        # (1% wider, because a great circle between two points is a little shorter than their parallel)
+        furthest_lat = np.abs(self.lats).max(initial=0) + self.cell_lat * NEAREST_MAX_RINGS
+        self.cell_lng = 1.01 * cell_meters / (METERS_PER_DEGREE * np.cos(np.radians(min(furthest_lat, 89.0))))
+
+        keys = self.cell_keys(*self.cells(self.lats, self.lngs))
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+
+    def __len__(self):
+        return len(self.stations)
+
+    # Function to find the grid cell (column and row) of coordinates
+    def cells(self, lats, lngs):
+        return (np.floor(lngs / self.cell_lng).astype('int64'), np.floor(lats / self.cell_lat).astype('int64'))
+
+    @staticmethod
+    def cell_keys(cx, cy):
+        return cx * 2 ** 32 + (cy + 2 ** 31)
+
+    # Function to find the slices of the sorted stations that lie in the given cells
+    def cell_slices(self, cx, cy):
+        keys = self.cell_keys(cx, cy)
+        return (np.searchsorted(self.sorted_keys, keys, side='left'),
+                np.searchsorted(self.sorted_keys, keys, side='right'))
+
+    # Function to compare points with the stations of one cell each, keeping the closest station seen so far
+    def check_cells(self, points, cx, cy, lats, lngs, best, best_distance):
+        starts, ends = self.cell_slices(cx, cy)
+        for k in range((ends - starts).max(initial=0)):
+            has_station = starts + k < ends
+            point = points[has_station]
+            station = self.order[starts[has_station] + k]
+            distance = haversine_meters(lats[point], lngs[point], self.lats[station], self.lngs[station])
+            closer = distance < best_distance[point]
+            best_distance[point[closer]] = distance[closer]
+            best[point[closer]] = station[closer]
+
+    # Function to find the nearest station to each of many points, optionally only within max_meters
+    # Returns the positions of the stations in self.stations (-1 where there is none) and their distances
+    def nearest(self, lats, lngs, max_meters=None):
+        lats = np.asarray(lats, dtype='float64')
+        lngs = np.asarray(lngs, dtype='float64')
+        best = np.full(len(lats), -1)
+        best_distance = np.full(len(lats), np.inf)
+        if not len(self):
+            return best, np.full(len(lats), np.nan)
+
+        points = np.flatnonzero(np.isfinite(lats) & np.isfinite(lngs))
+        cx, cy = self.cells(lats[points], lngs[points])
+        ring = 0
+        while len(points) and ring <= NEAREST_MAX_RINGS:
+            for dx, dy in ring_offsets(ring):
+                self.check_cells(points, cx + dx, cy + dy, lats, lngs, best, best_distance)
+            # Stations in cells beyond this ring are at least ring * cell_meters away
+            reach = ring * self.cell_meters
+            pending = best_distance[points] > reach
+            if max_meters is not None and reach >= max_meters:
+                pending[:] = False
+            points, cx, cy = points[pending], cx[pending], cy[pending]
+            ring += 1
+
+        for point in points:
+            distance = haversine_meters(lats[point], lngs[point], self.lats, self.lngs)
+            best[point] = np.argmin(distance)
+            best_distance[point] = distance[best[point]]
+
+        too_far = np.isinf(best_distance) | (best_distance > max_meters if max_meters is not None else False)
+        best[too_far] = -1
+        best_distance[too_far] = np.nan
+        return best, best_distance
+
+    # Function to find the stations within a distance of a point, closest first
+    # Returns the rows of self.stations with a distance_meters column
+    def within(self, lat, lng, meters):
+        rings = int(np.ceil(meters / self.cell_meters))
+        if rings <= NEAREST_MAX_RINGS:
+            (cx,), (cy,) = self.cells(np.array([lat]), np.array([lng]))
+            offsets = np.arange(-rings, rings + 1)
+            starts, ends = self.cell_slices(np.repeat(cx + offsets, len(offsets)), np.tile(cy + offsets, len(offsets)))
+            candidates = self.order[np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])]
+        else:
+            candidates = np.arange(len(self))
+        distance = haversine_meters(lat, lng, self.lats[candidates], self.lngs[candidates])
+        close = distance <= meters
+        found = self.stations.iloc[candidates[close]].assign(distance_meters=distance[close])
+        return found.sort_values('distance_meters', kind='stable').reset_index(drop=True)
+
+# Function to build the station index from the 'stations' table, as filled by loading_final.py
+# (the compact schema's station_key comes along with the rest of the station)
+def load_station_index(conn, cell_meters=GRID_CELL_METERS):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT * FROM stations WHERE latitude IS NOT NULL AND longitude IS NOT NULL;")
+        stations = pd.DataFrame(cursor.fetchall(), columns=[column.name for column in cursor.description])
+    stations[['latitude', 'longitude']] = stations[['latitude', 'longitude']].astype('float64')
+    return StationIndex(stations, cell_meters)
+
+# Function to count the rides that started within a distance of a point between two times, per station
+# The stations come from the index, and their departures from the station_hourly_flows rollup,
+# so nothing is computed over the rides table
+def departures_near(conn, index, lat, lng, meters, start, end):
+    stations = index.within(lat, lng, meters)
+    flows = query_frame(conn, """
+        SELECT station_id, sum(departures) AS departures
+        FROM station_hourly_flows
+        WHERE hour >= %(start)s AND hour < %(end)s AND station_id = ANY(%(station_ids)s::text[])
+        GROUP BY station_id;
+    """, {'start': start, 'end': end, 'station_ids': stations['station_id'].tolist()})
+    stations = stations[['station_id', 'station_name', 'distance_meters']].merge(flows, on='station_id', how='left')
+    stations['departures'] = stations['departures'].fillna(0).astype('int64')
+    return stations
@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import glob
+import shutil
+import platform
+import resource
+import subprocess
+import time
+import multiprocessing
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import psycopg2
+import syntheticData_final
+from metrics_final import MetricsConnection
+
+# Database connection setup (a local Postgres; the benchmark only touches its own schema)
+DATABASE_URI = 'YOUR_DATABASE_URI'
+BENCHMARK_SCHEMA = 'benchmark_stages'
+
+# Benchmark setup: the synthetic archives are generated once into benchmark_dir/archives
+# and every run works on a fresh copy of them in benchmark_dir/run
+benchmark_dir = 'stage_benchmark'
+ROWS_PER_FILE = 100_000
+BENCHMARK_RUNS = 3
+
+# Rows per chunk for preprocessing (None reads each file in one go, as preprocessing_final.py does by default)
+CHUNK_ROWS = None
+
+# Machine-readable results, and an earlier results file to compare against (None skips the comparison)
+BENCHMARK_OUTPUT = 'stage_benchmark.json'
+BASELINE_PATH = None
+
+# A stage whose rows/s drops by more than this share against the baseline counts as a regression
+REGRESSION_TOLERANCE = 0.2
+
+# Function to copy the generated archives into a fresh run directory laid out the way ingestion expects
+def prepare_run_directory(archive_dir, run_dir):
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(os.path.join(run_dir, 'zips'))
+    os.makedirs(os.path.join(run_dir, 'nyc_data'))
+    os.makedirs(os.path.join(run_dir, 'jersey_city_data'))
+    for zip_path in glob.glob(os.path.join(archive_dir, '*.zip')):
+        shutil.copy(zip_path, os.path.join(run_dir, 'zips'))
+
+# Stage: ingestion clean-up. Extracts the archives, flattens and de-duplicates them, marks the old format
+# files and deletes the redundant ones, exactly as ingestion_final.py does after downloading
+def run_ingestion_stage(run_dir):
+    from ingestion_final import extract_zip, remove_duplicates_and_move, rename_files, clean_up_files
+
+    os.chdir(run_dir)
+    zip_paths = sorted(glob.glob(os.path.join('zips', '*.zip')))
+    zip_bytes = sum(os.path.getsize(zip_path) for zip_path in zip_paths)
+    for zip_path in zip_paths:
+        extract_zip(os.path.basename(zip_path)[:-4], zip_path)
+    for directory in ['nyc_data', 'jersey_city_data']:
+        remove_duplicates_and_move(directory)
+        rename_files(directory)
+        clean_up_files(directory)
+
+    rows = 0
+    for csv_path in glob.glob(os.path.join('*_data', '*.csv')):
+        with open(csv_path, 'rb') as f:
+            rows += sum(1 for _ in f) - 1
+    return {'rows': rows, 'bytes': zip_bytes}
+
+# Stage: preprocessing. Turns every raw CSV into a preprocessed CSV for COPY
+def run_preprocessing_stage(run_dir):
+    import preprocessing_final
+
+    output_dir = os.path.join(run_dir, 'preprocessed_for_copy')
+    os.makedirs(output_dir, exist_ok=True)
+    preprocessing_final.preprocessed_csv_dir = output_dir
+    jobs = [*preprocessing_final.list_preprocessing_jobs(os.path.join(run_dir, 'nyc_data'), 'NYC'),
+            *preprocessing_final.list_preprocessing_jobs(os.path.join(run_dir, 'jersey_city_data'), 'Jersey City')]
+
+    rows = raw_bytes = 0
+    for source, output_path, city_name, is_old_format in jobs:
+        raw_bytes += os.path.getsize(source)
+        rows += preprocessing_final.preprocess_file(source, output_path, city_name, is_old_format, CHUNK_ROWS, 'csv')
+    return {'rows': rows, 'bytes': raw_bytes}
+
+# Function to create the tables in the benchmark schema, following the settings of createTables_final.py
+def create_benchmark_tables(conn):
+    from createTables_final import (PARTITION_RIDES, COMPACT_SCHEMA, create_stations_table_sql, rides_columns_sql,
+                                    create_enum_types_sql, create_compact_stations_table_sql,
+                                    compact_rides_columns_sql, rides_table_sql)
+    from rollups_final import create_rollup_tables_sql
+
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {BENCHMARK_SCHEMA} CASCADE; CREATE SCHEMA {BENCHMARK_SCHEMA};")
+        if COMPACT_SCHEMA:
+            cursor.execute(create_enum_types_sql)
+            cursor.execute(create_compact_stations_table_sql)
+            cursor.execute(rides_table_sql(compact_rides_columns_sql, PARTITION_RIDES))
+        else:
+            cursor.execute(create_stations_table_sql)
+            cursor.execute(rides_table_sql(rides_columns_sql, PARTITION_RIDES))
+        cursor.execute(create_rollup_tables_sql)
+    conn.commit()
+
+# Stage: loading. COPYs the preprocessed CSVs into the benchmark schema and finishes the load
+# (stations, foreign keys and rollups). Loads one file after another, as loading_final.py does with LOAD_WORKERS = 1
+def run_loading_stage(run_dir):
+    from loading_final import load_rides, load_rides_partitioned, rides_is_partitioned, finish_loading
+
+    filepaths = sorted(glob.glob(os.path.join(run_dir, 'preprocessed_for_copy', '*.csv')))
+    conn = psycopg2.connect(DATABASE_URI, options=f"-c search_path={BENCHMARK_SCHEMA}",
+                            connection_factory=MetricsConnection)
+    try:
+        create_benchmark_tables(conn)
+        if rides_is_partitioned(conn):
+            load_rides_partitioned(conn, filepaths)
+        else:
+            for filepath in filepaths:
+                load_rides(conn, filepath)
+        finish_loading(conn)
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM rides;")
+            rows = cursor.fetchone()[0]
+    finally:
+        conn.close()
+    return {'rows': rows, 'bytes': sum(os.path.getsize(filepath) for filepath in filepaths)}
+
+# Stages in the order they run; each one works on what the one before it left in the run directory
+stages = {
+    'ingestion clean-up': run_ingestion_stage,
+    'preprocessing': run_preprocessing_stage,
+    'loading': run_loading_stage,
+}
+
+# Function run in a fresh process for each stage, so its peak memory isn't mixed up with the other stages
+# Returns the stage's own counts plus its wall and CPU time and peak resident memory
+def measure_stage(stage_function, run_dir):
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    counts = stage_function(run_dir)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return {**counts, 'seconds': seconds, 'cpu_seconds': time.process_time() - cpu_start, 'peak_rss_bytes': peak_rss}
+
+# Function to run every stage once on a fresh copy of the archives
+def run_stages(archive_dir, run_dir):
+    prepare_run_directory(archive_dir, run_dir)
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for name, stage_function in stages.items():
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results[name] = executor.submit(measure_stage, stage_function, os.path.abspath(run_dir)).result()
+        print(f"{name}: {results[name]['seconds']:.2f}s")
+    return results
+
+# Function to summarise the runs of each stage by its fastest run, with throughput and peak memory
+def summarise_stages(runs):
+    summary = []
+    for name in stages:
+        fastest = min((run[name] for run in runs), key=lambda result: result['seconds'])
+        summary.append({
+            'stage': name,
+            'rows': fastest['rows'],
+            'bytes': fastest['bytes'],
+            'seconds': fastest['seconds'],
+            'cpu_seconds': fastest['cpu_seconds'],
+            'rows_per_second': fastest['rows'] / fastest['seconds'],
+            'mb_per_second': fastest['bytes'] / 1024 ** 2 / fastest['seconds'],
+            'peak_rss_mb': max(run[name]['peak_rss_bytes'] for run in runs) / 1024 ** 2,
+            'run_seconds': [run[name]['seconds'] for run in runs],
+        })
+    return summary
+
+# Function to describe the code and machine the benchmark ran on
+def benchmark_environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'git_commit': commit, 'python': platform.python_version(), 'pandas': pd.__version__,
+            'machine': platform.machine(), 'cpus': os.cpu_count()}
+
+# Function to compare stage throughput with an earlier results file
+# Returns the names of the stages that got slower than the tolerance allows
+def find_regressions(summary, baseline_path, tolerance=REGRESSION_TOLERANCE):
+    with open(baseline_path) as f:
+        baseline = {stage['stage']: stage for stage in json.load(f)['stages']}
+    regressions = []
+    print(f"{'stage':<20} {'baseline rows/s':>16} {'rows/s':>12} {'change':>8}")
+    for stage in summary:
+        if stage['stage'] not in baseline:
+            continue
+        before = baseline[stage['stage']]['rows_per_second']
+        change = stage['rows_per_second'] / before - 1
+        flag = '  REGRESSION' if change < -tolerance else ''
+        print(f"{stage['stage']:<20} {before:>16,.0f} {stage['rows_per_second']:>12,.0f} {change:>+8.1%}{flag}")
+        if flag:
+            regressions.append(stage['stage'])
+    return regressions
+
+# Function to print the summary table
+def print_stage_summary(summary):
+    print(f"{'stage':<20} {'rows':>10} {'MB':>8} {'seconds':>9} {'cpu s':>8} {'rows/s':>12} {'MB/s':>8} {'peak MB':>9}")
+    for stage in summary:
+        print(f"{stage['stage']:<20} {stage['rows']:>10,} {stage['bytes'] / 1024 ** 2:>8.1f} {stage['seconds']:>9.2f} "
+              f"{stage['cpu_seconds']:>8.2f} {stage['rows_per_second']:>12,.0f} {stage['mb_per_second']:>8.1f} "
+              f"{stage['peak_rss_mb']:>9.1f}")
+
+if __name__ == '__main__':
+    archive_dir = os.path.join(benchmark_dir, 'archives')
+    run_dir = os.path.join(benchmark_dir, 'run')
+
+    # Archives are only generated again when the scale changes
+    archives_path = os.path.join(archive_dir, 'archives.json')
+    archives = None
+    if os.path.exists(archives_path):
+        with open(archives_path) as f:
+            archives = json.load(f)
+        if archives['rows_per_file'] != ROWS_PER_FILE or archives['seed'] != syntheticData_final.SEED:
+            archives = None
+    if archives is None:
+        shutil.rmtree(archive_dir, ignore_errors=True)
+        archives = {'seed': syntheticData_final.SEED, 'rows_per_file': ROWS_PER_FILE,
+                    'files': syntheticData_final.generate_dataset(archive_dir, rows_per_file=ROWS_PER_FILE)}
+        with open(archives_path, 'w') as f:
+            json.dump(archives, f, indent=2)
+
+    runs = []
+    for run in range(BENCHMARK_RUNS):
+        print(f"Run {run + 1} of {BENCHMARK_RUNS}...")
+        runs.append(run_stages(archive_dir, run_dir))
+    shutil.rmtree(run_dir, ignore_errors=True)
+
+    summary = summarise_stages(runs)
+    print_stage_summary(summary)
+    results = {'generated_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+               'seed': archives['seed'], 'rows_per_file': archives['rows_per_file'],
+               'months': [archive['month'] + ' ' + archive['city'] for archive in archives['files']],
+               'chunk_rows': CHUNK_ROWS, 'environment': benchmark_environment(), 'stages': summary}
+    with open(BENCHMARK_OUTPUT, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {BENCHMARK_OUTPUT}.")
+
+    if BASELINE_PATH:
+        regressions = find_regressions(summary, BASELINE_PATH)
+        if regressions:
+            print(f"Slower than the baseline: {', '.join(regressions)}")
+            sys.exit(1)
@@ -0,0 +1,219 @@
+import os
+import csv
+import shutil
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+import numpy as np
+import pandas as pd
+
+# Output setup: archives are written the way the Citibike bucket serves them, ready for ingestion_final.py
+output_dir = 'synthetic_data'
+
+# Seed of the generator; the same seed, months and scale always give byte-identical files
+SEED = 42
+
+# Rides in each generated monthly file
+ROWS_PER_FILE = 100_000
+
+# Months to generate, as (year, month, city); months before February 2021 get the old data format
+synthetic_months = [(2015, 6, 'NYC'), (2017, 1, 'NYC'), (2018, 1, 'NYC'), (2019, 1, 'Jersey City'),
+                    (2021, 2, 'NYC'), (2023, 7, 'NYC'), (2023, 7, 'Jersey City')]
+
+# Stations in each city's catalog
+STATIONS_PER_CITY = 600
+
+# Shares of dirty rows, matching what the real files contain
+MISSING_END_STATION_SHARE = 0.01    # old format: 'NULL' end station; new format: blank end station
+MISSING_END_TIME_SHARE = 0.005      # new format: blank ended_at
+UNKNOWN_BIRTH_YEAR_SHARE = 0.05     # old format up to 2015: '\N' birth year
+FLOAT_STATION_ID_SHARE = 0.02       # old format: station ids written as '72.0'
+
+# Column headers of the title case old format files of late 2016 to early 2017 (the others are lower case)
+old_format_title_header = ['Trip Duration', 'Start Time', 'Stop Time', 'Start Station ID', 'Start Station Name',
+                           'Start Station Latitude', 'Start Station Longitude', 'End Station ID', 'End Station Name',
+                           'End Station Latitude', 'End Station Longitude', 'Bike ID', 'User Type', 'Birth Year',
+                           'Gender']
+
+# Rough centre of each city's stations, and the spread around it in degrees
+city_centres = {'NYC': (40.735, -73.985, 0.05), 'Jersey City': (40.725, -74.050, 0.015)}
+
+street_names = ['W 52 St', 'E 17 St', 'Broadway', 'Grand St', 'Fulton St', 'Christopher St', 'Newark Ave',
+                'Washington St', 'Pacific Ave', 'Bedford Ave', 'Canal St', 'Lafayette St', 'Bergen Ave',
+                'Columbus Ave', 'Atlantic Ave', 'Montgomery St']
+avenue_names = ['11 Ave', '1 Ave', 'Park Pl', 'Henry St', 'Hudson St', 'Grove St', 'Marin Blvd', 'Greene St',
+                'Lexington Ave', 'Driggs Ave', 'Church St', 'Essex St']
+
+# Function to check whether a month was published in the old (pre-February 2021) data format
+def is_old_format_month(year, month):
+    return (year, month) < (2021, 2)
+
+# Function to build the file name Citibike uses for a month, e.g. 'JC-201901-citibike-tripdata.csv'
+def month_file_name(year, month, city):
+    prefix = 'JC-' if city == 'Jersey City' else ''
+    return f"{prefix}{year}{month:02d}-citibike-tripdata.csv"
+
+# Function to make up the name of the i-th station of a catalog, e.g. 'W 52 St & 11 Ave'
+def station_name(i):
+    street, avenue = street_names[i % len(street_names)], avenue_names[i // len(street_names) % len(avenue_names)]
+    repeat = i // (len(street_names) * len(avenue_names))
+    return f"{street} & {avenue}" + (f" {repeat + 1}" if repeat else "")
+
+# Function to build a city's station catalog: ids in both formats, names and coordinates
+# The catalog only depends on the seed and the city, so every month of a city shares its stations
+def build_station_catalog(city, seed=SEED, stations=STATIONS_PER_CITY):
+    rng = np.random.default_rng([seed, len(city), sum(map(ord, city))])
+    latitude, longitude, spread = city_centres[city]
+    if city == 'Jersey City':
+        old_ids = 3183 + np.arange(stations)
+        new_ids = np.array([f"{'JC' if i % 3 else 'HB'}{i:03d}" for i in range(stations)])
+    else:
+        old_ids = 72 + np.arange(stations) * 5
+        new_ids = np.array([f"{4000 + i * 7 % 3000}.{i % 20:02d}" for i in range(stations)])
+    names = np.array([station_name(i) for i in range(stations)])
+    # Ride counts fall off with a station's rank, so a few stations are much busier than the rest
+    popularity = 1 / np.arange(1, stations + 1) ** 0.8
+    return pd.DataFrame({
+        'old_id': old_ids,
+        'new_id': new_ids,
+        'name': names,
+        'lat': np.round(latitude + rng.normal(0, spread, stations), 8),
+        'lng': np.round(longitude + rng.normal(0, spread, stations), 8),
+        'weight': popularity / popularity.sum(),
+    })
+
+# Function to draw the start time, duration, stations and rider type shared by both formats
+def draw_rides(rng, year, month, stations, rows):
+    month_start = np.datetime64(f"{year}-{month:02d}-01T00:00:00", 'ms')
+    month_ms = int((np.datetime64(f"{year + month // 12}-{month % 12 + 1:02d}-01", 'ms') - month_start).astype(int))
+    started_at = month_start + np.sort(rng.integers(0, month_ms, rows)).astype('timedelta64[ms]')
+    # Ride lengths are roughly log-normal, with a median around twelve minutes
+    duration_ms = np.clip(rng.lognormal(np.log(720), 0.7, rows), 61, 6 * 3600) * 1000
+    ended_at = started_at + duration_ms.astype('int64').astype('timedelta64[ms]')
+    start = rng.choice(len(stations), rows, p=stations['weight'].values)
+    end = rng.choice(len(stations), rows, p=stations['weight'].values)
+    member = rng.random(rows) < 0.8
+    return started_at, ended_at, duration_ms, start, end, member
+
+# Function to render datetimes as text, with a fractional part of `digits` digits (0 for none)
+def datetime_text(values, digits):
+    text = np.datetime_as_string(values, unit='ms' if digits else 's')
+    text = pd.Series(text).str.replace('T', ' ', regex=False)
+    return text + '0' * (digits - 3) if digits > 3 else text
+
+# Function to generate one month of rides in the old format, with its dirty rows
+def old_format_rides(rng, year, month, stations, rows):
+    started_at, ended_at, duration_ms, start, end, member = draw_rides(rng, year, month, stations, rows)
+    start_rows, end_rows = stations.iloc[start].reset_index(drop=True), stations.iloc[end].reset_index(drop=True)
+
+    # 2018 to 2020 files carry the time to a tenth of a millisecond ('2018-01-01 13:50:57.4340')
+    digits = 4 if year >= 2018 else 0
+    df = pd.DataFrame({
+        'tripduration': (duration_ms // 1000).astype('int64'),
+        'starttime': datetime_text(started_at, digits),
+        'stoptime': datetime_text(ended_at, digits),
+        'start station id': start_rows['old_id'].astype(str),
+        'start station name': start_rows['name'],
+        'start station latitude': start_rows['lat'],
+        'start station longitude': start_rows['lng'],
+        'end station id': end_rows['old_id'].astype(str),
+        'end station name': end_rows['name'],
+        'end station latitude': end_rows['lat'],
+        'end station longitude': end_rows['lng'],
+        'bikeid': rng.integers(14000, 40000, rows),
+        'usertype': np.where(member, 'Subscriber', 'Customer'),
+        'birth year': rng.integers(1940, 2004, rows).astype(str),
+        'gender': rng.choice([0, 1, 2], rows, p=[0.1, 0.65, 0.25]),
+    })
+
+    # Station ids that pandas will read back as floats
+    for column in ['start station id', 'end station id']:
+        float_ids = rng.random(rows) < FLOAT_STATION_ID_SHARE
+        df.loc[float_ids, column] = df.loc[float_ids, column] + '.0'
+    missing_end = rng.random(rows) < MISSING_END_STATION_SHARE
+    df.loc[missing_end, ['end station id', 'end station name', 'end station latitude', 'end station longitude']] = None
+    if year <= 2015:
+        df.loc[rng.random(rows) < UNKNOWN_BIRTH_YEAR_SHARE, 'birth year'] = r'\N'
+    return df
+
+# Function to generate one month of rides in the new format, with its dirty rows
+def new_format_rides(rng, year, month, stations, rows):
+    started_at, ended_at, _, start, end, member = draw_rides(rng, year, month, stations, rows)
+    start_rows, end_rows = stations.iloc[start].reset_index(drop=True), stations.iloc[end].reset_index(drop=True)
+
+    df = pd.DataFrame({
+        'ride_id': [f"{value:016X}" for value in rng.integers(0, 2 ** 62, rows, dtype=np.int64)],
+        'rideable_type': rng.choice(['classic_bike', 'electric_bike', 'docked_bike'], rows, p=[0.6, 0.35, 0.05]),
+        'started_at': datetime_text(started_at, 0),
+        'ended_at': datetime_text(ended_at, 0),
+        'start_station_name': start_rows['name'],
+        'start_station_id': start_rows['new_id'],
+        'end_station_name': end_rows['name'],
+        'end_station_id': end_rows['new_id'],
+        'start_lat': start_rows['lat'],
+        'start_lng': start_rows['lng'],
+        'end_lat': end_rows['lat'],
+        'end_lng': end_rows['lng'],
+        'member_casual': np.where(member, 'member', 'casual'),
+    })
+    df = df.sample(frac=1, random_state=rng.integers(2 ** 32)).reset_index(drop=True)
+
+    missing_end = rng.random(rows) < MISSING_END_STATION_SHARE
+    df.loc[missing_end, ['end_station_name', 'end_station_id', 'end_lat', 'end_lng']] = None
+    df.loc[rng.random(rows) < MISSING_END_TIME_SHARE, 'ended_at'] = None
+    return df
+
+# Function to write one month of rides as a CSV the way Citibike publishes it
+# Returns the number of rows written
+def write_month_csv(path, year, month, city, rows=ROWS_PER_FILE, seed=SEED):
+    rng = np.random.default_rng([seed, year, month, sum(map(ord, city))])
+    stations = build_station_catalog(city, seed)
+    if is_old_format_month(year, month):
+        df = old_format_rides(rng, year, month, stations, rows)
+        if (2016, 10) <= (year, month) <= (2017, 3):
+            df.columns = old_format_title_header
+        df.to_csv(path, index=False, na_rep='NULL', quoting=csv.QUOTE_ALL)
+    else:
+        df = new_format_rides(rng, year, month, stations, rows)
+        df.to_csv(path, index=False)
+    return len(df)
+
+# Function to build an archive entry dated to the start of its month, so archives don't depend on when they were made
+def archive_entry(name, year, month):
+    entry = ZipInfo(name, date_time=(year, month, 1, 0, 0, 0))
+    entry.compress_type = ZIP_DEFLATED
+    return entry
+
+# Function to write one month as a zipped archive named like the bucket's, e.g. '201901-citibike-tripdata.csv.zip'
+# 2013 and 2018 archives also get an overlapping '_1' part file, and Jersey City archives a __MACOSX entry,
+# so ingestion's clean-up has the same work to do as on the real data
+def write_month_zip(directory, year, month, city, rows=ROWS_PER_FILE, seed=SEED):
+    csv_name = month_file_name(year, month, city)
+    csv_path = os.path.join(directory, csv_name)
+    rows = write_month_csv(csv_path, year, month, city, rows, seed)
+    zip_path = f"{csv_path}.zip"
+    with ZipFile(zip_path, 'w') as archive:
+        with open(csv_path, 'rb') as source, archive.open(archive_entry(csv_name, year, month), 'w') as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+        if year in (2013, 2018):
+            with open(csv_path, 'rb') as source:
+                part = b''.join(line for _, line in zip(range(rows // 2 + 1), source))
+            archive.writestr(archive_entry(csv_name.replace('.csv', '_1.csv'), year, month), part)
+        if city == 'Jersey City':
+            archive.writestr(archive_entry(f"__MACOSX/._{csv_name}", year, month), b'\x00\x05\x16\x07')
+    os.remove(csv_path)
+    return zip_path, rows
+
+# Function to generate the archives of several months into a directory
+# Returns one dict per archive with its path, city, month, format, rows and size in bytes
+def generate_dataset(directory=output_dir, months=synthetic_months, rows_per_file=ROWS_PER_FILE, seed=SEED):
+    os.makedirs(directory, exist_ok=True)
+    archives = []
+    for year, month, city in months:
+        zip_path, rows = write_month_zip(directory, year, month, city, rows_per_file, seed)
+        archives.append({'path': zip_path, 'city': city, 'month': f"{year}-{month:02d}",
+                         'format': 'old' if is_old_format_month(year, month) else 'new',
+                         'rows': rows, 'bytes': os.path.getsize(zip_path)})
+        print(f"Generated {os.path.basename(zip_path)} ({rows:,} rows)")
+    return archives
+
+if __name__ == '__main__':
+    generate_dataset()